@@ -0,0 +1,78 @@
+from pathlib import Path
+from typing import List
+import numpy as np
+import pandas as pd
+from config import CPS_DATA_AGE_COUNTS_DIR
+from atomic_io import write_csv
+from variable_typing import *
+
+# Ages are counted from 0 to MAX_AGE (CPS ages are top-coded below this value)
+MAX_AGE = 99
+COUNT = "COUNT"
+
+def count_age_by_child(data_df: pd.DataFrame, age_var: str) -> np.ndarray:
+    """
+    Count the observations by age and HAS_CHILD with a single np.bincount.
+
+    Args:
+        data_df (pd.DataFrame): The child-related CPS data of one month.
+        age_var (str): The age variable (PEAGE or PRTAGE).
+
+    Returns:
+        np.ndarray: The counts, with shape (MAX_AGE + 1, 2).
+    """
+    age = pd.to_numeric(data_df[age_var], errors="coerce").to_numpy(dtype=float)
+    has_child = data_df[HAS_CHILD].to_numpy(dtype=float)
+    valid = (age >= 0) & (age <= MAX_AGE) & np.isin(has_child, [0, 1])
+    bins = age[valid].astype(np.int64) * 2 + has_child[valid].astype(np.int64)
+    return np.bincount(bins, minlength=(MAX_AGE + 1) * 2).reshape(MAX_AGE + 1, 2)
+
+def get_age_counts_file(data_file: Path) -> Path:
+    """
+    Get the path of the aggregate file of a monthly data file.
+    """
+    return CPS_DATA_AGE_COUNTS_DIR / f"{data_file.stem}.csv"
+
+def write_age_counts(counts: np.ndarray, year: int, output_file: Path) -> None:
+    """
+    Save the age counts of a month in long format (only the non-empty cells).
+
+    Args:
+        counts (np.ndarray): The counts from count_age_by_child.
+        year (int): The data year.
+        output_file (Path): The path to save the counts.
+    """
+    ages, has_child = np.nonzero(counts)
+    counts_df = pd.DataFrame({DATA_YEAR: year, AGE: ages, HAS_CHILD: has_child, COUNT: counts[ages, has_child]})
+    write_csv(counts_df, output_file, index=False)
+
+def build_missing_age_counts(child_data_files: List[Path]) -> None:
+    """
+    Build the age counts of the child data files that have none yet (e.g. months processed
+    before the counts were written by prep_04). Only the age and HAS_CHILD columns are read.
+
+    Args:
+        child_data_files (List[Path]): The child-related CPS data files.
+    """
+    for child_data_file in child_data_files:
+        output_file = get_age_counts_file(child_data_file)
+        if output_file.exists():
+            continue
+        columns = pd.read_csv(child_data_file, nrows=0).columns
+        age_var = "PEAGE" if "PEAGE" in columns else "PRTAGE"
+        data_df = pd.read_csv(child_data_file, usecols=[age_var, HAS_CHILD])
+        year = int(child_data_file.stem.split("_")[-1][:4])
+        write_age_counts(count_age_by_child(data_df, age_var), year, output_file)
+
+def load_age_counts() -> pd.DataFrame:
+    """
+    Load and sum the monthly age counts by DATA_YEAR, AGE and HAS_CHILD.
+
+    Returns:
+        pd.DataFrame: The counts with DATA_YEAR, AGE, HAS_CHILD and COUNT columns.
+    """
+    files = sorted(CPS_DATA_AGE_COUNTS_DIR.glob("*.csv"))
+    if not files:
+        raise FileNotFoundError(f"No age counts found in {CPS_DATA_AGE_COUNTS_DIR}")
+    counts_df = pd.concat([pd.read_csv(file) for file in files])
+    return counts_df.groupby([DATA_YEAR, AGE, HAS_CHILD], as_index=False)[COUNT].sum()
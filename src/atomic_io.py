@@ -0,0 +1,150 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional
+import json
+import os
+import re
+import shutil
+import socket
+import time
+from config import QUEUE_LEASE_SECONDS
+
+# Outputs are written to a temporary file in the same directory and renamed when complete,
+# then a completion marker records the size and modification time of the output and of its
+# inputs. An output without a matching marker (killed run, changed input) is redone. The
+# temporary files and markers are hidden (leading dot), so that they are ignored by the
+# month catalog, the pipeline status and the Parquet dataset discovery. A temporary file is
+# named after its writer (pid and host), so that only the files of dead writers are removed.
+MARKER_SUFFIX = ".done"
+TEMP_SUFFIX = ".tmp"
+TEMP_WRITER_PATTERN = re.compile(rf"\.(\d+)@(.+){re.escape(TEMP_SUFFIX)}$")
+
+def get_marker_file(output_file: Path) -> Path:
+    """
+    Get the completion marker of an output file (cps_199401.csv -> .cps_199401.csv.done).
+    """
+    return output_file.with_name(f".{output_file.name}{MARKER_SUFFIX}")
+
+def get_temp_file(file: Path) -> Path:
+    """
+    Get the temporary file of the current process for a file (cps_199401.csv -> .cps_199401.csv.1234@host.tmp).
+    """
+    name = file.name if file.name.startswith(".") else f".{file.name}"
+    return file.with_name(f"{name}.{os.getpid()}@{socket.gethostname()}{TEMP_SUFFIX}")
+
+def get_file_signature(file: Path) -> List[int]:
+    stat = file.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+def mark_complete(output_file: Path, inputs: Optional[List[Path]] = None) -> None:
+    """
+    Write the completion marker of an output file, with the signatures of its inputs.
+    """
+    marker = {"output": get_file_signature(output_file),
+              "inputs": {str(file): get_file_signature(file) for file in inputs or []}}
+    marker_file = get_marker_file(output_file)
+    temp_file = get_temp_file(marker_file)
+    temp_file.write_text(json.dumps(marker))
+    os.replace(temp_file, marker_file)
+
+def is_complete(output_file: Path, inputs: Optional[List[Path]] = None) -> bool:
+    """
+    Check whether an output file was completely written (from the same inputs, if given).
+    """
+    marker_file = get_marker_file(output_file)
+    if not output_file.exists() or not marker_file.exists():
+        return False
+    marker = json.loads(marker_file.read_text())
+    if marker["output"] != get_file_signature(output_file):
+        return False
+    return all(file.exists() and marker["inputs"].get(str(file)) == get_file_signature(file) for file in inputs or [])
+
+@contextmanager
+def atomic_output(output_file: Path, inputs: Optional[List[Path]] = None) -> Iterator[Path]:
+    """
+    Stage an output in a temporary file, and commit it when the block succeeds: the file is
+    flushed to disk, renamed over the output, and marked complete. On failure the temporary
+    file is removed and the previous output (if any) is left as it was, without its marker.
+
+    Args:
+        output_file (Path): The output file.
+        inputs (Optional[List[Path]]): The input files, recorded in the marker.
+
+    Yields:
+        Path: The temporary file to write.
+    """
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    get_marker_file(output_file).unlink(missing_ok=True)
+    temp_file = get_temp_file(output_file)
+    try:
+        yield temp_file
+        with open(temp_file, "rb+") as f:
+            os.fsync(f.fileno())
+        os.replace(temp_file, output_file)
+    except BaseException:
+        temp_file.unlink(missing_ok=True)
+        raise
+    mark_complete(output_file, inputs)
+
+def write_csv(data_df, output_file: Path, inputs: Optional[List[Path]] = None, **kwargs) -> None:
+    """
+    Write a DataFrame to a CSV file atomically (see atomic_output).
+    """
+    with atomic_output(output_file, inputs) as temp_file:
+        data_df.to_csv(temp_file, **kwargs)
+
+def link_output(source_file: Path, output_file: Path, inputs: Optional[List[Path]] = None) -> None:
+    """
+    Publish an input file unchanged as an output: hard-link it (copy it across filesystems)
+    to a temporary file, rename it over the output, and mark it complete. The writers
+    replace their outputs instead of writing in place, so the input is never modified.
+    """
+    get_marker_file(output_file).unlink(missing_ok=True)
+    temp_file = get_temp_file(output_file)
+    temp_file.unlink(missing_ok=True)
+    try:
+        os.link(source_file, temp_file)
+    except OSError:
+        shutil.copy2(source_file, temp_file)
+    os.replace(temp_file, output_file)
+    mark_complete(output_file, inputs)
+
+def is_process_running(pid: int) -> bool:
+    """
+    Check whether a process of this host is running.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # running, as another user
+        return True
+    return True
+
+def is_temp_file_live(temp_file: Path, max_age_seconds: float = QUEUE_LEASE_SECONDS) -> bool:
+    """
+    Check whether a temporary file may still be written: it was modified within max_age_seconds,
+    and its writer is running on this host or runs on another host (or is not known).
+    """
+    try:
+        age = time.time() - temp_file.stat().st_mtime
+    except FileNotFoundError:
+        return False
+    if age > max_age_seconds:
+        return False
+    match = TEMP_WRITER_PATTERN.search(temp_file.name)
+    if match is None or match.group(2) != socket.gethostname():
+        return True
+    return is_process_running(int(match.group(1)))
+
+def remove_temp_files(output_dir: Path, max_age_seconds: float = QUEUE_LEASE_SECONDS) -> int:
+    """
+    Remove the temporary files left by killed runs in a directory (and its subdirectories):
+    those of the dead writers of this host, and those not modified for max_age_seconds (the
+    writers of the other hosts). The files of the live writers (e.g. other workers) are kept.
+    """
+    temp_files = list(output_dir.rglob(f".*{TEMP_SUFFIX}")) if output_dir.exists() else []
+    temp_files = [temp_file for temp_file in temp_files if not is_temp_file_live(temp_file, max_age_seconds)]
+    for temp_file in temp_files:
+        temp_file.unlink(missing_ok=True)
+    return len(temp_files)
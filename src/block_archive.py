@@ -0,0 +1,218 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+import argparse
+import gzip
+import hashlib
+import json
+import struct
+import time
+import zlib
+import numpy as np
+from atomic_io import atomic_output, is_complete
+from config import CPS_DATA_GZ_DIR, CPS_DATA_FW_DIR, CPS_DATA_BLOCKS_DIR, ARCHIVE_BLOCK_BYTES
+from fixed_width_kernel import locate_records
+from month_catalog import get_month, is_sampled_month
+
+try: # zstandard is optional, zlib (stdlib) is used as a fallback
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# A block archive holds the fixed-width records of a month in independently compressed
+# blocks that start and end on record boundaries, followed by a JSON index of the blocks:
+#   MAGIC | block 0 | block 1 | ... | index | index length (uint64) | MAGIC
+# Any row range is read by decompressing only the blocks that overlap it, and the blocks of
+# a month are decompressed in parallel (zlib and zstd release the GIL).
+MAGIC = b"CPSBLK01"
+ARCHIVE_SUFFIX = ".blk"
+DEFAULT_CODEC = "zstd" if zstandard is not None else "zlib"
+ZSTD_LEVEL = 9
+ZLIB_LEVEL = 6
+
+def compress_block(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+def decompress_block(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise ImportError("The archive is zstd-compressed, install zstandard to read it.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+def iter_record_blocks(f, block_bytes: int) -> Iterator[bytes]:
+    """
+    Read a binary stream in blocks of about block_bytes that end on a line terminator (the
+    last block ends where the stream ends).
+    """
+    pending = b""
+    while True:
+        chunk = f.read(block_bytes)
+        if not chunk:
+            break
+        pending += chunk
+        cut = pending.rfind(b"\n") + 1
+        if cut > 0:
+            yield pending[:cut]
+            pending = pending[cut:]
+    if pending:
+        yield pending
+
+def build_archive(source_file: Path, archive_file: Path, block_bytes: int = ARCHIVE_BLOCK_BYTES,
+                  codec: str = DEFAULT_CODEC) -> Dict:
+    """
+    Recompress a raw month (the downloaded .gz file or an extracted fixed-width file) into a
+    block archive, streaming: only one block is in memory at a time.
+
+    Args:
+        source_file (Path): The .gz or fixed-width file.
+        archive_file (Path): The block archive.
+        block_bytes (int): The uncompressed size of a block (rounded to a record boundary).
+        codec (str): "zstd" or "zlib".
+
+    Returns:
+        Dict: The index of the archive.
+    """
+    index = {"codec": codec, "rows": 0, "record_length": None, "raw_bytes": 0, "blocks": []}
+    sha256 = hashlib.sha256()
+    opener = gzip.open if source_file.suffix == ".gz" else open
+    with opener(source_file, "rb") as f_in, atomic_output(archive_file, [source_file]) as temp_file, \
+            open(temp_file, "wb") as f_out:
+        f_out.write(MAGIC)
+        for block in iter_record_blocks(f_in, block_bytes):
+            starts, ends = locate_records(np.frombuffer(block, dtype=np.uint8))
+            if index["record_length"] is None and len(starts) > 0:
+                index["record_length"] = int(ends[0] - starts[0])
+            compressed = compress_block(block, codec)
+            index["blocks"].append([f_out.tell(), len(compressed), index["rows"], len(starts), len(block)])
+            f_out.write(compressed)
+            sha256.update(block)
+            index["rows"] += len(starts)
+            index["raw_bytes"] += len(block)
+        index["raw_sha256"] = sha256.hexdigest()
+        encoded_index = json.dumps(index).encode()
+        f_out.write(encoded_index + struct.pack("<Q", len(encoded_index)) + MAGIC)
+    return index
+
+def read_index(archive_file: Path) -> Dict:
+    """
+    Read the block index of an archive (from its footer, the blocks are not read).
+    """
+    with open(archive_file, "rb") as f:
+        f.seek(-(8 + len(MAGIC)), 2)
+        index_length, magic = struct.unpack("<Q", f.read(8))[0], f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f"{archive_file} is not a complete block archive.")
+        f.seek(-(8 + len(MAGIC) + index_length), 2)
+        return json.loads(f.read(index_length))
+
+def read_blocks(archive_file: Path, index: Dict, block_numbers: List[int],
+                max_workers: Optional[int] = None) -> np.ndarray:
+    """
+    Decompress blocks of an archive (in parallel) and concatenate their records.
+    """
+    with open(archive_file, "rb") as f:
+        compressed = []
+        for block_number in block_numbers:
+            offset, size = index["blocks"][block_number][:2]
+            f.seek(offset)
+            compressed.append(f.read(size))
+    if len(compressed) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            blocks = list(executor.map(lambda data: decompress_block(data, index["codec"]), compressed))
+    else:
+        blocks = [decompress_block(data, index["codec"]) for data in compressed]
+    return np.frombuffer(b"".join(blocks), dtype=np.uint8)
+
+def load_archive_records(archive_file: Path, first_row: int = 0, stop_row: Optional[int] = None,
+                         max_workers: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Load a range of records of a block archive, decompressing only the blocks that overlap
+    it (the whole month by default). The result is the same as load_fixed_width_bytes on the
+    extracted file, restricted to the range.
+
+    Args:
+        archive_file (Path): The block archive.
+        first_row (int): The first record.
+        stop_row (Optional[int]): The record after the last one (the end of the month by default).
+        max_workers (Optional[int]): The threads decompressing the blocks.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The raw bytes, the start offset and the end
+        offset (exclusive, without line terminator) of each record.
+    """
+    index = read_index(archive_file)
+    stop_row = index["rows"] if stop_row is None else min(stop_row, index["rows"])
+    block_numbers = [i for i, (_, _, block_first, block_rows, _) in enumerate(index["blocks"])
+                     if block_first < stop_row and block_first + block_rows > first_row]
+    if not block_numbers:
+        return np.empty(0, dtype=np.uint8), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    buffer = read_blocks(archive_file, index, block_numbers, max_workers)
+    starts, ends = locate_records(buffer)
+    skip = first_row - index["blocks"][block_numbers[0]][2]
+    return buffer, starts[skip:skip + stop_row - first_row], ends[skip:skip + stop_row - first_row]
+
+def get_archive_file(source_file: Path, archive_dir: Path = CPS_DATA_BLOCKS_DIR) -> Path:
+    """
+    Get the archive of a raw month (cps_199401.gz -> blocks/cps_199401.blk).
+    """
+    return archive_dir / f"{source_file.name.split('.')[0]}{ARCHIVE_SUFFIX}"
+
+def archive_raw_files(source_dir: Path = CPS_DATA_GZ_DIR, archive_dir: Path = CPS_DATA_BLOCKS_DIR,
+                      remove_fixed_width: bool = False) -> None:
+    """
+    Build the missing or stale archives of the downloaded months, and optionally delete the
+    extracted fixed-width files whose archive is complete.
+    """
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    gz_files = [gz_file for gz_file in sorted(source_dir.glob("*.gz")) if is_sampled_month(get_month(gz_file))]
+    with ThreadPoolExecutor() as executor:
+        futures = {}
+        for gz_file in gz_files:
+            archive_file = get_archive_file(gz_file, archive_dir)
+            if is_complete(archive_file, [gz_file]):
+                print(f"Already archived {archive_file}")
+            else:
+                futures[executor.submit(build_archive, gz_file, archive_file)] = gz_file
+        for future in as_completed(futures):
+            try:
+                index = future.result()
+                print(f"Archived {futures[future].stem}: {index['rows']} records in {len(index['blocks'])} {index['codec']} blocks")
+            except Exception as e:
+                print(f"An error occurred while archiving {futures[future].stem}: {e}")
+
+    if remove_fixed_width:
+        for gz_file in gz_files:
+            fixed_width_file = CPS_DATA_FW_DIR / gz_file.stem
+            if fixed_width_file.exists() and is_complete(get_archive_file(gz_file, archive_dir), [gz_file]):
+                fixed_width_file.unlink()
+
+def benchmark_archive(archive_file: Path, num_rows: int = 1000) -> None:
+    """
+    Compare reading a whole month, reading it with one thread, and reading a row range.
+    """
+    index = read_index(archive_file)
+    size = archive_file.stat().st_size
+    print(f"{archive_file.stem}: {index['rows']} records, {index['raw_bytes'] / 1e6:.1f} MB raw, "
+          f"{size / 1e6:.1f} MB archived ({len(index['blocks'])} {index['codec']} blocks)")
+    for label, kwargs in [("whole month, parallel", {}), ("whole month, 1 thread", {"max_workers": 1}),
+                          (f"{num_rows} rows in the middle", {"first_row": index["rows"] // 2,
+                                                               "stop_row": index["rows"] // 2 + num_rows})]:
+        start = time.perf_counter()
+        _, starts, _ = load_archive_records(archive_file, **kwargs)
+        print(f"  {label}: {len(starts)} records in {time.perf_counter() - start:.3f} s")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Recompress the raw CPS months into block archives.")
+    parser.add_argument("--remove-fixedwidth", action="store_true", help="delete the extracted fixed-width files")
+    parser.add_argument("--benchmark", metavar="YYYYMM", help="time the reads of an archived month")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark_archive(CPS_DATA_BLOCKS_DIR / f"cps_{args.benchmark}{ARCHIVE_SUFFIX}")
+        return
+    archive_raw_files(remove_fixed_width=args.remove_fixedwidth)
+
+if __name__ == "__main__":
+    main()
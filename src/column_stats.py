@@ -0,0 +1,187 @@
+from pathlib import Path
+from typing import Dict, List, Optional
+import base64
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Number of minimum hash values kept per column (K-minimum-values distinct-count sketch)
+DISTINCT_SKETCH_SIZE = 64
+
+def get_stats_file(data_file: Path) -> Path:
+    """
+    Get the path of the sidecar statistics file of a data file (cps_199401.csv -> cps_199401.stats.json).
+    """
+    return data_file.with_name(f"{data_file.name.split('.')[0]}.stats.json")
+
+def get_csv_dtype(series: pd.Series) -> str:
+    """
+    Get the dtype that pandas infers when the column is read back from a CSV file.
+    """
+    if pd.api.types.is_bool_dtype(series):
+        return "bool"
+    if pd.api.types.is_integer_dtype(series):
+        return "float64" if series.isna().any() else "int64"
+    if pd.api.types.is_float_dtype(series) or series.isna().all():
+        return "float64"
+    return "object"
+
+def get_distinct_sketch(series: pd.Series) -> np.ndarray:
+    """
+    Get the K smallest distinct 64-bit hashes of the non-missing values of a column.
+    Numbers are hashed as float64, so that 5 and 5.0 share a hash across dtypes.
+    """
+    values = series.dropna()
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        values = values.to_numpy(dtype=np.float64)
+    else:
+        values = values.astype(str).to_numpy(dtype=object)
+    hashes = pd.util.hash_array(values)
+    if len(hashes) > 4 * DISTINCT_SKETCH_SIZE:
+        smallest = np.unique(np.partition(hashes, 4 * DISTINCT_SKETCH_SIZE)[:4 * DISTINCT_SKETCH_SIZE])
+        if len(smallest) >= DISTINCT_SKETCH_SIZE:
+            return smallest[:DISTINCT_SKETCH_SIZE]
+    return np.unique(hashes)[:DISTINCT_SKETCH_SIZE]
+
+def estimate_distinct_count(sketch: np.ndarray) -> int:
+    """
+    Estimate the number of distinct values from a K-minimum-values sketch (exact below K values).
+    """
+    if len(sketch) < DISTINCT_SKETCH_SIZE:
+        return len(sketch)
+    return int(round((DISTINCT_SKETCH_SIZE - 1) / (float(sketch[-1]) / 2**64)))
+
+def encode_sketch(sketch: np.ndarray) -> str:
+    """
+    Encode a sketch as base64 text (compact in the JSON sidecar).
+    """
+    return base64.b64encode(sketch.astype("<u8").tobytes()).decode("ascii")
+
+def decode_sketch(text: str) -> np.ndarray:
+    """
+    Decode a sketch encoded with encode_sketch.
+    """
+    return np.frombuffer(base64.b64decode(text), dtype="<u8")
+
+def merge_distinct_sketches(sketches: List[np.ndarray]) -> np.ndarray:
+    """
+    Merge the sketches of several months (e.g. to estimate the distinct values over the archive).
+    """
+    return np.unique(np.concatenate(sketches))[:DISTINCT_SKETCH_SIZE]
+
+def estimate_archive_distinct_counts(stats_list: List[Dict]) -> Dict[str, int]:
+    """
+    Estimate the number of distinct values of each column over several months, from the
+    merged sketches of their statistics.
+    """
+    sketches = {}
+    for stats in stats_list:
+        for col, col_stats in stats["columns"].items():
+            sketches.setdefault(col, []).append(decode_sketch(col_stats["sketch"]))
+    return {col: estimate_distinct_count(merge_distinct_sketches(col_sketches)) for col, col_sketches in sketches.items()}
+
+def to_python_scalar(value):
+    """
+    Convert a NumPy scalar to a JSON-serializable Python scalar.
+    """
+    if isinstance(value, (np.integer, np.floating)):
+        value = value.item()
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return value
+
+def compute_column_stats(data_df: pd.DataFrame, invalid_counts: Dict[str, int] = {}) -> Dict:
+    """
+    Compute the per-column statistics of a monthly DataFrame: CSV dtype, null count,
+    min/max, invalid-character count and a distinct-value sketch.
+
+    Parameters:
+        data_df (pd.DataFrame): The monthly data.
+        invalid_counts (Dict[str, int]): The number of invalid values per column found while decoding.
+
+    Returns:
+        Dict: The statistics, with "rows" and "columns" keys.
+    """
+    null_counts = data_df.isna().sum()
+    columns = {}
+    for col in data_df.columns:
+        series = data_df[col]
+        non_null = series.dropna()
+        if len(non_null) > 0 and (pd.api.types.is_numeric_dtype(series) or pd.api.types.is_string_dtype(series)):
+            if not pd.api.types.is_numeric_dtype(series):
+                non_null = non_null.astype(str)
+            low, high = to_python_scalar(non_null.min()), to_python_scalar(non_null.max())
+        else:
+            low, high = None, None
+        sketch = get_distinct_sketch(series)
+        columns[col] = {
+            "dtype": get_csv_dtype(series),
+            "nulls": int(null_counts[col]),
+            "min": low,
+            "max": high,
+            "invalid": int(invalid_counts.get(col, 0)),
+            "distinct": estimate_distinct_count(sketch),
+            "sketch": encode_sketch(sketch),
+        }
+    return {"rows": len(data_df), "columns": columns}
+
+def write_column_stats(data_file: Path, stats: Dict) -> None:
+    """
+    Write the statistics as a sidecar of a data file, tagged with the size and modification
+    time of the data file so that stale sidecars are detected.
+    """
+    stat = data_file.stat()
+    stats = {"source_bytes": stat.st_size, "source_mtime_ns": stat.st_mtime_ns, **stats}
+    stats_file = get_stats_file(data_file)
+    temp_file = stats_file.with_name(f"{stats_file.name}.{os.getpid()}.tmp") # two workers may write the same sidecar
+    temp_file.write_text(json.dumps(stats))
+    os.replace(temp_file, stats_file)
+
+def load_column_stats(data_file: Path) -> Optional[Dict]:
+    """
+    Load the sidecar statistics of a data file, or None if they are missing or stale.
+    """
+    stats_file = get_stats_file(data_file)
+    if not stats_file.exists() or not data_file.exists():
+        return None
+    stats = json.loads(stats_file.read_text())
+    stat = data_file.stat()
+    if stats["source_bytes"] != stat.st_size or stats["source_mtime_ns"] != stat.st_mtime_ns:
+        return None
+    return stats
+
+def get_str_columns(stats: Dict, allowed_str_vars: List[str]) -> List[str]:
+    """
+    Get the string columns that are not allowed, from the statistics.
+    """
+    return [col for col, col_stats in stats["columns"].items()
+            if col_stats["dtype"] == "object" and col not in allowed_str_vars]
+
+def validate_column_stats(stats: Dict, allowed_str_vars: List[str],
+                          min_columns: int = 300, min_rows: int = 100000) -> Dict[str, List[str]]:
+    """
+    Evaluate the validation rules of a monthly file against its statistics.
+
+    Parameters:
+        stats (Dict): The sidecar statistics.
+        allowed_str_vars (List[str]): The variables that may hold strings.
+        min_columns (int): The number of columns has to be above this threshold.
+        min_rows (int): The number of rows has to be above this threshold.
+
+    Returns:
+        Dict[str, List[str]]: The "errors" and "warnings" found.
+    """
+    errors, warnings = [], []
+    if len(stats["columns"]) <= min_columns:
+        errors.append(f"Number of columns is too low ({len(stats['columns'])})")
+    if stats["rows"] <= min_rows:
+        errors.append(f"Number of entries is too low ({stats['rows']})")
+    for col in get_str_columns(stats, allowed_str_vars):
+        col_stats = stats["columns"][col]
+        warnings.append(f"Unexpected string column {col} (~{col_stats['distinct']} distinct values, "
+                        f"from {col_stats['min']!r} to {col_stats['max']!r})")
+    for col, col_stats in stats["columns"].items():
+        if col_stats["invalid"] > 0:
+            warnings.append(f"{col_stats['invalid']} invalid values in {col}")
+    return {"errors": errors, "warnings": warnings}
@@ -1,4 +1,5 @@
 from pathlib import Path
+import os
 
 # Define the root directory of the project
 ROOT_DIR = Path(__file__).resolve().parent.parent
@@ -7,19 +8,44 @@ DATA_DIR = ROOT_DIR / "data"
 RAW_DIR = DATA_DIR / "raw"
 PROCESSED_DIR = DATA_DIR / "processed"
 OUTPUT_DIR = ROOT_DIR / "output"
+
+# Sampling mode for development runs (pipeline.py --sample-fraction/--months, or the environment
+# variables): prep_02 keeps a deterministic fraction of the households (hash of HRHHID), and only
+# the listed months are processed (e.g. "199401-199412,200001"). A sample run reads the shared
+# raw files and writes everything downstream of them to its own directory.
+CPS_SAMPLE_FRACTION = float(os.environ.get("CPS_SAMPLE_FRACTION", "1"))
+CPS_SAMPLE_MONTHS = os.environ.get("CPS_SAMPLE_MONTHS", "")
+if not 0 < CPS_SAMPLE_FRACTION <= 1:
+    raise ValueError(f"CPS_SAMPLE_FRACTION must be in (0, 1], got {CPS_SAMPLE_FRACTION}")
+IS_SAMPLE_RUN = CPS_SAMPLE_FRACTION < 1 or CPS_SAMPLE_MONTHS != ""
+SAMPLE_DIR = DATA_DIR / "samples" / f"fraction_{CPS_SAMPLE_FRACTION:g}_months_{CPS_SAMPLE_MONTHS.replace(',', '_') or 'all'}"
+if IS_SAMPLE_RUN:
+    PROCESSED_DIR = SAMPLE_DIR / "processed"
+    OUTPUT_DIR = SAMPLE_DIR / "output"
 PLOT_DIR = OUTPUT_DIR / "plot"
+ESTIMATE_DIR = OUTPUT_DIR / "estimate"
 
 # Define the directories for the CPS data
 RAW_CPS_DATA_DIR = RAW_DIR / "cps_data"
 CPS_DATA_GZ_DIR = RAW_CPS_DATA_DIR / "gz"
-CPS_DATA_FW_DIR = RAW_CPS_DATA_DIR / "fixedwidth"
-CPS_DATA_CSV_DIR = RAW_CPS_DATA_DIR / "csv"
+CPS_DATA_FW_DIR = RAW_CPS_DATA_DIR / "fixedwidth" # extracted files (replaced by the block archives, see block_archive.py)
+CPS_DATA_BLOCKS_DIR = RAW_CPS_DATA_DIR / "blocks"
+CPS_DATA_CSV_DIR = RAW_CPS_DATA_DIR / "csv" if not IS_SAMPLE_RUN else SAMPLE_DIR / "csv"
+CPS_DATA_HOUSEHOLD_DIR = RAW_CPS_DATA_DIR / "households" if not IS_SAMPLE_RUN else SAMPLE_DIR / "households" # one row per household (see household_tables.py)
 
 PROCESSED_CPS_DATA_DIR = PROCESSED_DIR / "cps_data"
 CPS_DATA_CLEANED_DIR = PROCESSED_CPS_DATA_DIR / "cleaned"
 CPS_DATA_CHILD_DIR = PROCESSED_CPS_DATA_DIR / "child"
 CPS_DATA_MERGED_DIR = PROCESSED_CPS_DATA_DIR / "merged"
 CPS_DATA_PSEUDO_DIR = PROCESSED_CPS_DATA_DIR / "pseudo_panel"
+CPS_DATA_AGE_COUNTS_DIR = PROCESSED_CPS_DATA_DIR / "age_counts"
+CPS_DATA_LINKS_DIR = PROCESSED_CPS_DATA_DIR / "links"
+CPS_DATA_STATA_DIR = PROCESSED_CPS_DATA_DIR / "stata"
+CPS_DATA_SPILL_DIR = PROCESSED_CPS_DATA_DIR / "spill" # temporary sorted runs of the external sort (see external_sort.py)
+CPS_DATA_QUEUE_DIR = PROCESSED_CPS_DATA_DIR / "queue" # leases and status records of the month workers (see month_queue.py)
+
+# Catalog of the monthly files of every stage (see month_catalog.py)
+CPS_DATA_CATALOG = DATA_DIR / "cps_month_catalog.json" if not IS_SAMPLE_RUN else SAMPLE_DIR / "cps_month_catalog.json"
 
 # Define the directories for the CPS dictionary
 RAW_CPS_DICT_DIR = RAW_DIR / "cps_dict"
@@ -27,6 +53,14 @@ CPS_DICT_TXT_DIR = RAW_CPS_DICT_DIR / "txt"
 CPS_DICT_CSV_DIR = RAW_CPS_DICT_DIR / "csv"
 CPS_DICT_DCT_DIR = RAW_CPS_DICT_DIR / "dct"
 
+# Download settings (the manifest records which months exist and how their download went)
+CPS_DATA_DOWNLOAD_MANIFEST = RAW_CPS_DATA_DIR / "download_manifest.json"
+DOWNLOAD_MAX_CONCURRENCY = 8 # concurrent downloads
+DOWNLOAD_REQUESTS_PER_SECOND = 4.0 # per host
+DOWNLOAD_MAX_RETRIES = 5
+DOWNLOAD_BACKOFF_SECONDS = 1.0 # doubled after each failed attempt
+DOWNLOAD_MISSING_RECHECK_DAYS = 7 # months answered with 404 are requested again after this many days
+
 # Define the URLs for the CPS data and dictionary
 CPS_DATA_URL_TEMPLATE = "https://www2.census.gov/programs-surveys/cps/datasets/{year_int4}/basic/{mon_str3}{year_int2}pub.dat.gz"
 CPS_DICT_URL_LIST = [
@@ -65,6 +99,7 @@ CPS_DICT_STARTTIME_LIST = [
 # Define the file paths for the CPS dictionary
 CPS_DICT_TXT_LIST = [CPS_DICT_TXT_DIR / f"cps_dict_{start_time}.txt" for start_time in CPS_DICT_STARTTIME_LIST]
 CPS_DICT_CSV_LIST = [CPS_DICT_CSV_DIR / f"cps_dict_{start_time}.csv" for start_time in CPS_DICT_STARTTIME_LIST]
+CPS_DICT_LAYOUTS = CPS_DICT_CSV_DIR / "cps_dict_layouts.json" # layout fingerprints and diffs of the epochs (dict_layouts.py)
 CPS_DICT_DCT_LIST = [CPS_DICT_DCT_DIR / f"cps_dict_{start_time}.dct" for start_time in CPS_DICT_STARTTIME_LIST]
 
 # Define the file paths for the parsed CPS data
@@ -76,5 +111,26 @@ MANUAL_CLEAN_CPS_DICT_CSV_LIST = [
 ]
 
 # File paths for the data files
-CPS_DATA_MERGED_CSV = CPS_DATA_MERGED_DIR / "cps_data_merged.csv"
-CPS_DATA_PSEUDO_CSV = CPS_DATA_PSEUDO_DIR / "cps_data_pseudo_panel.csv"
\ No newline at end of file
+CPS_DATA_MERGED_DATASET = CPS_DATA_MERGED_DIR / "cps_data_merged" # Parquet dataset, one partition per DATA_YEAR
+CPS_DATA_PSEUDO_CSV = CPS_DATA_PSEUDO_DIR / "cps_data_pseudo_panel.csv"
+CPS_DATA_COHORT_STATUS = CPS_DATA_PSEUDO_DIR / "cohort_status.parquet" # matching status of the cohorts, for the update mode
+CPS_DATA_PERSON_LINKS = CPS_DATA_LINKS_DIR / "cps_person_links.parquet" # persons linked across the months of their rotation
+FAMILY_CHUNK_ROWS = None # rows per household-aligned chunk in prep_04 (None loads whole months)
+MERGE_MAX_WORKERS = 4 # processes loading the monthly files in prep_05
+MERGE_BATCH_MONTHS = 24 # months loaded and written per batch in prep_05 (the checkpoint unit)
+MERGED_ROW_GROUP_SIZE = 50000 # rows per Parquet row group (the unit skipped by the min/max statistics)
+ARCHIVE_BLOCK_BYTES = 4 * 2**20 # uncompressed bytes per block of the raw archives (rounded to a record boundary)
+STATA_CHUNK_ROWS = 100000 # rows read and written per chunk by the Stata export
+EXTERNAL_SORT_RUN_ROWS = 2000000 # rows sorted in memory per run by the external sort of the merged dataset
+EXTERNAL_SORT_MERGE_ROWS = 65536 # rows read per run and batch when the sorted runs are merged
+PSEUDO_PANEL_BY_COHORT = False # build the pseudo panel from the externally sorted merged dataset, cohort batch by batch (bounded memory)
+QUEUE_LEASE_SECONDS = 600 # a month whose worker has not renewed its lease for this long is claimed again
+QUEUE_MAX_ATTEMPTS = 3 # claims of a month (failures and expired leases) before it is left as failed
+
+# Result cache of the derived variables of prep_04 (see derived_cache.py)
+DERIVED_CACHE_DIR = PROCESSED_DIR / "cache" / "derived"
+DERIVED_CACHE_MAX_BYTES = 20 * 2**30 # least recently used results are evicted above this size (0 disables the cache)
+
+# Event-study bootstrap (see event_study.py)
+BOOTSTRAP_REPLICATES = 1000
+BOOTSTRAP_SEED = 0
@@ -0,0 +1,210 @@
+from functools import lru_cache, wraps
+from pathlib import Path
+from types import CodeType, FunctionType, ModuleType
+from typing import Callable, Dict, List
+import hashlib
+import inspect
+import json
+import os
+import sys
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from config import DERIVED_CACHE_DIR, DERIVED_CACHE_MAX_BYTES
+
+# The key of the data a step receives travels in DataFrame.attrs: load_data sets the key of
+# the month (its checksum), and every cached step sets the key of its output, so that a step
+# is keyed by the whole chain of steps before it (month, code versions and parameters).
+CACHE_KEY = "cache_key"
+INDEX_COLUMN = "__index__"
+PROJECT_DIR = Path(__file__).resolve().parent
+
+# Hits and misses of the current process, by step
+CACHE_STATS: Dict[str, Dict[str, int]] = {}
+
+def get_referenced_code(code: CodeType) -> List[str]:
+    """
+    List the global names referenced by a code object, including its nested functions and lambdas.
+    """
+    names = list(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names += get_referenced_code(const)
+    return names
+
+def is_project_object(value) -> bool:
+    """
+    Check whether a function or a module is defined in a module of this project (src/).
+    """
+    module = value if isinstance(value, ModuleType) else sys.modules.get(getattr(value, "__module__", None) or "")
+    file = getattr(module, "__file__", None)
+    return file is not None and Path(file).resolve().parent == PROJECT_DIR
+
+@lru_cache(maxsize=None)
+def get_source_fingerprint(func: FunctionType) -> Dict:
+    """
+    Get the source of a function and of the project functions it calls (recursively, from
+    any module of src/), the sources of the project modules it references, and the other
+    global names it references.
+
+    Args:
+        func (FunctionType): The undecorated function.
+
+    Returns:
+        Dict: The sources by qualified name, and the referenced (module, name) pairs.
+    """
+    sources, names, pending = {}, set(), [func]
+    while pending:
+        current = inspect.unwrap(pending.pop())
+        qualname = f"{current.__module__}.{current.__qualname__}"
+        if qualname in sources:
+            continue
+        sources[qualname] = inspect.getsource(current)
+        for name in get_referenced_code(current.__code__):
+            value = current.__globals__.get(name)
+            if isinstance(value, FunctionType) and is_project_object(value):
+                pending.append(value)
+            elif isinstance(value, ModuleType) and is_project_object(value):
+                sources[value.__name__] = inspect.getsource(value)
+            elif value is not None:
+                names.add((current.__module__, name))
+    return {"sources": sources, "names": sorted(names)}
+
+def get_code_version(func: FunctionType) -> str:
+    """
+    Hash the code of a step: its source, the sources of the project functions it calls, and
+    the current values of the constants they reference (e.g. the AGE variable, set per month).
+    """
+    fingerprint = get_source_fingerprint(func)
+    constants = {}
+    for module_name, name in fingerprint["names"]:
+        value = vars(sys.modules[module_name]).get(name)
+        if isinstance(value, (str, int, float, tuple, list)):
+            constants[f"{module_name}.{name}"] = value
+    return hashlib.sha256(repr((fingerprint["sources"], constants)).encode()).hexdigest()
+
+def get_cache_file(key: str, cache_dir: Path = DERIVED_CACHE_DIR) -> Path:
+    return cache_dir / key[:2] / f"{key}.parquet"
+
+def save_result(output_df: pd.DataFrame, changed_columns: List[str], same_rows: bool, cache_file: Path) -> None:
+    """
+    Save the output of a step: its index, and only the columns it adds or changes (the
+    other columns are taken from the input on a hit). The output column order is saved
+    in the file metadata.
+    """
+    result_df = output_df[changed_columns].reset_index(drop=True)
+    result_df.insert(0, INDEX_COLUMN, output_df.index.to_numpy())
+    table = pa.Table.from_pandas(result_df, preserve_index=False)
+    metadata = {**table.schema.metadata, b"columns": json.dumps(list(output_df.columns)).encode(),
+                b"same_rows": json.dumps(same_rows).encode()}
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp") # concurrent workers may save the same result
+    pq.write_table(table.replace_schema_metadata(metadata), temp_file)
+    os.replace(temp_file, cache_file)
+
+def load_result(input_df: pd.DataFrame, cache_file: Path) -> pd.DataFrame:
+    """
+    Rebuild the output of a step from its saved columns and the input. Like the steps, a
+    result with the rows of the input is assigned to the input in place.
+    """
+    table = pq.read_table(cache_file)
+    metadata = table.schema.metadata
+    result_df = table.to_pandas()
+    if json.loads(metadata[b"same_rows"]):
+        output_df = input_df
+    else:
+        output_df = input_df.loc[result_df[INDEX_COLUMN].to_numpy()]
+    result_df.index = output_df.index
+    for col in result_df.columns.drop(INDEX_COLUMN):
+        output_df[col] = result_df[col]
+    columns = json.loads(metadata[b"columns"])
+    if list(output_df.columns) != columns:
+        output_df = output_df[columns]
+    return output_df
+
+def evict_results(cache_dir: Path = DERIVED_CACHE_DIR, max_bytes: int = DERIVED_CACHE_MAX_BYTES) -> None:
+    """
+    Delete the least recently used results (by modification time, which is refreshed on
+    every hit) until the cache fits in max_bytes.
+    """
+    files = []
+    for file in cache_dir.glob("*/*.parquet"):
+        try:
+            files.append((file.stat(), file))
+        except FileNotFoundError: # evicted by another process
+            continue
+    total_bytes = sum(stat.st_size for stat, _ in files)
+    for stat, file in sorted(files, key=lambda item: item[0].st_mtime_ns):
+        if total_bytes <= max_bytes:
+            break
+        file.unlink(missing_ok=True)
+        total_bytes -= stat.st_size
+
+def report_cache_stats() -> None:
+    """
+    Print the cache hits and misses of the current process, by step.
+    """
+    for step, stats in CACHE_STATS.items():
+        print(f"Cache {step}: {stats['hits']} hits, {stats['misses']} misses")
+
+def cached_step(outputs: List[str]) -> Callable:
+    """
+    Memoize a variable-adding step on disk. The result is keyed by the key of the input
+    data, the code version of the step and its other arguments, so that a month is only
+    recomputed by the steps whose code or parameters changed (and the steps after them).
+    Inputs without a key (e.g. data not loaded with load_data) are not cached.
+
+    A result holds the declared output columns and the columns that are not in the input;
+    the other columns are taken from the input on a hit, so every existing column that the
+    step (or a function it calls) overwrites has to be declared.
+
+    Args:
+        outputs (List[str]): The columns the step assigns.
+
+    Returns:
+        Callable: The decorator of a step taking the data first and returning the data with
+        the new variables.
+    """
+    outputs = list(outputs)
+
+    def decorator(func: Callable) -> Callable:
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(data_df: pd.DataFrame, *args, **kwargs) -> pd.DataFrame:
+            input_key = data_df.attrs.get(CACHE_KEY)
+            if input_key is None or DERIVED_CACHE_MAX_BYTES <= 0:
+                return func(data_df, *args, **kwargs)
+
+            arguments = signature.bind(data_df, *args, **kwargs)
+            arguments.apply_defaults()
+            params = {name: value for name, value in arguments.arguments.items() if value is not data_df}
+            key = hashlib.sha256(repr((input_key, func.__qualname__, get_code_version(func), params, outputs)).encode()).hexdigest()
+            cache_file = get_cache_file(key)
+            stats = CACHE_STATS.setdefault(func.__qualname__, {"hits": 0, "misses": 0})
+
+            output_df = None
+            if cache_file.exists():
+                try:
+                    output_df = load_result(data_df, cache_file)
+                except FileNotFoundError: # evicted by another process since the check
+                    output_df = None
+            if output_df is not None:
+                try:
+                    os.utime(cache_file) # mark as recently used
+                except FileNotFoundError:
+                    pass
+                stats["hits"] += 1
+            else:
+                input_columns, input_index = data_df.columns, data_df.index
+                output_df = func(data_df, *args, **kwargs)
+                same_rows = output_df.index.equals(input_index)
+                changed_columns = [col for col in output_df.columns if col not in input_columns or col in outputs]
+                save_result(output_df, changed_columns, same_rows, cache_file)
+                stats["misses"] += 1
+            output_df.attrs[CACHE_KEY] = key
+            return output_df
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,134 @@
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Tuple
+import hashlib
+import json
+import os
+import pandas as pd
+from config import CPS_DICT_CSV_LIST, CPS_DICT_LAYOUTS
+
+# A record layout is the sorted list of (var_name, start_pos, end_pos) of the decoded columns.
+# Epochs with the same fingerprint share one layout (and one set of colspecs for the decoder).
+FILLER_VARS = ["FILLER", "FILLER.2"]
+
+Colspecs = List[Tuple[str, int, int]]
+
+def read_colspecs(dict_csv_file: Path) -> Colspecs:
+    """
+    Read the (var_name, start_pos, end_pos) of the columns of a dictionary CSV file, sorted
+    by position (FILLER columns are not decoded).
+
+    Parameters:
+        dict_csv_file (Path): The path to the dictionary CSV file.
+
+    Returns:
+        Colspecs: The column specifications.
+    """
+    dict_df = pd.read_csv(dict_csv_file, usecols=["var_name", "start_pos", "end_pos"])
+    dict_df = dict_df.sort_values("start_pos", kind="stable")
+    dict_df = dict_df[~dict_df["var_name"].isin(FILLER_VARS)]
+    return [(name, int(start), int(end)) for name, start, end in dict_df.itertuples(index=False, name=None)]
+
+def get_layout_fingerprint(colspecs: Colspecs) -> str:
+    """
+    Hash the (var_name, start_pos, end_pos) tuples of a layout.
+    """
+    return hashlib.sha256(json.dumps(colspecs).encode()).hexdigest()[:16]
+
+@lru_cache(maxsize=None)
+def _load_layout(dict_csv_file: Path, mtime_ns: int) -> Tuple[str, Tuple[Tuple[str, int, int], ...]]:
+    colspecs = read_colspecs(dict_csv_file)
+    return get_layout_fingerprint(colspecs), tuple(colspecs)
+
+def get_layout(dict_csv_file: Path) -> Tuple[str, Colspecs]:
+    """
+    Get the fingerprint and the column specifications of a dictionary, read once per process
+    (and again only if the file changes), so that the months of an epoch share them.
+    """
+    fingerprint, colspecs = _load_layout(dict_csv_file, dict_csv_file.stat().st_mtime_ns)
+    return fingerprint, list(colspecs)
+
+def diff_layouts(old_colspecs: Colspecs, new_colspecs: Colspecs) -> Dict[str, List]:
+    """
+    Compare two layouts column by column.
+
+    Parameters:
+        old_colspecs (Colspecs): The layout of the earlier epoch.
+        new_colspecs (Colspecs): The layout of the later epoch.
+
+    Returns:
+        Dict[str, List]: The added and removed columns, and the moved columns (same name,
+        other positions) with their old and new positions.
+    """
+    old_positions = {name: (start, end) for name, start, end in old_colspecs}
+    new_positions = {name: (start, end) for name, start, end in new_colspecs}
+    return {
+        "added": [name for name in new_positions if name not in old_positions],
+        "removed": [name for name in old_positions if name not in new_positions],
+        "moved": [[name, list(old_positions[name]), list(new_positions[name])] for name in new_positions
+                  if name in old_positions and old_positions[name] != new_positions[name]],
+    }
+
+def get_changed_columns(diff: Dict[str, List]) -> List[str]:
+    """
+    Get the columns that changed between two epochs (the only ones a harmonization step has to touch).
+    """
+    return diff["added"] + diff["removed"] + [name for name, _, _ in diff["moved"]]
+
+def build_layout_registry(dict_csv_files: List[Path] = CPS_DICT_CSV_LIST) -> Dict:
+    """
+    Fingerprint the layout of every dictionary epoch, collapse the identical layouts, and
+    diff the layouts of adjacent epochs.
+
+    Parameters:
+        dict_csv_files (List[Path]): The dictionary CSV files ("cps_dict_YYYYMM.csv").
+
+    Returns:
+        Dict: The fingerprint of each epoch, the epochs of each distinct layout, and the
+        diff of each pair of adjacent epochs.
+    """
+    epochs, layouts = {}, {}
+    for dict_csv_file in sorted(dict_csv_files, key=lambda file: file.stem.split("_")[-1]):
+        fingerprint, colspecs = get_layout(dict_csv_file)
+        epoch = dict_csv_file.stem.split("_")[-1]
+        epochs[epoch] = fingerprint
+        layouts.setdefault(fingerprint, {"epochs": [], "colspecs": colspecs})["epochs"].append(epoch)
+
+    diffs = []
+    epoch_list = list(epochs)
+    for old_epoch, new_epoch in zip(epoch_list[:-1], epoch_list[1:]):
+        old_fingerprint, new_fingerprint = epochs[old_epoch], epochs[new_epoch]
+        diff = diff_layouts(layouts[old_fingerprint]["colspecs"], layouts[new_fingerprint]["colspecs"])
+        diffs.append({"from": old_epoch, "to": new_epoch, "same_layout": old_fingerprint == new_fingerprint, **diff})
+    return {"epochs": epochs, "layouts": layouts, "diffs": diffs}
+
+def write_layout_registry(registry: Dict, registry_file: Path = CPS_DICT_LAYOUTS) -> None:
+    """
+    Save the layout registry as JSON (written to a temporary file, then renamed).
+    """
+    registry_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = registry_file.with_name(registry_file.name + ".tmp")
+    with open(temp_file, "w") as f:
+        json.dump(registry, f, indent=1)
+    os.replace(temp_file, registry_file)
+
+def print_layout_summary(registry: Dict) -> None:
+    """
+    Print the distinct layouts and the columns that change between adjacent epochs.
+    """
+    print(f"{len(registry['epochs'])} dictionary epochs, {len(registry['layouts'])} distinct layouts:")
+    for fingerprint, layout in registry["layouts"].items():
+        print(f"  {fingerprint}: {len(layout['colspecs'])} columns, epochs {', '.join(layout['epochs'])}")
+    for diff in registry["diffs"]:
+        if diff["same_layout"]:
+            continue
+        print(f"  {diff['from']} -> {diff['to']}: {len(diff['added'])} added, {len(diff['removed'])} removed, "
+              f"{len(diff['moved'])} moved")
+
+def main() -> None:
+    registry = build_layout_registry()
+    write_layout_registry(registry)
+    print_layout_summary(registry)
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 from pathlib import Path
-from typing import List
-import shutil
-import gzip
+from typing import List, Dict
 import requests
 import concurrent.futures
-from config import (CPS_DATA_URL_TEMPLATE, RAW_CPS_DATA_DIR, 
-                    CPS_DICT_URL_LIST, CPS_DICT_TXT_DIR, CPS_DICT_STARTTIME_LIST)
+from config import (CPS_DATA_URL_TEMPLATE, CPS_DATA_GZ_DIR, CPS_DATA_BLOCKS_DIR,
+                    CPS_DICT_URL_LIST, CPS_DICT_TXT_DIR, CPS_DICT_STARTTIME_LIST,
+                    CPS_DATA_DOWNLOAD_MANIFEST, DOWNLOAD_MAX_CONCURRENCY, DOWNLOAD_REQUESTS_PER_SECOND,
+                    DOWNLOAD_MAX_RETRIES, DOWNLOAD_BACKOFF_SECONDS, DOWNLOAD_MISSING_RECHECK_DAYS)
+from block_archive import archive_raw_files
+from fetch_engine import download_files
+from month_catalog import is_sampled_month
 
 # Download the CPS dictionary files
 def download_file(url: str, file_path: Path) -> None:
@@ -66,55 +69,57 @@ def rename_cps_dict_files(dict_dir: Path, dict_file_list: List[Path], dict_start
             dict_file.unlink()
 
 # Download the CPS data files
-def download_cps_data(years: List[int], months: List[str], data_dir: Path):
-    data_dir.mkdir(parents=True, exist_ok=True)
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for year in years:
-            for month in months:
-                url = CPS_DATA_URL_TEMPLATE.format(year_int4=year, mon_str3=month, year_int2=str(year)[2:])
-                month_num = str(months.index(month) + 1).zfill(2)
-                data_file = data_dir / f"cps_{year}{month_num}.gz"
-                if data_file.exists():
-                    print(f"Already downloaded {data_file}")
-                else:
-                    print(f"Downloading {data_file}")
-                    futures.append(executor.submit(download_file, url, data_file))
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                future.result()
-            except Exception as e:
-                print(f"An error occurred: {e}")
+MONTH_ABBREVIATIONS = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
 
-def extract_file(gz_file: Path, output_file: Path) -> None:
+def download_cps_months(month_keys: List[str], data_dir: Path,
+                        url_template: str = CPS_DATA_URL_TEMPLATE,
+                        manifest_file: Path = CPS_DATA_DOWNLOAD_MANIFEST) -> Dict[str, Dict]:
     """
-    Extracts the contents of a gzip-compressed file.
+    Download the CPS data files of some months concurrently, and record which months exist in
+    the download manifest (months answered with 404 are not requested again for a while).
 
     Args:
-        gz_file (Path): The path to the gzip file to be extracted.
-        output_file (Path): The path where the extracted contents will be saved.
+        month_keys (List[str]): The months to download, "YYYYMM".
+        data_dir (Path): The directory to save the gz files.
+        url_template (str): The URL template of the data files (can point to a mock server).
+        manifest_file (Path): The path to the download status manifest.
+
+    Returns:
+        Dict[str, Dict]: The download status of each month ("YYYYMM").
     """
-    with gzip.open(gz_file, "rb") as f_in:
-        output_file.parent.mkdir(parents=True, exist_ok=True)
-        with open(output_file, "wb") as f_out:
-            f_out.write(f_in.read())
+    data_dir.mkdir(parents=True, exist_ok=True)
+    jobs = {}
+    for month_key in month_keys:
+        year, month = month_key[:4], MONTH_ABBREVIATIONS[int(month_key[4:]) - 1]
+        url = url_template.format(year_int4=year, mon_str3=month, year_int2=year[2:])
+        jobs[month_key] = (url, data_dir / f"cps_{month_key}.gz")
 
-def extract_gz_files(input_dir: Path, output_dir: Path) -> None:
-    output_dir.mkdir(parents=True, exist_ok=True)
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for gz_file in input_dir.glob("*.gz"):
-            data_file = output_dir / gz_file.stem
-            if data_file.exists():
-                print(f"Already extracted {data_file}")
-            else:
-                print(f"Extracting {data_file}")
-                futures.append(executor.submit(extract_file, gz_file, data_file))
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                future.result()
-            except Exception as e:
-                print(f"An error occurred: {e}")
+    return download_files(jobs, manifest_file,
+                          max_concurrency=DOWNLOAD_MAX_CONCURRENCY,
+                          requests_per_second=DOWNLOAD_REQUESTS_PER_SECOND,
+                          max_retries=DOWNLOAD_MAX_RETRIES,
+                          backoff_seconds=DOWNLOAD_BACKOFF_SECONDS,
+                          missing_recheck_days=DOWNLOAD_MISSING_RECHECK_DAYS)
+
+def download_cps_data(years: List[int], months: List[str], data_dir: Path,
+                      url_template: str = CPS_DATA_URL_TEMPLATE,
+                      manifest_file: Path = CPS_DATA_DOWNLOAD_MANIFEST) -> Dict[str, Dict]:
+    """
+    Download the monthly CPS data files of some years concurrently (see download_cps_months).
+
+    Args:
+        years (List[int]): The years to download.
+        months (List[str]): The 3-letter month abbreviations.
+        data_dir (Path): The directory to save the gz files.
+        url_template (str): The URL template of the data files (can point to a mock server).
+        manifest_file (Path): The path to the download status manifest.
+
+    Returns:
+        Dict[str, Dict]: The download status of each month ("YYYYMM").
+    """
+    month_keys = [f"{year}{MONTH_ABBREVIATIONS.index(month) + 1:02d}" for year in years for month in months]
+    month_keys = [month_key for month_key in month_keys if is_sampled_month(month_key)]
+    return download_cps_months(month_keys, data_dir, url_template, manifest_file)
 
 # Main function
 def main() -> None:
@@ -125,9 +130,8 @@ def main() -> None:
     
     # Download the CPS data files
     years = range(1994, 2024+1)
-    months = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
-    download_cps_data(years, months, RAW_CPS_DATA_DIR / "gz")
-    extract_gz_files(RAW_CPS_DATA_DIR / "gz", RAW_CPS_DATA_DIR / "fixedwidth")
+    download_cps_data(years, MONTH_ABBREVIATIONS, CPS_DATA_GZ_DIR)
+    archive_raw_files(CPS_DATA_GZ_DIR, CPS_DATA_BLOCKS_DIR)
 
 if __name__ == "__main__":
     main()
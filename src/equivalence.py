@@ -0,0 +1,294 @@
+from io import BytesIO
+from typing import Callable, Dict, List, Optional, Tuple
+import argparse
+import sys
+import time
+import numpy as np
+import pandas as pd
+from block_archive import load_archive_records
+from config import CPS_DICT_CSV_LIST
+from dict_layouts import Colspecs, FILLER_VARS, get_layout
+from fixed_width_kernel import locate_records, decode_fixed_width_columns
+from month_catalog import load_catalog, get_month_files, get_month, get_dict_epoch
+import prep_04_construct_family_related_variables as family
+from variable_typing import *
+
+# Differential testing of the accelerated code paths against the code they replace. A case
+# runs a legacy function and a candidate on the same month of every dictionary epoch (a real
+# archived month, or a synthetic month generated from the record layout) and diffs the outputs
+# column by column. Integer columns must match exactly whatever their dtype (int64, float64
+# with NaN, nullable Int), float columns within FLOAT_RTOL, and string columns exactly.
+FLOAT_RTOL = 1e-9
+SYNTHETIC_ROWS = 20000
+SYNTHETIC_SEED = 0
+
+# Name -> (legacy, candidate, prepare): prepare builds the arguments of both functions from
+# the raw records and the layout of a month, and both functions return a DataFrame
+CASES: Dict[str, Tuple[Callable, Callable, Callable]] = {}
+
+def register_case(name: str, legacy: Callable, candidate: Callable, prepare: Callable) -> None:
+    """
+    Register a legacy function and its replacement.
+
+    Args:
+        name (str): The case name.
+        legacy (Callable): The reference implementation.
+        candidate (Callable): The implementation under test.
+        prepare (Callable): Builds the arguments from (raw bytes, colspecs), called once per
+            run so that functions that modify their input get a fresh copy.
+    """
+    CASES[name] = (legacy, candidate, prepare)
+
+# Synthetic months
+def make_synthetic_records(colspecs: Colspecs, num_rows: int = SYNTHETIC_ROWS, seed: int = SYNTHETIC_SEED) -> bytes:
+    """
+    Generate fixed-width records for a layout: households of 1 to 6 persons (reference person,
+    spouse, children and others) with plausible demographic codes, random digits elsewhere,
+    and blanks and negative codes ("-1") as in the real files.
+
+    Args:
+        colspecs (Colspecs): The layout.
+        num_rows (int): The number of records.
+        seed (int): The random seed.
+
+    Returns:
+        bytes: The records, one per line.
+    """
+    rng = np.random.default_rng(seed)
+    household_sizes = rng.integers(1, 7, size=num_rows)
+    household_numbers = np.repeat(np.arange(num_rows), household_sizes)[:num_rows]
+    position = np.arange(num_rows) - np.searchsorted(household_numbers, household_numbers)
+    relationship = np.select([position == 0, position == 1, position <= 4], [1, 2, 3], default=rng.integers(4, 6, size=num_rows))
+    age = np.where(relationship == 3, rng.integers(0, 30, size=num_rows), rng.integers(16, 90, size=num_rows))
+    special = {
+        HOUSEHOLD_ID: 10**13 + household_numbers * 7919,
+        RELATIONSHIP: relationship,
+        AGE: age,
+        "PRTAGE": age,
+        MARRITAL_STATUS: rng.integers(1, 7, size=num_rows),
+        GENDER: rng.integers(1, 3, size=num_rows),
+        RACE: rng.integers(1, 5, size=num_rows),
+        EDUCATION: rng.integers(31, 47, size=num_rows),
+        STATE: rng.integers(11, 96, size=num_rows),
+    }
+
+    record_length = max(end for _, _, end in colspecs)
+    records = np.full((num_rows, record_length + 1), ord(" "), dtype=np.uint8)
+    records[:, -1] = ord("\n")
+    for name, start, end in colspecs:
+        width = end - start + 1
+        if name in STR_VARS:
+            letters = rng.integers(ord("A"), ord("Z") + 1, size=(num_rows, width), dtype=np.uint8)
+            records[:, start - 1:end] = letters
+            continue
+        if name in special:
+            values = special[name]
+        else:
+            values = rng.integers(0, 10 ** min(width, 18), size=num_rows, dtype=np.int64)
+            values = np.where(rng.random(num_rows) < 0.05, -1, values) if width >= 2 else values
+        text = pd.Series(values).astype(str).str.rjust(width).str[-width:]
+        text = text.mask(rng.random(num_rows) < 0.02 if name not in special else np.zeros(num_rows, dtype=bool), " " * width)
+        records[:, start - 1:end] = np.frombuffer("".join(text).encode("ascii"), dtype=np.uint8).reshape(num_rows, width)
+    return records.tobytes()
+
+def load_real_records(epoch: str, num_rows: Optional[int]) -> Optional[Tuple[str, bytes]]:
+    """
+    Load the first records of the first archived month of an epoch (None if there is none).
+    """
+    for archive_file in get_month_files(load_catalog(), "blocks"):
+        month = get_month(archive_file)
+        if month >= epoch and get_dict_epoch(month) == epoch:
+            buffer, starts, ends = load_archive_records(archive_file, 0, num_rows)
+            return month, buffer[:ends[-1] + 1].tobytes() if len(ends) else b""
+    return None
+
+# Comparison
+def is_integer_like(series: pd.Series) -> bool:
+    if pd.api.types.is_integer_dtype(series) or pd.api.types.is_bool_dtype(series):
+        return True
+    if pd.api.types.is_float_dtype(series):
+        values = series.dropna().to_numpy()
+        return bool(np.all(values == np.round(values)))
+    return False
+
+def diff_frames(expected: pd.DataFrame, actual: pd.DataFrame, float_rtol: float = FLOAT_RTOL) -> List[Dict]:
+    """
+    Diff two DataFrames column by column, with dtype-aware tolerance.
+
+    Args:
+        expected (pd.DataFrame): The output of the legacy function.
+        actual (pd.DataFrame): The output of the candidate.
+        float_rtol (float): The relative tolerance of the non-integer float columns.
+
+    Returns:
+        List[Dict]: The mismatches (column, kind, count, example), empty if the outputs are equivalent.
+    """
+    mismatches = []
+    for col in expected.columns.difference(actual.columns, sort=False):
+        mismatches.append({"column": col, "kind": "missing column", "count": len(expected), "example": None})
+    for col in actual.columns.difference(expected.columns, sort=False):
+        mismatches.append({"column": col, "kind": "extra column", "count": len(actual), "example": None})
+    if len(expected) != len(actual):
+        return mismatches + [{"column": None, "kind": "rows", "count": abs(len(expected) - len(actual)),
+                              "example": f"{len(expected)} != {len(actual)}"}]
+    if not expected.index.equals(actual.index):
+        mismatches.append({"column": None, "kind": "index", "count": int((expected.index != actual.index).sum()), "example": None})
+
+    for col in expected.columns.intersection(actual.columns, sort=False):
+        left, right = expected[col], actual[col]
+        left_numeric, right_numeric = pd.api.types.is_numeric_dtype(left), pd.api.types.is_numeric_dtype(right)
+        if left_numeric != right_numeric:
+            mismatches.append({"column": col, "kind": "dtype", "count": len(left), "example": f"{left.dtype} != {right.dtype}"})
+            continue
+        left_missing, right_missing = left.isna().to_numpy(), right.isna().to_numpy()
+        if left_numeric:
+            left_values = left.to_numpy(dtype=np.float64, na_value=np.nan)
+            right_values = right.to_numpy(dtype=np.float64, na_value=np.nan)
+            rtol = 0 if is_integer_like(left) and is_integer_like(right) else float_rtol
+            same = np.isclose(left_values, right_values, rtol=rtol, atol=0) | (left_missing & right_missing)
+        else:
+            same = (left.astype(object).to_numpy() == right.astype(object).to_numpy()) | (left_missing & right_missing)
+        if not same.all():
+            i = int(np.flatnonzero(~same)[0])
+            mismatches.append({"column": col, "kind": "values", "count": int((~same).sum()),
+                               "example": f"row {i}: {left.iloc[i]!r} != {right.iloc[i]!r}"})
+    return mismatches
+
+def time_call(func: Callable, prepare: Callable, repeat: int) -> Tuple[pd.DataFrame, float]:
+    """
+    Run a function on freshly prepared arguments, and keep the best of several timings.
+    """
+    best, output = float("inf"), None
+    for _ in range(repeat):
+        args = prepare()
+        start = time.perf_counter()
+        output = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return output, best
+
+def run_case(name: str, raw: bytes, colspecs: Colspecs, repeat: int = 1) -> Dict:
+    """
+    Run a case on a month, and diff and time the legacy function and the candidate.
+    """
+    legacy, candidate, prepare = CASES[name]
+    expected, legacy_time = time_call(legacy, lambda: prepare(raw, colspecs), repeat)
+    actual, candidate_time = time_call(candidate, lambda: prepare(raw, colspecs), repeat)
+    return {"case": name, "rows": len(expected), "mismatches": diff_frames(expected, actual),
+            "legacy_s": legacy_time, "candidate_s": candidate_time,
+            "speedup": legacy_time / candidate_time if candidate_time > 0 else float("inf")}
+
+def run_harness(case_names: List[str], synthetic: bool = False, num_rows: Optional[int] = SYNTHETIC_ROWS,
+                repeat: int = 1) -> pd.DataFrame:
+    """
+    Run cases on one month per dictionary epoch: the first archived month of the epoch (the
+    first num_rows records), or a synthetic month if synthetic is set or none is archived.
+
+    Args:
+        case_names (List[str]): The registered cases to run.
+        synthetic (bool): Use synthetic months only.
+        num_rows (Optional[int]): The number of records per month (None for whole real months).
+        repeat (int): The timings keep the best of repeat runs.
+
+    Returns:
+        pd.DataFrame: One row per case and epoch (month, rows, mismatches, timings and speedup).
+    """
+    results = []
+    for dict_csv_file in sorted(CPS_DICT_CSV_LIST):
+        if not dict_csv_file.exists():
+            continue
+        epoch = dict_csv_file.stem.split("_")[-1]
+        _, colspecs = get_layout(dict_csv_file)
+        real = None if synthetic else load_real_records(epoch, num_rows)
+        month, raw = real if real is not None else ("synthetic", make_synthetic_records(colspecs, num_rows or SYNTHETIC_ROWS))
+        for name in case_names:
+            result = run_case(name, raw, colspecs, repeat)
+            result.update({"epoch": epoch, "month": month})
+            results.append(result)
+            for mismatch in result["mismatches"]:
+                print(f"  {name} {epoch} ({month}): {mismatch}")
+    return pd.DataFrame(results, columns=["case", "epoch", "month", "rows", "mismatches", "legacy_s", "candidate_s", "speedup"])
+
+# Registered cases
+def decode_with_read_fwf(raw: bytes, colspecs: Colspecs) -> pd.DataFrame:
+    """
+    Legacy decoder of prep_02: pd.read_fwf with the dictionary colspecs (FILLER columns dropped).
+    Only blank fields are read as missing: the legacy decoder also read the string "NA" (e.g.
+    an HRSERSUF suffix) as missing, which the kernel deliberately keeps (user-027).
+    """
+    names = [name for name, _, _ in colspecs]
+    data_df = pd.read_fwf(BytesIO(raw), colspecs=[(start - 1, end) for _, start, end in colspecs], header=None,
+                          names=names, keep_default_na=False, na_values={name: [""] for name in names})
+    return data_df[[col for col in data_df.columns if col not in FILLER_VARS]]
+
+def decode_with_kernel(raw: bytes, colspecs: Colspecs) -> pd.DataFrame:
+    """
+    Decoder of prep_02: the NumPy/Numba fixed-width kernel.
+    """
+    buffer = np.frombuffer(raw, dtype=np.uint8)
+    data_df, _ = decode_fixed_width_columns(buffer, *locate_records(buffer), colspecs, str_columns=STR_VARS)
+    return data_df
+
+def prepare_decode(raw: bytes, colspecs: Colspecs) -> Tuple:
+    return raw, colspecs
+
+def prepare_family_input(raw: bytes, colspecs: Colspecs) -> Tuple[pd.DataFrame]:
+    """
+    Decode a month into the input of the prep_04 steps (with DATA_YEAR and BIRTH_YEAR).
+    """
+    data_df = decode_with_kernel(raw, colspecs)
+    data_df = data_df.astype({col: "float64" for col in data_df.columns if col not in STR_VARS}) # as read from the CSV file
+    data_df[DATA_YEAR] = 2000
+    family.update_age(data_df)
+    data_df[BIRTH_YEAR] = data_df[DATA_YEAR] - data_df[family.AGE]
+    return (data_df,)
+
+def add_child_related_variables_legacy(data_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Legacy child variables of prep_04: one pass of Python code per household.
+    """
+    age = family.AGE
+    def add_for_household(family_group: pd.DataFrame) -> pd.DataFrame:
+        is_ref_or_spouse = family_group[RELATIONSHIP].isin([1, 2])
+        is_child = family_group[RELATIONSHIP] == 3
+        num_children_in_family = is_child.sum()
+        family_group[HAS_CHILD] = (int(num_children_in_family > 0) * is_ref_or_spouse).astype(int)
+        family_group[AGE_OF_OLDEST_CHILD] = family_group.loc[is_child, age].max() if num_children_in_family > 0 else -1
+        family_group[YEAR_OF_FIRST_BIRTH_GIVING] = (family_group[DATA_YEAR] - family_group[AGE_OF_OLDEST_CHILD]
+                                                    if num_children_in_family > 0 else -1)
+        return family_group[is_ref_or_spouse]
+    return pd.concat([add_for_household(group) for _, group in data_df.groupby(HOUSEHOLD_ID)])
+
+def add_cohort_id_legacy(data_df: pd.DataFrame, var_list: List[str] = MATCHING_VARS) -> pd.DataFrame:
+    """
+    Legacy add_cohort_id of prep_04: one Python function call per row.
+    """
+    data_df[COHORT_ID] = data_df[var_list].apply(lambda x: "_".join(x.astype(str)), axis=1)
+    return data_df
+
+register_case("decode", decode_with_read_fwf, decode_with_kernel, prepare_decode)
+register_case("child_variables", add_child_related_variables_legacy,
+              family.add_child_related_variables.__wrapped__, prepare_family_input)
+register_case("cohort_id", add_cohort_id_legacy, family.add_cohort_id.__wrapped__, prepare_family_input)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Diff the accelerated code paths against the legacy ones on every dictionary epoch.")
+    parser.add_argument("cases", nargs="*", default=list(CASES), help=f"cases to run (default: all of {', '.join(CASES)})")
+    parser.add_argument("--synthetic", action="store_true", help="use synthetic months instead of the archived ones")
+    parser.add_argument("--rows", type=int, default=SYNTHETIC_ROWS, help="records per month (0 for whole real months)")
+    parser.add_argument("--repeat", type=int, default=1, help="timing repetitions (the best is kept)")
+    args = parser.parse_args()
+
+    results = run_harness(args.cases, args.synthetic, args.rows or None, args.repeat)
+    if results.empty:
+        print("No case was run (no dictionary epoch found).")
+        sys.exit(1)
+    results["mismatches"] = results["mismatches"].apply(len)
+    print(results.round(4).to_string(index=False))
+    summary = results.groupby("case").agg(epochs=("epoch", "count"), mismatches=("mismatches", "sum"),
+                                          legacy_s=("legacy_s", "sum"), candidate_s=("candidate_s", "sum"))
+    summary["speedup"] = summary["legacy_s"] / summary["candidate_s"]
+    print(summary.round(3).to_string())
+    sys.exit(1 if results["mismatches"].sum() > 0 else 0)
+
+if __name__ == "__main__":
+    main()
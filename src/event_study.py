@@ -0,0 +1,151 @@
+from pathlib import Path
+from typing import Tuple
+import time
+import numpy as np
+import pandas as pd
+from config import ESTIMATE_DIR, BOOTSTRAP_REPLICATES, BOOTSTRAP_SEED
+from merged_dataset import read_merged_dataset
+from prep_06_construct_pseudo_panel import drop_non_matched_observations
+from variable_typing import *
+
+# Non-parents are potential parents 1 to PRE_PERIODS years before the first birth (as in
+# the pseudo panel), and the effects are measured against REFERENCE_EVENT_TIME
+PRE_PERIODS = 5
+REFERENCE_EVENT_TIME = -1
+EVENT_TIME = "EVENT_TIME"
+
+# Bootstrap replicates are processed in blocks, to bound the size of the weight matrix
+REPLICATE_BLOCK_SIZE = 100
+
+def get_cell_statistics(df: pd.DataFrame, target_var: str) -> Tuple[pd.Index, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Compute the sufficient statistics (count and sum of the target) of each cohort x event-time
+    cell. Event time is the age of the oldest child for parents; each non-parent counts once
+    in every pre-period -PRE_PERIODS..-1 of its cohort, without replicating rows. Negative
+    codes of the target (not in universe, missing) are left out.
+
+    Args:
+        df (pd.DataFrame): The matched observations of the merged dataset.
+        target_var (str): The target variable.
+
+    Returns:
+        Tuple[pd.Index, np.ndarray, np.ndarray, np.ndarray]: The cohorts, the event times,
+        and the counts and sums, with shape (cohorts, event times).
+    """
+    df = df[df[target_var] >= 0]
+    cohort_codes, cohorts = pd.factorize(df[COHORT_ID].astype(str))
+    event_time = df[AGE_OF_OLDEST_CHILD].to_numpy(dtype=np.int64)
+    target = df[target_var].to_numpy(dtype=np.float64)
+    event_times = np.arange(-PRE_PERIODS, max(event_time.max(initial=-1), 0) + 1)
+    num_cohorts, num_event_times = len(cohorts), len(event_times)
+
+    # Parents: one cell per cohort and age of the oldest child
+    is_parent = event_time >= 0
+    cells = cohort_codes[is_parent] * num_event_times + event_time[is_parent] + PRE_PERIODS
+    size = num_cohorts * num_event_times
+    counts = np.bincount(cells, minlength=size).reshape(num_cohorts, num_event_times).astype(np.float64)
+    sums = np.bincount(cells, weights=target[is_parent], minlength=size).reshape(num_cohorts, num_event_times)
+
+    # Non-parents: the same cohort statistics in each pre-period
+    counts[:, :PRE_PERIODS] += np.bincount(cohort_codes[~is_parent], minlength=num_cohorts)[:, None]
+    sums[:, :PRE_PERIODS] += np.bincount(cohort_codes[~is_parent], weights=target[~is_parent],
+                                         minlength=num_cohorts)[:, None]
+    return cohorts, event_times, counts, sums
+
+def get_cell_means(cohorts: pd.Index, event_times: np.ndarray, counts: np.ndarray, sums: np.ndarray) -> pd.DataFrame:
+    """
+    Get the mean of the target in the non-empty cohort x event-time cells.
+    """
+    cohort_index, event_index = np.nonzero(counts)
+    return pd.DataFrame({COHORT_ID: cohorts[cohort_index], EVENT_TIME: event_times[event_index],
+                         "N": counts[cohort_index, event_index].astype(np.int64),
+                         "MEAN": sums[cohort_index, event_index] / counts[cohort_index, event_index]})
+
+def draw_cluster_weights(num_clusters: int, num_replicates: int, method: str, rng: np.random.Generator) -> np.ndarray:
+    """
+    Draw bootstrap weights for the clusters: Poisson(1) weights, or multinomial counts
+    (the classic resampling of clusters with replacement).
+    """
+    if method == "poisson":
+        return rng.poisson(1.0, size=(num_replicates, num_clusters)).astype(np.float64)
+    if method == "multinomial":
+        return rng.multinomial(num_clusters, np.full(num_clusters, 1 / num_clusters), size=num_replicates).astype(np.float64)
+    raise ValueError(f"Unknown bootstrap method: {method}")
+
+def estimate_event_study(counts: np.ndarray, sums: np.ndarray, event_times: np.ndarray,
+                         num_replicates: int = BOOTSTRAP_REPLICATES, method: str = "poisson",
+                         seed: int = BOOTSTRAP_SEED) -> pd.DataFrame:
+    """
+    Estimate the mean of the target at each event time and the effect relative to the
+    reference event time, with cohort-clustered bootstrap standard errors. A replicate
+    weights the cell statistics of each cohort by the cohort weight, so that the replicate
+    means are two matrix products: (W @ sums) / (W @ counts).
+
+    Args:
+        counts (np.ndarray): The cell counts, with shape (cohorts, event times).
+        sums (np.ndarray): The cell sums of the target, with the same shape.
+        event_times (np.ndarray): The event times of the columns.
+        num_replicates (int): The number of bootstrap replicates.
+        method (str): The bootstrap weights, "poisson" or "multinomial".
+        seed (int): The seed of the random generator.
+
+    Returns:
+        pd.DataFrame: The estimates by event time (N, MEAN, EFFECT, SE, CI_LOW, CI_HIGH).
+    """
+    rng = np.random.default_rng(seed)
+    reference = int(np.flatnonzero(event_times == REFERENCE_EVENT_TIME)[0])
+    means = sums.sum(axis=0) / counts.sum(axis=0)
+    effects = means - means[reference]
+
+    replicate_effects = []
+    for block_start in range(0, num_replicates, REPLICATE_BLOCK_SIZE):
+        block_size = min(REPLICATE_BLOCK_SIZE, num_replicates - block_start)
+        weights = draw_cluster_weights(counts.shape[0], block_size, method, rng)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            replicate_means = (weights @ sums) / (weights @ counts)
+        replicate_effects.append(replicate_means - replicate_means[:, [reference]])
+    replicate_effects = np.concatenate(replicate_effects)
+
+    return pd.DataFrame({
+        EVENT_TIME: event_times,
+        "N": counts.sum(axis=0).astype(np.int64),
+        "MEAN": means,
+        "EFFECT": effects,
+        "SE": np.nanstd(replicate_effects, axis=0, ddof=1),
+        "CI_LOW": np.nanpercentile(replicate_effects, 2.5, axis=0),
+        "CI_HIGH": np.nanpercentile(replicate_effects, 97.5, axis=0),
+    })
+
+def run_event_study(df: pd.DataFrame, target_var: str, output_dir: Path = ESTIMATE_DIR,
+                    num_replicates: int = BOOTSTRAP_REPLICATES) -> pd.DataFrame:
+    """
+    Estimate the event study of a target and save the estimates and the cell means.
+
+    Args:
+        df (pd.DataFrame): The matched observations of the merged dataset.
+        target_var (str): The target variable.
+        output_dir (Path): The directory to save the estimates.
+        num_replicates (int): The number of bootstrap replicates.
+
+    Returns:
+        pd.DataFrame: The estimates by event time.
+    """
+    cohorts, event_times, counts, sums = get_cell_statistics(df, target_var)
+    start = time.perf_counter()
+    estimates_df = estimate_event_study(counts, sums, event_times, num_replicates)
+    print(f"{target_var}: {num_replicates} bootstrap replicates over {len(cohorts)} cohorts "
+          f"in {time.perf_counter() - start:.2f} s")
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    estimates_df.to_csv(output_dir / f"event_study_{target_var}.csv", index=False)
+    get_cell_means(cohorts, event_times, counts, sums).to_csv(output_dir / f"cell_means_{target_var}.csv", index=False)
+    return estimates_df
+
+def main() -> None:
+    columns = [COHORT_ID, HAS_CHILD, AGE_OF_OLDEST_CHILD, TARGET_VAR1, TARGET_VAR2]
+    df = drop_non_matched_observations(read_merged_dataset(columns=columns), COHORT_ID, HAS_CHILD)
+    for target_var in [TARGET_VAR1, TARGET_VAR2]:
+        print(run_event_study(df, target_var).round(3).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
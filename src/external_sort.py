@@ -0,0 +1,263 @@
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from config import CPS_DATA_MERGED_DATASET, CPS_DATA_SPILL_DIR, EXTERNAL_SORT_RUN_ROWS, EXTERNAL_SORT_MERGE_ROWS
+from merged_dataset import get_dataset, get_dataset_ranges, build_filter_expression
+from variable_schema import apply_schema
+from variable_typing import *
+
+# External sort of the merged dataset by cohort key and DATA_YEAR, in bounded memory:
+#   1. the dataset is scanned in runs of run_rows rows; each run is sorted in memory and
+#      spilled to a Parquet file in a temporary directory of CPS_DATA_SPILL_DIR;
+#   2. the runs are merged k ways, each run read in batches of merge_rows rows: the rows of
+#      all buffers below the smallest last key of the buffers are emitted, sorted together,
+#      and the buffers are refilled;
+#   3. the merged stream is cut at cohort boundaries, so that the consumers get whole
+#      cohorts, one batch (iter_cohort_batches) or one cohort (iter_cohorts) at a time.
+# The memory is bounded by one run while sorting and by k batches while merging (plus the
+# largest cohort). The sort key is packed into one uint64 per row: each key column is
+# coded as value - min + 1 (0 for missing) on the bits its range needs, from the row-group
+# statistics, so that the runs are sorted with a single integer argsort. The sort is stable:
+# the rows of a cohort and year keep the order of the dataset.
+SORT_KEY = "_SORT_KEY"
+KeyLayout = List[Tuple[str, int, int]] # (column, minimum, bits) of each key column, most significant first
+
+def get_key_layout(dataset: ds.Dataset, key_columns: List[str]) -> KeyLayout:
+    """
+    Get the bit layout of a packed sort key from the ranges of its columns (row-group
+    statistics, and the partition values for DATA_YEAR).
+
+    Args:
+        dataset (ds.Dataset): The merged dataset.
+        key_columns (List[str]): The key columns, most significant first (integer columns).
+
+    Returns:
+        KeyLayout: The minimum and the number of bits of each column.
+    """
+    ranges = get_dataset_ranges(dataset, [col for col in key_columns if col != DATA_YEAR])
+    if DATA_YEAR in key_columns:
+        years = [ds.get_partition_keys(fragment.partition_expression)[DATA_YEAR] for fragment in dataset.get_fragments()]
+        ranges[DATA_YEAR] = (min(years), max(years)) if years else (0, 0)
+    layout = []
+    for col in key_columns:
+        if ranges[col] is None:
+            raise ValueError(f"{col} has no statistics in the merged dataset, it cannot be packed into the sort key.")
+        low, high = int(ranges[col][0]), int(ranges[col][1])
+        layout.append((col, low, (high - low + 1).bit_length())) # codes 0 (missing) to high - low + 1
+    if sum(bits for _, _, bits in layout) > 64:
+        raise ValueError(f"The sort key {key_columns} does not fit in 64 bits: {layout}")
+    return layout
+
+def pack_keys(table: pa.Table, layout: KeyLayout) -> np.ndarray:
+    """
+    Pack the key columns of a table into one uint64 per row (see get_key_layout).
+    """
+    keys = np.zeros(table.num_rows, dtype=np.uint64)
+    for col, low, bits in layout:
+        codes = pc.add(pc.subtract(table[col].cast(pa.int64()), low), 1).fill_null(0)
+        keys = (keys << np.uint64(bits)) | codes.to_numpy().astype(np.uint64)
+    return keys
+
+def get_group_shift(layout: KeyLayout, group_columns: List[str]) -> np.uint64:
+    """
+    Get the right shift that turns a packed key into the key of its group (the leading
+    group_columns of the layout).
+    """
+    if [col for col, _, _ in layout[:len(group_columns)]] != list(group_columns):
+        raise ValueError(f"The group columns {group_columns} are not the leading columns of the sort key.")
+    return np.uint64(sum(bits for _, _, bits in layout[len(group_columns):]))
+
+def write_sorted_runs(dataset: ds.Dataset, columns: List[str], layout: KeyLayout, spill_dir: Path,
+                      filters: Optional[Dict] = None, run_rows: int = EXTERNAL_SORT_RUN_ROWS,
+                      merge_rows: int = EXTERNAL_SORT_MERGE_ROWS) -> List[Path]:
+    """
+    Scan the dataset in runs of about run_rows rows, sort each run by its packed key and
+    write it to a Parquet file (row groups of merge_rows rows, the unit read by the merge).
+
+    Args:
+        dataset (ds.Dataset): The merged dataset.
+        columns (List[str]): The columns to keep.
+        layout (KeyLayout): The sort key.
+        spill_dir (Path): The directory of the run files.
+        filters (Optional[Dict]): The filters of the rows (see build_filter_expression).
+        run_rows (int): The rows per run.
+        merge_rows (int): The rows per row group of the run files.
+
+    Returns:
+        List[Path]: The run files, in scan order.
+    """
+    key_columns = [col for col, _, _ in layout]
+    read_columns = columns + [col for col in key_columns if col not in columns]
+    run_files, batches, num_rows = [], [], 0
+
+    def write_run() -> None:
+        table = pa.Table.from_batches(batches)
+        keys = pack_keys(table, layout)
+        order = np.argsort(keys, kind="stable")
+        table = table.select(columns).take(order).append_column(SORT_KEY, pa.array(keys[order]))
+        run_file = spill_dir / f"run_{len(run_files):05d}.parquet"
+        pq.write_table(table, run_file, row_group_size=merge_rows)
+        run_files.append(run_file)
+
+    for batch in dataset.to_batches(columns=read_columns, filter=build_filter_expression(filters)):
+        if batch.num_rows == 0:
+            continue
+        batches.append(batch)
+        num_rows += batch.num_rows
+        if num_rows >= run_rows:
+            write_run()
+            batches, num_rows = [], 0
+    if batches:
+        write_run()
+    return run_files
+
+def merge_runs(run_files: List[Path], merge_rows: int = EXTERNAL_SORT_MERGE_ROWS) -> Iterator[pa.Table]:
+    """
+    Merge sorted run files k ways, reading each in batches of merge_rows rows, and yield
+    the merged rows in key order. Equal keys are emitted together, in run order, so the
+    merge is stable.
+    """
+    readers = [pq.ParquetFile(run_file).iter_batches(batch_size=merge_rows) for run_file in run_files]
+    buffers = [pa.Table.from_batches([], schema=pq.read_schema(run_file)) for run_file in run_files]
+    is_done = [False] * len(run_files)
+
+    def refill(i: int) -> None:
+        batch = next(readers[i], None)
+        if batch is None:
+            is_done[i] = True
+        else:
+            buffers[i] = pa.concat_tables([buffers[i], pa.Table.from_batches([batch])])
+
+    while True:
+        for i in range(len(run_files)):
+            while buffers[i].num_rows == 0 and not is_done[i]:
+                refill(i)
+        if all(buffer.num_rows == 0 for buffer in buffers):
+            return
+        # Every row below the smallest last key of the unfinished runs precedes the rows
+        # still on disk (all rows are final once every run is read)
+        last_keys = [buffers[i][SORT_KEY][-1].as_py() for i in range(len(run_files)) if not is_done[i]]
+        bound = min(last_keys) if last_keys else None
+        parts = []
+        for i, buffer in enumerate(buffers):
+            cut = buffer.num_rows if bound is None else int(np.searchsorted(buffer[SORT_KEY].to_numpy(), bound, side="left"))
+            if cut > 0:
+                parts.append(buffer.slice(0, cut))
+                buffers[i] = buffer.slice(cut)
+        if not parts:
+            # The runs that end on the bound hold only rows with that key: read further
+            for i in range(len(run_files)):
+                if not is_done[i] and buffers[i][SORT_KEY][-1].as_py() == bound:
+                    refill(i)
+            continue
+        table = pa.concat_tables(parts)
+        yield table.take(np.argsort(table[SORT_KEY].to_numpy(), kind="stable"))
+
+def iter_sorted_cohort_tables(columns: List[str], filters: Optional[Dict] = None,
+                              group_columns: List[str] = MATCHING_VARS, run_rows: int = EXTERNAL_SORT_RUN_ROWS,
+                              merge_rows: int = EXTERNAL_SORT_MERGE_ROWS, spill_dir: Path = CPS_DATA_SPILL_DIR,
+                              dataset_dir: Path = CPS_DATA_MERGED_DATASET) -> Iterator[Tuple[pa.Table, np.ndarray]]:
+    """
+    Sort the merged dataset by group_columns and DATA_YEAR on disk, and yield tables of
+    whole groups in key order, with the group key of each row. The run files are deleted
+    when the iteration ends.
+    """
+    dataset = get_dataset(dataset_dir)
+    layout = get_key_layout(dataset, list(group_columns) + [DATA_YEAR])
+    shift = get_group_shift(layout, group_columns)
+    spill_dir.mkdir(parents=True, exist_ok=True)
+    run_dir = Path(tempfile.mkdtemp(prefix=f"sort_{os.getpid()}_", dir=spill_dir))
+    try:
+        run_files = write_sorted_runs(dataset, columns, layout, run_dir, filters, run_rows, merge_rows)
+        pending = None
+        for table in merge_runs(run_files, merge_rows):
+            table = table if pending is None else pa.concat_tables([pending, table])
+            group_keys = table[SORT_KEY].to_numpy() >> shift
+            # The last group may continue in the next batch
+            cut = int(np.searchsorted(group_keys, group_keys[-1], side="left"))
+            if cut > 0:
+                yield table.slice(0, cut), group_keys[:cut]
+            pending = table.slice(cut)
+        if pending is not None and pending.num_rows > 0:
+            yield pending, pending[SORT_KEY].to_numpy() >> shift
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+def to_frame(table: pa.Table, columns: List[str]) -> pd.DataFrame:
+    return apply_schema(table.drop([SORT_KEY]).to_pandas())[columns]
+
+def iter_cohort_batches(columns: List[str] = NEEDED_VARS, filters: Optional[Dict] = None,
+                        group_columns: List[str] = MATCHING_VARS, run_rows: int = EXTERNAL_SORT_RUN_ROWS,
+                        merge_rows: int = EXTERNAL_SORT_MERGE_ROWS, spill_dir: Path = CPS_DATA_SPILL_DIR,
+                        dataset_dir: Path = CPS_DATA_MERGED_DATASET) -> Iterator[pd.DataFrame]:
+    """
+    Stream the merged dataset sorted by cohort and DATA_YEAR, in batches that contain whole
+    cohorts only, so that a cohort-level operation can run batch by batch.
+
+    Args:
+        columns (List[str]): The columns to read.
+        filters (Optional[Dict]): The filters of the rows (see build_filter_expression).
+        group_columns (List[str]): The cohort key (integer columns).
+        run_rows (int): The rows sorted in memory per run.
+        merge_rows (int): The rows read per run and batch by the merge.
+        spill_dir (Path): The directory of the temporary run files.
+        dataset_dir (Path): The dataset directory.
+
+    Yields:
+        pd.DataFrame: Consecutive cohorts, with the schema dtypes.
+    """
+    for table, _ in iter_sorted_cohort_tables(columns, filters, group_columns, run_rows, merge_rows, spill_dir, dataset_dir):
+        yield to_frame(table, columns)
+
+def iter_cohorts(columns: List[str] = NEEDED_VARS, filters: Optional[Dict] = None,
+                 group_columns: List[str] = MATCHING_VARS, run_rows: int = EXTERNAL_SORT_RUN_ROWS,
+                 merge_rows: int = EXTERNAL_SORT_MERGE_ROWS, spill_dir: Path = CPS_DATA_SPILL_DIR,
+                 dataset_dir: Path = CPS_DATA_MERGED_DATASET) -> Iterator[pd.DataFrame]:
+    """
+    Stream the merged dataset one cohort at a time (rows sorted by DATA_YEAR), see
+    iter_cohort_batches for the arguments.
+    """
+    for table, group_keys in iter_sorted_cohort_tables(columns, filters, group_columns, run_rows, merge_rows, spill_dir, dataset_dir):
+        data_df = to_frame(table, columns)
+        bounds = np.r_[0, np.flatnonzero(np.diff(group_keys)) + 1, len(group_keys)]
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            yield data_df.iloc[start:stop]
+
+def benchmark_external_sort(run_rows: int = EXTERNAL_SORT_RUN_ROWS) -> None:
+    """
+    Compare the external sort with sorting the whole merged dataset in memory (same order).
+    """
+    from merged_dataset import read_merged_dataset
+    start = time.perf_counter()
+    data_df = read_merged_dataset(columns=NEEDED_VARS)
+    expected_df = data_df.sort_values(MATCHING_VARS + [DATA_YEAR], kind="stable").reset_index(drop=True)
+    in_memory_time = time.perf_counter() - start
+    print(f"In memory: {len(expected_df)} rows sorted in {in_memory_time:.2f} s "
+          f"({data_df.memory_usage(deep=True).sum() / 1e6:.1f} MB loaded)")
+    del data_df
+
+    start = time.perf_counter()
+    batch_dfs = list(iter_cohort_batches(NEEDED_VARS, run_rows=run_rows))
+    external_time = time.perf_counter() - start
+    actual_df = pd.concat(batch_dfs, ignore_index=True)
+    print(f"External ({run_rows} rows per run): {len(actual_df)} rows in {len(batch_dfs)} batches "
+          f"in {external_time:.2f} s, same order: {actual_df.astype(str).equals(expected_df.astype(str))}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Sort the merged dataset by cohort and year in bounded memory.")
+    parser.add_argument("--run-rows", type=int, default=EXTERNAL_SORT_RUN_ROWS, help="rows sorted in memory per run")
+    args = parser.parse_args()
+    benchmark_external_sort(args.run_rows)
+
+if __name__ == "__main__":
+    main()
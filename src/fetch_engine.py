@@ -0,0 +1,202 @@
+from pathlib import Path
+from typing import Dict, Tuple
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+import asyncio
+import json
+import os
+import random
+import requests
+
+# HTTP status codes that are worth retrying (throttling and transient server errors)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class HostRateLimiter:
+    """
+    Space out the requests to a single host to at most `requests_per_second`.
+    """
+    def __init__(self, requests_per_second: float) -> None:
+        self.interval = 1.0 / requests_per_second if requests_per_second > 0 else 0.0
+        self.next_time = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            wait = max(0.0, self.next_time - now)
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+def get_request(url: str, file_path: Path, timeout: float) -> Tuple[int, int, Dict[str, str]]:
+    """
+    Download a URL into a temporary file next to `file_path` (blocking, run in a worker thread).
+
+    Parameters:
+        url (str): The URL to download.
+        file_path (Path): The final path of the file.
+        timeout (float): The connect/read timeout in seconds.
+
+    Returns:
+        Tuple[int, int, Dict[str, str]]: The HTTP status code, the number of bytes written
+        and the response headers.
+    """
+    temp_file = file_path.with_name(file_path.name + ".part")
+    with requests.get(url, stream=True, timeout=timeout) as response:
+        if response.status_code != 200:
+            return response.status_code, 0, dict(response.headers)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        num_bytes = 0
+        with open(temp_file, "wb") as f:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+                num_bytes += len(chunk)
+    if num_bytes <= 1024: # not a data file (e.g. an error page)
+        temp_file.unlink()
+    else:
+        os.replace(temp_file, file_path)
+    return 200, num_bytes, dict(response.headers)
+
+async def fetch_file(url: str, file_path: Path, semaphore: asyncio.Semaphore, rate_limiter: HostRateLimiter,
+                     max_retries: int, backoff_seconds: float, timeout: float) -> Dict:
+    """
+    Fetch a single file with bounded concurrency, rate limiting and exponential-backoff retries.
+
+    Parameters:
+        url (str): The URL to download.
+        file_path (Path): The path to save the file.
+        semaphore (asyncio.Semaphore): Limits the number of concurrent downloads.
+        rate_limiter (HostRateLimiter): The rate limiter of the URL's host.
+        max_retries (int): The maximum number of retries after the first attempt.
+        backoff_seconds (float): The base delay, doubled after each failed attempt.
+        timeout (float): The connect/read timeout in seconds.
+
+    Returns:
+        Dict: The status entry of the file ("downloaded", "missing", "too_small" or "failed").
+    """
+    entry = {"url": url, "file": str(file_path), "attempts": 0}
+    for attempt in range(max_retries + 1):
+        entry["attempts"] = attempt + 1
+        delay = backoff_seconds * 2 ** attempt * (1 + random.random()) # jitter avoids synchronized retries
+        async with semaphore:
+            await rate_limiter.acquire()
+            try:
+                status_code, num_bytes, headers = await asyncio.to_thread(get_request, url, file_path, timeout)
+            except requests.RequestException as e:
+                entry.update({"status": "failed", "http_status": None, "error": repr(e)})
+                status_code = None
+        if status_code == 200:
+            status = "downloaded" if num_bytes > 1024 else "too_small"
+            entry.update({"status": status, "http_status": 200, "bytes": num_bytes, "error": None})
+            break
+        if status_code == 404: # the month has not been published (yet)
+            entry.update({"status": "missing", "http_status": 404, "error": None})
+            break
+        if status_code is not None:
+            entry.update({"status": "failed", "http_status": status_code, "error": f"HTTP {status_code}"})
+            if status_code not in RETRY_STATUS_CODES:
+                break
+            retry_after = headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+        if attempt < max_retries:
+            await asyncio.sleep(delay)
+
+    entry["checked_at"] = datetime.now().isoformat(timespec="seconds")
+    return entry
+
+def load_manifest(manifest_file: Path) -> Dict[str, Dict]:
+    """
+    Load the download status manifest (an empty one if it does not exist yet).
+    """
+    if not manifest_file.exists():
+        return {}
+    return json.loads(manifest_file.read_text())
+
+def save_manifest(manifest: Dict[str, Dict], manifest_file: Path) -> None:
+    """
+    Save the download status manifest, replacing the old one atomically.
+    """
+    manifest_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = manifest_file.with_name(manifest_file.name + ".tmp")
+    temp_file.write_text(json.dumps(dict(sorted(manifest.items())), indent=2))
+    os.replace(temp_file, manifest_file)
+
+def needs_download(key: str, file_path: Path, manifest: Dict[str, Dict], missing_recheck_days: float) -> bool:
+    """
+    Check whether a file still has to be (re)requested, given the manifest.
+
+    Parameters:
+        key (str): The manifest key of the file (e.g. the month "199401").
+        file_path (Path): The path to save the file.
+        manifest (Dict[str, Dict]): The download status manifest.
+        missing_recheck_days (float): Months reported missing are requested again after this many days.
+
+    Returns:
+        bool: True if the file should be requested.
+    """
+    if file_path.exists():
+        return False
+    entry = manifest.get(key)
+    if entry is not None and entry["status"] == "missing":
+        checked_at = datetime.fromisoformat(entry["checked_at"])
+        return datetime.now() - checked_at > timedelta(days=missing_recheck_days)
+    return True
+
+async def fetch_files(jobs: Dict[str, Tuple[str, Path]], max_concurrency: int, requests_per_second: float,
+                      max_retries: int, backoff_seconds: float, timeout: float) -> Dict[str, Dict]:
+    """
+    Fetch several files concurrently, with one rate limiter per host.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    rate_limiters = {}
+    tasks = {}
+    for key, (url, file_path) in jobs.items():
+        host = urlparse(url).netloc
+        if host not in rate_limiters:
+            rate_limiters[host] = HostRateLimiter(requests_per_second)
+        tasks[key] = fetch_file(url, file_path, semaphore, rate_limiters[host], max_retries, backoff_seconds, timeout)
+    entries = await asyncio.gather(*tasks.values())
+    return dict(zip(tasks.keys(), entries))
+
+def download_files(jobs: Dict[str, Tuple[str, Path]], manifest_file: Path, max_concurrency: int = 8,
+                   requests_per_second: float = 4.0, max_retries: int = 5, backoff_seconds: float = 1.0,
+                   timeout: float = 60.0, missing_recheck_days: float = 7.0) -> Dict[str, Dict]:
+    """
+    Download the files that are not available yet and record the outcome in a status manifest.
+
+    Parameters:
+        jobs (Dict[str, Tuple[str, Path]]): The (url, file_path) to download, by manifest key.
+        manifest_file (Path): The path to the JSON status manifest.
+        max_concurrency (int): The maximum number of concurrent downloads.
+        requests_per_second (float): The maximum request rate per host.
+        max_retries (int): The maximum number of retries per file.
+        backoff_seconds (float): The base delay of the exponential backoff.
+        timeout (float): The connect/read timeout in seconds.
+        missing_recheck_days (float): Months reported missing are requested again after this many days.
+
+    Returns:
+        Dict[str, Dict]: The updated manifest.
+    """
+    manifest = load_manifest(manifest_file)
+    for key, (url, file_path) in jobs.items():
+        if file_path.exists() and manifest.get(key, {}).get("status") != "downloaded":
+            manifest[key] = {"url": url, "file": str(file_path), "status": "downloaded",
+                             "bytes": file_path.stat().st_size, "checked_at": datetime.now().isoformat(timespec="seconds")}
+    pending_jobs = {key: job for key, job in jobs.items() if needs_download(key, job[1], manifest, missing_recheck_days)}
+    print(f"{len(pending_jobs)} of {len(jobs)} files to request, {len(jobs) - len(pending_jobs)} already known")
+
+    if pending_jobs:
+        entries = asyncio.run(fetch_files(pending_jobs, max_concurrency, requests_per_second,
+                                          max_retries, backoff_seconds, timeout))
+        manifest.update(entries)
+
+        # Summarize the outcome
+        statuses = [entry["status"] for entry in entries.values()]
+        print(", ".join(f"{status}: {statuses.count(status)}" for status in sorted(set(statuses))))
+        for key, entry in entries.items():
+            if entry["status"] == "failed":
+                print(f"Failed to download {key} after {entry['attempts']} attempts: {entry['error']}")
+
+    save_manifest(manifest, manifest_file)
+    return manifest
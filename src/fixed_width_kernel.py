@@ -0,0 +1,208 @@
+from pathlib import Path
+from typing import Dict, List, Tuple
+import numpy as np
+import pandas as pd
+
+try: # Numba is optional, the pure NumPy kernel is used as a fallback
+    import numba
+except ImportError:
+    numba = None
+
+# ASCII codes used by the kernel
+SPACE, PLUS, MINUS, ZERO, NINE, NEWLINE, CARRIAGE_RETURN = 32, 43, 45, 48, 57, 10, 13
+
+def load_fixed_width_bytes(data_fx_file: Path) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Load a fixed-width data file as raw bytes and locate its records.
+
+    Parameters:
+        data_fx_file (Path): The path to the fixed-width data file.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The raw bytes, the start offset and
+        the end offset (exclusive, without line terminator) of each record.
+    """
+    buffer = np.fromfile(data_fx_file, dtype=np.uint8)
+    return buffer, *locate_records(buffer)
+
+def locate_records(buffer: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Locate the records in a buffer of ASCII bytes.
+
+    Parameters:
+        buffer (np.ndarray): The raw bytes (uint8).
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The start and end offset of each record.
+    """
+    newlines = np.flatnonzero(buffer == NEWLINE)
+    if len(buffer) > 0 and (len(newlines) == 0 or newlines[-1] != len(buffer) - 1):
+        newlines = np.append(newlines, len(buffer)) # last record without line terminator
+    starts = np.concatenate([[0], newlines[:-1] + 1]).astype(np.int64)
+    ends = newlines.astype(np.int64)
+
+    # Strip carriage returns (files with Windows line endings)
+    has_cr = (ends > starts) & (buffer[np.maximum(ends - 1, 0)] == CARRIAGE_RETURN)
+    ends = ends - has_cr
+
+    # Drop empty records (e.g. trailing blank lines)
+    non_empty = ends > starts
+    return starts[non_empty], ends[non_empty]
+
+def slice_column(buffer: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+                 start_pos: int, end_pos: int) -> np.ndarray:
+    """
+    Slice a byte column out of every record; bytes beyond a short record are read as blanks.
+
+    Parameters:
+        buffer (np.ndarray): The raw bytes.
+        starts (np.ndarray): The start offset of each record.
+        ends (np.ndarray): The end offset of each record.
+        start_pos (int): The 1-based start position of the column (dictionary convention).
+        end_pos (int): The 1-based, inclusive end position of the column.
+
+    Returns:
+        np.ndarray: A (num_records, width) uint8 matrix.
+    """
+    offsets = starts[:, None] + np.arange(start_pos - 1, end_pos)
+    in_record = offsets < ends[:, None]
+    return np.where(in_record, buffer[np.minimum(offsets, len(buffer) - 1)], SPACE).astype(np.uint8)
+
+def _parse_int_column_numpy(chars: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Parse a byte column with vectorized NumPy operations (see parse_int_column).
+    """
+    num_rows, width = chars.shape
+    positions = np.arange(width)
+    non_space = chars != SPACE
+    is_blank = ~non_space.any(axis=1)
+
+    # Strip leading and trailing spaces
+    first = non_space.argmax(axis=1)
+    last = width - 1 - non_space[:, ::-1].argmax(axis=1)
+    inside = (positions >= first[:, None]) & (positions <= last[:, None])
+
+    # An optional sign is allowed at the first non-space character
+    first_char = chars[np.arange(num_rows), first]
+    has_sign = (first_char == PLUS) | (first_char == MINUS)
+    is_digit_region = inside & ~((positions == first[:, None]) & has_sign[:, None])
+    is_digit = (chars >= ZERO) & (chars <= NINE)
+
+    # Everything in the digit region has to be a digit, and there has to be at least one digit
+    is_invalid = (is_digit_region & ~is_digit).any(axis=1) | ~is_digit_region.any(axis=1)
+    is_invalid &= ~is_blank
+
+    # Accumulate the digits from left to right
+    values = np.zeros(num_rows, dtype=np.int64)
+    for i in range(width):
+        use = is_digit_region[:, i] & is_digit[:, i]
+        values = np.where(use, values * 10 + (chars[:, i].astype(np.int64) - ZERO), values)
+    values = np.where(first_char == MINUS, -values, values)
+    values[is_blank | is_invalid] = 0
+
+    return values, is_blank, is_invalid
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _parse_int_column_numba(chars):
+        num_rows, width = chars.shape
+        values = np.zeros(num_rows, dtype=np.int64)
+        is_blank = np.zeros(num_rows, dtype=np.bool_)
+        is_invalid = np.zeros(num_rows, dtype=np.bool_)
+        for row in range(num_rows):
+            first = 0
+            while first < width and chars[row, first] == SPACE:
+                first += 1
+            if first == width:
+                is_blank[row] = True
+                continue
+            last = width - 1
+            while chars[row, last] == SPACE:
+                last -= 1
+            negative = chars[row, first] == MINUS
+            if negative or chars[row, first] == PLUS:
+                first += 1
+            if first > last:
+                is_invalid[row] = True
+                continue
+            value = 0
+            for i in range(first, last + 1):
+                char = chars[row, i]
+                if char < ZERO or char > NINE:
+                    is_invalid[row] = True
+                    value = 0
+                    break
+                value = value * 10 + (char - ZERO)
+            values[row] = -value if negative else value
+        return values, is_blank, is_invalid
+
+def parse_int_column(chars: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Parse a byte column of ASCII integers in one pass. Leading and trailing spaces are
+    ignored, a single leading sign is allowed (e.g. -1 for "not in universe"), blank
+    fields are treated as missing, and anything else is flagged as invalid.
+
+    Parameters:
+        chars (np.ndarray): A (num_records, width) uint8 matrix.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The parsed values (int64, 0 where
+        missing), the blank mask and the invalid-value mask.
+    """
+    chars = np.ascontiguousarray(chars, dtype=np.uint8)
+    if chars.shape[1] == 0: # e.g. a dictionary entry with end_pos < start_pos
+        num_rows = chars.shape[0]
+        return np.zeros(num_rows, dtype=np.int64), np.ones(num_rows, dtype=bool), np.zeros(num_rows, dtype=bool)
+    if numba is not None:
+        return _parse_int_column_numba(chars)
+    return _parse_int_column_numpy(chars)
+
+def to_nullable_int(values: np.ndarray, mask: np.ndarray) -> pd.arrays.IntegerArray:
+    """
+    Wrap parsed values into a pandas nullable integer array, using the smallest integer type.
+
+    Parameters:
+        values (np.ndarray): The parsed values.
+        mask (np.ndarray): The missing-value mask.
+
+    Returns:
+        pd.arrays.IntegerArray: The nullable integer array.
+    """
+    valid_values = values[~mask]
+    low, high = (valid_values.min(), valid_values.max()) if len(valid_values) > 0 else (0, 0)
+    for dtype in [np.int8, np.int16, np.int32, np.int64]:
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            break
+    return pd.arrays.IntegerArray(values.astype(dtype), mask)
+
+def decode_fixed_width_columns(buffer: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+                               colspecs: List[Tuple[str, int, int]],
+                               str_columns: List[str] = []) -> Tuple[pd.DataFrame, Dict[str, int]]:
+    """
+    Decode the columns of a fixed-width buffer into a DataFrame of nullable integers.
+
+    Parameters:
+        buffer (np.ndarray): The raw bytes.
+        starts (np.ndarray): The start offset of each record.
+        ends (np.ndarray): The end offset of each record.
+        colspecs (List[Tuple[str, int, int]]): (var_name, start_pos, end_pos) of each column,
+            with 1-based, inclusive positions as in the dictionary CSV files.
+        str_columns (List[str]): Columns that are kept as stripped strings (e.g. HRSAMPLE).
+
+    Returns:
+        Tuple[pd.DataFrame, Dict[str, int]]: The decoded data and the number of invalid
+        values per column (only columns with invalid values are listed).
+    """
+    columns, invalid_counts = {}, {}
+    for var_name, start_pos, end_pos in colspecs:
+        chars = slice_column(buffer, starts, ends, start_pos, end_pos)
+        if var_name in str_columns:
+            strings = pd.Series(chars.view(f"S{chars.shape[1]}").ravel()).str.decode("ascii", errors="replace").str.strip()
+            columns[var_name] = strings.mask(strings == "")
+            continue
+        values, is_blank, is_invalid = parse_int_column(chars)
+        columns[var_name] = to_nullable_int(values, is_blank | is_invalid)
+        if is_invalid.any():
+            invalid_counts[var_name] = int(is_invalid.sum())
+
+    return pd.DataFrame(columns), invalid_counts
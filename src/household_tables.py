@@ -0,0 +1,143 @@
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from config import CPS_DATA_HOUSEHOLD_DIR
+from variable_typing import HOUSEHOLD_ID, HOUSEHOLD_ID2, SAMPLE_ID, SERIAL_SUFFIX, PERSON_NUM, STR_VARS
+
+# The household record fields (HR*, HU*, HE*, HG*, HX*) and the geography fields (GE*, GT*)
+# are the same for every person of a household. prep_02 stores them once per household in a
+# household table (same file name as the monthly file, in CPS_DATA_HOUSEHOLD_DIR), and the
+# person table keeps the household key and the person fields. The stages join the household
+# fields they use, and only those.
+HOUSEHOLD_PREFIXES = ("H", "G")
+
+def get_household_key_columns(columns: List[str]) -> List[str]:
+    """
+    Get the variables that identify a household in a month: HRHHID with HRHHID2 from May 2004,
+    and with HRSAMPLE, HRSERSUF and HUHHNUM before.
+    """
+    if HOUSEHOLD_ID2 in columns:
+        return [HOUSEHOLD_ID, HOUSEHOLD_ID2]
+    return [HOUSEHOLD_ID] + [col for col in [SAMPLE_ID, SERIAL_SUFFIX, PERSON_NUM] if col in columns]
+
+def get_household_keys(data_df: pd.DataFrame, key_columns: List[str]) -> np.ndarray:
+    """
+    Hash the household key of each row (uint64). The same identifiers hash to the same key in
+    every file, whatever dtype was inferred when the file was read.
+    """
+    key_df = pd.DataFrame({col: data_df[col].fillna("").astype(str) if col in STR_VARS else data_df[col].fillna(-1).astype(np.int64)
+                           for col in key_columns})
+    return pd.util.hash_pandas_object(key_df, index=False).to_numpy()
+
+def get_household_file(data_file: Path, household_dir: Path = CPS_DATA_HOUSEHOLD_DIR) -> Path:
+    """
+    Get the household table of a monthly file of any stage (csv/cps_199401.csv -> households/cps_199401.csv).
+    """
+    return household_dir / data_file.name
+
+def split_household_table(data_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Split a decoded month into a household table and a person table. A household-level field
+    that is not constant within a household (a data error) stays in the person table.
+
+    Args:
+        data_df (pd.DataFrame): The decoded month, one row per person.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: The person table (household key and person fields,
+        one row per person) and the household table (household key and household fields,
+        one row per household, in order of first appearance).
+    """
+    key_columns = get_household_key_columns(data_df.columns.to_list())
+    candidates = [col for col in data_df.columns if col.startswith(HOUSEHOLD_PREFIXES) and col not in key_columns]
+    num_values = data_df.groupby(key_columns, sort=False, dropna=False)[candidates].nunique(dropna=False).max()
+    household_columns = [col for col in candidates if num_values.get(col, 0) <= 1]
+    varying = [col for col in candidates if col not in household_columns]
+    if varying:
+        print(f"Household fields that vary within a household (kept in the person table): {varying}")
+
+    household_df = data_df[key_columns + household_columns].drop_duplicates(key_columns).reset_index(drop=True)
+    person_df = data_df[[col for col in data_df.columns if col not in household_columns]]
+    return person_df, household_df
+
+def get_month_columns(data_file: Path) -> List[str]:
+    """
+    Get the columns of a month: those of its file and those of its household table.
+    """
+    columns = pd.read_csv(data_file, nrows=0).columns.to_list()
+    household_file = get_household_file(data_file)
+    if household_file.exists():
+        columns += [col for col in pd.read_csv(household_file, nrows=0).columns if col not in columns]
+    return columns
+
+def load_household_columns(data_file: Path, columns: List[str]) -> Optional[pd.DataFrame]:
+    """
+    Load some fields of the household table of a month, indexed by the hashed household key
+    (None if none of the fields is in the household table).
+    """
+    household_file = get_household_file(data_file)
+    if not household_file.exists():
+        return None
+    household_columns = pd.read_csv(household_file, nrows=0).columns.to_list()
+    key_columns = get_household_key_columns(household_columns)
+    columns = [col for col in columns if col in household_columns and col not in key_columns]
+    if not columns:
+        return None
+    household_df = pd.read_csv(household_file, usecols=key_columns + columns, dtype={var: str for var in STR_VARS})
+    household_df.index = pd.Index(get_household_keys(household_df, key_columns))
+    household_df = household_df[columns]
+    household_df.attrs["key_columns"] = key_columns
+    return household_df
+
+def join_household_columns(person_df: pd.DataFrame, data_file: Path, columns: List[str],
+                           household_df: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    Add household fields to the persons of a month (the index, the row order and the attrs
+    are kept). The fields already in the person table (e.g. files decoded before the split)
+    are not joined again.
+
+    Args:
+        person_df (pd.DataFrame): Persons of the month, with the household key.
+        data_file (Path): The monthly file of the persons (any stage).
+        columns (List[str]): The household fields to add.
+        household_df (Optional[pd.DataFrame]): The household fields, if already loaded
+            (see load_household_columns).
+
+    Returns:
+        pd.DataFrame: The persons with the household fields.
+    """
+    missing = [col for col in columns if col not in person_df.columns]
+    if not missing:
+        return person_df
+    if household_df is None:
+        household_df = load_household_columns(data_file, missing)
+    if household_df is None:
+        return person_df
+    values_df = household_df.reindex(get_household_keys(person_df, household_df.attrs["key_columns"]))
+    joined_df = person_df.copy()
+    for col in missing:
+        if col in values_df.columns:
+            joined_df[col] = values_df[col].to_numpy()
+    return joined_df
+
+def read_month(data_file: Path, columns: Optional[List[str]] = None, dtype: Optional[Dict] = None) -> pd.DataFrame:
+    """
+    Read some columns of a month, from its file and from its household table.
+
+    Args:
+        data_file (Path): The monthly file (any stage).
+        columns (Optional[List[str]]): The columns (all columns by default).
+        dtype (Optional[Dict]): The dtypes passed to read_csv.
+
+    Returns:
+        pd.DataFrame: The columns, one row per person in file order.
+    """
+    person_columns = pd.read_csv(data_file, nrows=0).columns.to_list()
+    month_columns = get_month_columns(data_file)
+    columns = columns or month_columns
+    key_columns = get_household_key_columns(month_columns)
+    usecols = [col for col in person_columns if col in columns or col in key_columns]
+    person_df = pd.read_csv(data_file, usecols=usecols, dtype={**{var: str for var in STR_VARS}, **(dtype or {})})
+    person_df = join_household_columns(person_df, data_file, [col for col in columns if col not in person_columns])
+    return person_df[columns]
@@ -0,0 +1,201 @@
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from atomic_io import atomic_output, is_complete, get_marker_file
+from config import CPS_DATA_MERGED_DATASET, MERGED_ROW_GROUP_SIZE
+from variable_schema import apply_schema
+from variable_typing import *
+
+# Rows are sorted by the cohort key within each year, so that the row-group min/max
+# statistics of the matching variables (BIRTH_YEAR first) are tight
+MERGED_SORT_KEY = MATCHING_VARS
+
+def get_month_file(dataset_dir: Path, month: str) -> Path:
+    """
+    Get the file of a month in its DATA_YEAR partition (hive style, e.g. DATA_YEAR=1994/cps_199401.parquet).
+    """
+    return dataset_dir / f"{DATA_YEAR}={month[:4]}" / f"cps_{month}.parquet"
+
+def list_merged_months(dataset_dir: Path = CPS_DATA_MERGED_DATASET) -> List[str]:
+    """
+    List the months stored in the dataset, from the file names only.
+    """
+    return sorted(file.stem.split("_")[-1] for file in dataset_dir.glob(f"{DATA_YEAR}=*/cps_*.parquet"))
+
+def write_month(data_df: pd.DataFrame, month: str, dataset_dir: Path = CPS_DATA_MERGED_DATASET,
+                row_group_size: int = MERGED_ROW_GROUP_SIZE, inputs: Optional[List[Path]] = None) -> None:
+    """
+    Write (or replace) the rows of a month in its DATA_YEAR partition. The file is written
+    to a temporary file and then renamed, so readers never see a partially written month.
+
+    Args:
+        data_df (pd.DataFrame): The merged data of the month, with the schema dtypes.
+        month (str): The month, "YYYYMM".
+        dataset_dir (Path): The dataset directory.
+        row_group_size (int): The number of rows per row group.
+        inputs (Optional[List[Path]]): The input files of the month, recorded in its completion marker.
+    """
+    data_df = data_df.sort_values(MERGED_SORT_KEY, kind="stable").drop(columns=DATA_YEAR)
+    table = pa.Table.from_pandas(data_df, preserve_index=False)
+    with atomic_output(get_month_file(dataset_dir, month), inputs) as temp_file:
+        pq.write_table(table, temp_file, row_group_size=row_group_size, write_statistics=True)
+
+def is_month_merged(month: str, inputs: List[Path], dataset_dir: Path = CPS_DATA_MERGED_DATASET) -> bool:
+    """
+    Check whether a month was completely written from the same input files.
+    """
+    return is_complete(get_month_file(dataset_dir, month), inputs)
+
+def remove_stale_months(months: List[str], dataset_dir: Path = CPS_DATA_MERGED_DATASET) -> None:
+    """
+    Delete the files of the months that are not in a list (and the empty partitions).
+    """
+    month_files = {get_month_file(dataset_dir, month) for month in months}
+    for file in dataset_dir.glob(f"{DATA_YEAR}=*/*.parquet"):
+        if file not in month_files:
+            file.unlink()
+            get_marker_file(file).unlink(missing_ok=True)
+    for partition_dir in dataset_dir.glob(f"{DATA_YEAR}=*"):
+        if not any(file.suffix == ".parquet" for file in partition_dir.iterdir()):
+            for file in partition_dir.iterdir():
+                file.unlink()
+            partition_dir.rmdir()
+
+def write_merged_dataset(month_dfs: Dict[str, pd.DataFrame], dataset_dir: Path = CPS_DATA_MERGED_DATASET,
+                         row_group_size: int = MERGED_ROW_GROUP_SIZE) -> None:
+    """
+    Write the merged data as a dataset partitioned by DATA_YEAR (one file per month),
+    dropping the files of the months that are no longer present.
+
+    Args:
+        month_dfs (Dict[str, pd.DataFrame]): The merged data of each month, with the schema dtypes.
+        dataset_dir (Path): The dataset directory.
+        row_group_size (int): The number of rows per row group.
+    """
+    for month, data_df in month_dfs.items():
+        write_month(data_df, month, dataset_dir, row_group_size)
+    remove_stale_months(list(month_dfs), dataset_dir)
+
+def parse_cohort_component(value: str) -> Optional[int]:
+    """
+    Parse a component of a COHORT_ID as an integer ("1970" or "1970.0"), or None if it is not one.
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return int(number) if number.is_integer() else None
+
+def build_filter_expression(filters: Optional[Dict]) -> Optional[ds.Expression]:
+    """
+    Build a pyarrow filter expression from a dictionary of filters. Each value can be a
+    scalar (equality), a list or set (membership) or a (low, high) tuple (inclusive range,
+    None for an open bound), e.g. {DATA_YEAR: (2000, 2010), STATE: [11, 12], GENDER: 2}.
+    """
+    if not filters:
+        return None
+    filters = dict(filters)
+    if isinstance(filters.get(COHORT_ID), (str, list, set)):
+        # COHORT_ID has no usable statistics, so the cohorts are also matched on their components
+        # ("1970" or "1970.0" when the matching variables were floats; a component that is not
+        # an integer, e.g. "nan", is only matched through COHORT_ID)
+        cohort_ids = [filters[COHORT_ID]] if isinstance(filters[COHORT_ID], str) else list(filters[COHORT_ID])
+        components = list(zip(*[cohort_id.split("_") for cohort_id in cohort_ids]))
+        for var, values in zip(MATCHING_VARS, components):
+            values = {parse_cohort_component(value) for value in values}
+            if None in values:
+                continue
+            values = sorted(values)
+            filters.setdefault(var, values[0] if len(values) == 1 else values)
+    expression = None
+    for var, value in filters.items():
+        field = ds.field(var)
+        if isinstance(value, tuple):
+            low, high = value
+            condition = None
+            if low is not None:
+                condition = field >= low
+            if high is not None:
+                condition = (field <= high) if condition is None else condition & (field <= high)
+            if condition is None:
+                continue
+        elif isinstance(value, (list, set)):
+            condition = field.isin(list(value))
+        else:
+            condition = field == value
+        expression = condition if expression is None else expression & condition
+    return expression
+
+def get_dataset(dataset_dir: Path = CPS_DATA_MERGED_DATASET) -> ds.Dataset:
+    """
+    Open the merged dataset (the DATA_YEAR column comes from the partition directories).
+    """
+    if not dataset_dir.exists():
+        raise FileNotFoundError(f"Merged dataset not found: {dataset_dir}")
+    partitioning = ds.partitioning(pa.schema([(DATA_YEAR, pa.int16())]), flavor="hive")
+    return ds.dataset(dataset_dir, format="parquet", partitioning=partitioning)
+
+def get_dataset_ranges(dataset: ds.Dataset, columns: List[str]) -> Dict[str, Tuple]:
+    """
+    Get the minimum and maximum of columns of a Parquet dataset from the row-group statistics
+    (no data is read), or None for a column without statistics.
+    """
+    ranges = {col: [None, None] for col in columns}
+    for fragment in dataset.get_fragments():
+        for row_group in fragment.row_groups:
+            for col in columns:
+                col_stats = (row_group.statistics or {}).get(col)
+                if col_stats is None or ranges[col] is None:
+                    ranges[col] = None
+                    continue
+                low, high = ranges[col]
+                ranges[col] = [col_stats["min"] if low is None else min(low, col_stats["min"]),
+                               col_stats["max"] if high is None else max(high, col_stats["max"])]
+    return {col: tuple(value) if value is not None else None for col, value in ranges.items()}
+
+def read_merged_dataset(filters: Optional[Dict] = None, columns: Optional[List[str]] = None,
+                        dataset_dir: Path = CPS_DATA_MERGED_DATASET) -> pd.DataFrame:
+    """
+    Read the rows of the merged dataset that match the filters. Partitions whose DATA_YEAR
+    does not match are not opened, and row groups are skipped using their min/max statistics.
+
+    Args:
+        filters (Optional[Dict]): The filters (see build_filter_expression).
+        columns (Optional[List[str]]): The columns to read (all if None).
+        dataset_dir (Path): The dataset directory.
+
+    Returns:
+        pd.DataFrame: The matching rows, with the schema dtypes.
+    """
+    dataset = get_dataset(dataset_dir)
+    table = dataset.to_table(columns=columns, filter=build_filter_expression(filters))
+    data_df = apply_schema(table.to_pandas())
+    if columns is None:
+        columns = [col for col in NEEDED_VARS if col in data_df.columns]
+        columns += [col for col in data_df.columns if col not in columns]
+    return data_df[columns]
+
+def read_merged_month(month: str, dataset_dir: Path = CPS_DATA_MERGED_DATASET) -> pd.DataFrame:
+    """
+    Read the rows of a single month of the merged dataset.
+    """
+    data_df = pq.read_table(get_month_file(dataset_dir, month)).to_pandas()
+    data_df[DATA_YEAR] = int(month[:4])
+    return apply_schema(data_df)[NEEDED_VARS]
+
+def count_scanned_row_groups(filters: Optional[Dict] = None,
+                             dataset_dir: Path = CPS_DATA_MERGED_DATASET) -> Tuple[int, int]:
+    """
+    Count the row groups a filtered read has to scan, against the total number of row groups.
+    """
+    dataset = get_dataset(dataset_dir)
+    expression = build_filter_expression(filters)
+    total = sum(fragment.metadata.num_row_groups for fragment in dataset.get_fragments())
+    if expression is None:
+        return total, total
+    scanned = sum(len(fragment.split_by_row_group(expression, schema=dataset.schema))
+                  for fragment in dataset.get_fragments(filter=expression))
+    return scanned, total
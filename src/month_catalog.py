@@ -0,0 +1,216 @@
+from pathlib import Path
+from typing import Dict, List, Optional
+from bisect import bisect_right
+import hashlib
+import json
+import os
+from config import (CPS_DATA_CATALOG, CPS_SAMPLE_MONTHS, CPS_DATA_GZ_DIR, CPS_DATA_BLOCKS_DIR, CPS_DATA_CSV_DIR, CPS_DATA_HOUSEHOLD_DIR,
+                    CPS_DATA_CLEANED_DIR, CPS_DATA_CHILD_DIR, CPS_DICT_STARTTIME_LIST)
+
+# Directory and file suffix of each catalogued artifact, in pipeline order
+CATALOG_STAGES = {
+    "gz": (CPS_DATA_GZ_DIR, ".gz"), # raw downloads
+    "blocks": (CPS_DATA_BLOCKS_DIR, ".blk"), # fixed-width records recompressed in blocks (see block_archive.py)
+    "csv": (CPS_DATA_CSV_DIR, ".csv"), # decoded by prep_02 (person table)
+    "households": (CPS_DATA_HOUSEHOLD_DIR, ".csv"), # decoded by prep_02 (household table)
+    "cleaned": (CPS_DATA_CLEANED_DIR, ".csv"), # cleaned by prep_03
+    "child": (CPS_DATA_CHILD_DIR, ".csv"), # family variables added by prep_04
+}
+
+# Dictionary lookup index: the start months of the dictionary epochs, sorted once
+DICT_EPOCHS = sorted(CPS_DICT_STARTTIME_LIST)
+
+def get_dict_epoch(month: str, epochs: List[str] = DICT_EPOCHS) -> str:
+    """
+    Find the dictionary epoch (start month of the record layout) of a data month.
+
+    Parameters:
+        month (str): The data month, "YYYYMM".
+        epochs (List[str]): The sorted start months of the dictionaries.
+
+    Returns:
+        str: The start month of the corresponding dictionary.
+    """
+    index = bisect_right(epochs, month)
+    if index == 0:
+        raise ValueError(f"No dictionary epoch found for {month}")
+    return epochs[index - 1]
+
+def get_month(file: Path) -> Optional[str]:
+    """
+    Get the month ("YYYYMM") of a data file, e.g. cps_199401.csv, or None for other files.
+    """
+    month = file.name.split(".")[0].split("_")[-1]
+    return month if len(month) == 6 and month.isdigit() else None
+
+def parse_month_spec(spec: str) -> List[List[str]]:
+    """
+    Parse a list of months and month ranges, e.g. "199401-199412,200001", into inclusive
+    [first, last] ranges (an empty list for an empty spec, i.e. all months).
+    """
+    ranges = []
+    for item in filter(None, (item.strip() for item in spec.split(","))):
+        first, _, last = item.partition("-")
+        for month in [first, last or first]:
+            if len(month) != 6 or not month.isdigit():
+                raise ValueError(f"Invalid month {month!r} in {spec!r} (expected YYYYMM or YYYYMM-YYYYMM)")
+        ranges.append([first, last or first])
+    return ranges
+
+def is_sampled_month(month: str, spec: str = CPS_SAMPLE_MONTHS) -> bool:
+    """
+    Check whether a month is processed in the current run (all months unless a sample
+    month spec is set).
+    """
+    ranges = parse_month_spec(spec)
+    return not ranges or any(first <= month <= last for first, last in ranges)
+
+def scan_file(file: Path, stage: str) -> Dict:
+    """
+    Read a file once to compute its checksum, row count and record length (the row count and
+    record length of a block archive come from its index).
+
+    Parameters:
+        file (Path): The path to the file.
+        stage (str): The catalog stage of the file.
+
+    Returns:
+        Dict: The artifact entry (file name, bytes, mtime_ns, sha256, rows, record_length).
+    """
+    stat = file.stat()
+    sha256 = hashlib.sha256()
+    num_newlines, last_byte = 0, b""
+    with open(file, "rb") as f:
+        while True:
+            chunk = f.read(1 << 23)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            if stage not in ["gz", "blocks"]:
+                num_newlines += chunk.count(b"\n")
+            last_byte = chunk[-1:]
+
+    entry = {"file": file.name, "bytes": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+             "sha256": sha256.hexdigest(), "rows": None, "record_length": None}
+    if stage == "blocks":
+        from block_archive import read_index # imported here, as it loads numpy (the pipeline status does not)
+        index = read_index(file)
+        entry["rows"], entry["record_length"] = index["rows"], index["record_length"]
+    elif stage != "gz" and stat.st_size > 0:
+        entry["rows"] = num_newlines + (last_byte != b"\n") - 1 # header line
+    return entry
+
+def load_catalog(catalog_file: Path = CPS_DATA_CATALOG) -> Dict[str, Dict]:
+    """
+    Load the month catalog (an empty one if it does not exist yet).
+    """
+    if not catalog_file.exists():
+        return {}
+    return json.loads(catalog_file.read_text())
+
+def save_catalog(catalog: Dict[str, Dict], catalog_file: Path = CPS_DATA_CATALOG) -> None:
+    """
+    Save the month catalog, replacing the old one atomically.
+    """
+    catalog_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = catalog_file.with_name(f"{catalog_file.name}.{os.getpid()}.tmp") # workers on several hosts may save it at once
+    temp_file.write_text(json.dumps(dict(sorted(catalog.items())), indent=1))
+    os.replace(temp_file, catalog_file)
+
+def update_catalog(catalog: Dict[str, Dict], stages: Optional[List[str]] = None) -> Dict[str, Dict]:
+    """
+    Bring the catalog up to date with the files on disk. Only new or modified files
+    (different size or modification time) are read again.
+
+    Parameters:
+        catalog (Dict[str, Dict]): The month catalog.
+        stages (Optional[List[str]]): The stages to scan (all stages by default).
+
+    Returns:
+        Dict[str, Dict]: The updated month catalog.
+    """
+    for stage in stages or list(CATALOG_STAGES.keys()):
+        stage_dir, suffix = CATALOG_STAGES[stage]
+        found_months = set()
+        if stage_dir.exists():
+            for dir_entry in os.scandir(stage_dir):
+                file = Path(dir_entry.path)
+                month = get_month(file)
+                if month is None or not dir_entry.is_file() or file.suffix != suffix or not is_sampled_month(month):
+                    continue
+                found_months.add(month)
+                month_entry = catalog.setdefault(month, {"month": month, "dict_epoch": get_dict_epoch(month),
+                                                         "record_length": None, "artifacts": {}})
+                artifact = month_entry["artifacts"].get(stage)
+                stat = dir_entry.stat()
+                if artifact is None or artifact["bytes"] != stat.st_size or artifact["mtime_ns"] != stat.st_mtime_ns:
+                    artifact = scan_file(file, stage)
+                    month_entry["artifacts"][stage] = artifact
+                if artifact["record_length"] is not None:
+                    month_entry["record_length"] = artifact["record_length"]
+
+        # Forget artifacts that have been deleted
+        for month_entry in catalog.values():
+            if stage in month_entry["artifacts"] and month_entry["month"] not in found_months:
+                del month_entry["artifacts"][stage]
+
+    # Forget the artifacts of retired stages (e.g. the extracted fixed-width files)
+    for month_entry in catalog.values():
+        for stage in set(month_entry["artifacts"]) - set(CATALOG_STAGES):
+            del month_entry["artifacts"][stage]
+
+    return catalog
+
+def refresh_catalog(stages: Optional[List[str]] = None, catalog_file: Path = CPS_DATA_CATALOG) -> Dict[str, Dict]:
+    """
+    Load, update and save the month catalog.
+    """
+    catalog = update_catalog(load_catalog(catalog_file), stages)
+    save_catalog(catalog, catalog_file)
+    return catalog
+
+def get_month_files(catalog: Dict[str, Dict], stage: str) -> List[Path]:
+    """
+    Get the files of a stage, sorted by month.
+    """
+    stage_dir = CATALOG_STAGES[stage][0]
+    return [stage_dir / catalog[month]["artifacts"][stage]["file"]
+            for month in sorted(catalog) if stage in catalog[month]["artifacts"]]
+
+def get_file_sha256(file: Path, catalog_file: Path = CPS_DATA_CATALOG) -> str:
+    """
+    Get the SHA-256 checksum of a monthly file from the catalog when its entry is up to date
+    (same size and modification time), or compute it.
+    """
+    stat = file.stat()
+    month_entry = load_catalog(catalog_file).get(get_month(file), {"artifacts": {}})
+    for stage, artifact in month_entry["artifacts"].items():
+        if (CATALOG_STAGES[stage][0] == file.parent and artifact["file"] == file.name and
+                artifact["bytes"] == stat.st_size and artifact["mtime_ns"] == stat.st_mtime_ns):
+            return artifact["sha256"]
+    sha256 = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 23), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def count_observations(catalog: Dict[str, Dict], stage: str = "cleaned") -> int:
+    """
+    Count the observations of a stage from the catalog metadata (no data file is read).
+    """
+    return sum(month_entry["artifacts"][stage]["rows"] or 0
+               for month_entry in catalog.values() if stage in month_entry["artifacts"])
+
+def main() -> None:
+    """
+    Refresh the catalog and summarize every stage.
+    """
+    catalog = refresh_catalog()
+    for stage in CATALOG_STAGES:
+        entries = [month_entry["artifacts"][stage] for month_entry in catalog.values() if stage in month_entry["artifacts"]]
+        num_bytes = sum(entry["bytes"] for entry in entries)
+        rows = count_observations(catalog, stage) if stage != "gz" else "n/a"
+        print(f"{stage}: {len(entries)} months, {rows} observations, {num_bytes / 1e9:.2f} GB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+from config import (CPS_DATA_GZ_DIR, CPS_DATA_BLOCKS_DIR, CPS_DATA_QUEUE_DIR, CPS_SAMPLE_MONTHS,
+                    QUEUE_LEASE_SECONDS, QUEUE_MAX_ATTEMPTS)
+from month_catalog import get_month, is_sampled_month
+
+# Work queue of the per-month stages (archive, decode, clean, family variables) on a shared
+# filesystem, for workers on one or several hosts and no service to run. The queue is the
+# set of downloaded months; its state is a directory of small files:
+#   cps_YYYYMM.lease.N   claim number N of the month, created with O_CREAT | O_EXCL so that
+#                        exactly one worker wins it; its holder renews its modification
+#                        time while it works (the lease expires QUEUE_LEASE_SECONDS later)
+#   cps_YYYYMM.failed.N  the error of claim N
+#   cps_YYYYMM.done      the completion record (worker, claim, duration)
+# A month whose last claim failed or expired (dead worker) is claimed again with the next
+# number, up to QUEUE_MAX_ATTEMPTS claims. A slow worker whose lease was taken over may
+# finish the month too, which is harmless: the outputs are written atomically and the
+# steps skip the complete ones (see atomic_io.py). Expiry compares the modification times
+# set by the file server with the clock of the worker, so the hosts' clocks should agree
+# within a small fraction of the lease.
+LEASE_SUFFIX = ".lease"
+FAILED_SUFFIX = ".failed"
+DONE_SUFFIX = ".done"
+POLL_SECONDS = 5
+STATES = ["done", "leased", "pending", "retry", "failed"]
+
+def get_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def list_queue_months(spec: str = CPS_SAMPLE_MONTHS) -> List[str]:
+    """
+    List the months of the queue: the downloaded or archived months (of the sample run).
+    """
+    months = {get_month(file) for data_dir in [CPS_DATA_GZ_DIR, CPS_DATA_BLOCKS_DIR] if data_dir.exists()
+              for file in data_dir.iterdir()}
+    return sorted(month for month in months if month is not None and is_sampled_month(month, spec))
+
+def get_lease_file(queue_dir: Path, month: str, attempt: int) -> Path:
+    return queue_dir / f"cps_{month}{LEASE_SUFFIX}.{attempt}"
+
+def get_failed_file(queue_dir: Path, month: str, attempt: int) -> Path:
+    return queue_dir / f"cps_{month}{FAILED_SUFFIX}.{attempt}"
+
+def get_done_file(queue_dir: Path, month: str) -> Path:
+    return queue_dir / f"cps_{month}{DONE_SUFFIX}"
+
+def get_attempts(queue_dir: Path, month: str) -> List[int]:
+    """
+    Get the claim numbers of a month, in order.
+    """
+    return sorted(int(file.name.rsplit(".", 1)[1]) for file in queue_dir.glob(f"cps_{month}{LEASE_SUFFIX}.*")
+                  if file.name.rsplit(".", 1)[1].isdigit())
+
+def is_expired(lease_file: Path, lease_seconds: float = QUEUE_LEASE_SECONDS) -> bool:
+    try:
+        return lease_file.stat().st_mtime + lease_seconds < time.time()
+    except FileNotFoundError:
+        return True
+
+def get_month_state(queue_dir: Path, month: str, lease_seconds: float = QUEUE_LEASE_SECONDS,
+                    max_attempts: int = QUEUE_MAX_ATTEMPTS, attempts: Optional[List[int]] = None) -> str:
+    """
+    Get the state of a month in the queue: "done", "leased" (a live worker holds it),
+    "pending" (never claimed), "retry" (its last claim failed or expired) or "failed" (no
+    claim left). The claim numbers can be passed if already listed.
+    """
+    if get_done_file(queue_dir, month).exists():
+        return "done"
+    attempts = get_attempts(queue_dir, month) if attempts is None else attempts
+    if not attempts:
+        return "pending"
+    last = attempts[-1]
+    if get_failed_file(queue_dir, month, last).exists() or is_expired(get_lease_file(queue_dir, month, last), lease_seconds):
+        return "failed" if last >= max_attempts else "retry"
+    return "leased"
+
+def get_queue_status(months: List[str], queue_dir: Path = CPS_DATA_QUEUE_DIR, lease_seconds: float = QUEUE_LEASE_SECONDS,
+                     max_attempts: int = QUEUE_MAX_ATTEMPTS) -> Dict[str, List[str]]:
+    """
+    Group the months of the queue by state.
+    """
+    status = {state: [] for state in STATES}
+    for month in months:
+        status[get_month_state(queue_dir, month, lease_seconds, max_attempts)].append(month)
+    return status
+
+def write_record(record_file: Path, record: Dict) -> None:
+    """
+    Write a status record atomically (several workers may write the same record).
+    """
+    temp_file = record_file.with_name(f".{record_file.name}.{os.getpid()}.tmp")
+    temp_file.write_text(json.dumps(record))
+    os.replace(temp_file, record_file)
+
+def claim_month(months: List[str], worker_id: str, queue_dir: Path = CPS_DATA_QUEUE_DIR,
+                lease_seconds: float = QUEUE_LEASE_SECONDS, max_attempts: int = QUEUE_MAX_ATTEMPTS) -> Optional[Tuple[str, int]]:
+    """
+    Claim the first month that is pending or to retry, by creating its next lease file
+    (the other workers trying the same claim fail to create it and move on).
+
+    Args:
+        months (List[str]): The months of the queue.
+        worker_id (str): The claiming worker, recorded in the lease.
+        queue_dir (Path): The queue directory.
+        lease_seconds (float): The lease duration.
+        max_attempts (int): The claims allowed per month.
+
+    Returns:
+        Optional[Tuple[str, int]]: The month and the claim number, or None if no month can be claimed.
+    """
+    queue_dir.mkdir(parents=True, exist_ok=True)
+    for month in months:
+        # The claim follows the state it was decided on: if another worker claimed the month
+        # in the meantime, the lease file exists and the claim fails
+        attempts = get_attempts(queue_dir, month)
+        if get_month_state(queue_dir, month, lease_seconds, max_attempts, attempts) not in ["pending", "retry"]:
+            continue
+        attempt = max(attempts, default=0) + 1
+        try:
+            fd = os.open(get_lease_file(queue_dir, month, attempt), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": worker_id, "claimed": time.time()}, f)
+        return month, attempt
+    return None
+
+def renew_lease(lease_file: Path, next_lease_file: Path, interval: float, stop: threading.Event, lost: threading.Event) -> None:
+    """
+    Renew a lease every interval seconds until stop is set, or until the next claim of the
+    month exists (the lease expired and was taken over).
+    """
+    while not stop.wait(interval):
+        if next_lease_file.exists():
+            lost.set()
+            return
+        os.utime(lease_file)
+
+def run_claimed_month(month: str, attempt: int, worker_id: str, process: Callable[[str], object],
+                      queue_dir: Path = CPS_DATA_QUEUE_DIR, lease_seconds: float = QUEUE_LEASE_SECONDS) -> bool:
+    """
+    Process a claimed month while renewing its lease in a background thread, and record the
+    outcome. A failure releases the lease at once, so that the month is retried without
+    waiting for the lease to expire.
+
+    Returns:
+        bool: Whether the month was processed.
+    """
+    lease_file = get_lease_file(queue_dir, month, attempt)
+    stop, lost = threading.Event(), threading.Event()
+    renewer = threading.Thread(target=renew_lease, daemon=True,
+                               args=(lease_file, get_lease_file(queue_dir, month, attempt + 1), lease_seconds / 3, stop, lost))
+    renewer.start()
+    start = time.time()
+    try:
+        process(month)
+    except Exception as e:
+        write_record(get_failed_file(queue_dir, month, attempt),
+                     {"worker": worker_id, "error": repr(e), "traceback": traceback.format_exc()})
+        os.utime(lease_file, (0, 0)) # expired
+        print(f"{worker_id}: {month} failed (claim {attempt}): {e!r}")
+        return False
+    finally:
+        stop.set()
+        renewer.join()
+    if lost.is_set():
+        print(f"{worker_id}: the lease of {month} expired while it was processed, another worker claimed it too")
+    write_record(get_done_file(queue_dir, month), {"worker": worker_id, "attempt": attempt,
+                                                    "seconds": round(time.time() - start, 3), "finished": time.time()})
+    print(f"{worker_id}: {month} done in {time.time() - start:.1f} s (claim {attempt})")
+    return True
+
+def run_worker(months: Optional[List[str]] = None, queue_dir: Path = CPS_DATA_QUEUE_DIR,
+               lease_seconds: float = QUEUE_LEASE_SECONDS, max_attempts: int = QUEUE_MAX_ATTEMPTS,
+               poll_seconds: float = POLL_SECONDS, process: Optional[Callable[[str], object]] = None) -> int:
+    """
+    Claim and process months until none is left to claim and no other worker holds one
+    (a month held by another worker may still need a retry if that worker dies).
+
+    Args:
+        months (Optional[List[str]]): The months of the queue (list_queue_months by default).
+        queue_dir (Path): The queue directory, on the filesystem shared by the workers.
+        lease_seconds (float): The lease duration.
+        max_attempts (int): The claims allowed per month.
+        poll_seconds (float): The wait between two claims when every month left is leased.
+        process (Optional[Callable[[str], object]]): The per-month work (build_month_files
+            of update_months.py by default).
+
+    Returns:
+        int: The number of months processed by this worker.
+    """
+    if process is None:
+        from update_months import build_month_files # imports the stage modules
+        process = build_month_files
+    months = list_queue_months() if months is None else months
+    worker_id = get_worker_id()
+    num_processed = 0
+    while True:
+        claim = claim_month(months, worker_id, queue_dir, lease_seconds, max_attempts)
+        if claim is None:
+            if not get_queue_status(months, queue_dir, lease_seconds, max_attempts)["leased"]:
+                return num_processed
+            time.sleep(poll_seconds)
+            continue
+        num_processed += run_claimed_month(*claim, worker_id, process, queue_dir, lease_seconds)
+
+def run_local_workers(num_workers: int, months: Optional[List[str]] = None) -> Dict[str, List[str]]:
+    """
+    Run workers in local processes (the other hosts run month_queue.py worker on the same
+    shared directories), then update the month catalog and print the queue status.
+    """
+    months = list_queue_months() if months is None else months
+    if num_workers <= 1:
+        run_worker(months)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for future in [executor.submit(run_worker, months) for _ in range(num_workers)]:
+                future.result()
+    from month_catalog import refresh_catalog
+    from derived_cache import evict_results
+    evict_results() # once, after the workers (see derived_cache.py)
+    refresh_catalog(["blocks", "csv", "households", "cleaned", "child"])
+    return print_queue_status(months)
+
+def print_queue_status(months: List[str], queue_dir: Path = CPS_DATA_QUEUE_DIR) -> Dict[str, List[str]]:
+    status = get_queue_status(months, queue_dir)
+    print(", ".join(f"{len(status[state])} {state}" for state in STATES) + f" ({len(months)} months)")
+    for month in status["failed"]:
+        failed_file = get_failed_file(queue_dir, month, get_attempts(queue_dir, month)[-1])
+        error = json.loads(failed_file.read_text())["error"] if failed_file.exists() else "lease expired"
+        print(f"  {month} failed: {error}")
+    return status
+
+def reset_queue(months: List[str], queue_dir: Path = CPS_DATA_QUEUE_DIR, failed_only: bool = False) -> None:
+    """
+    Forget the claims and records of months (only of the failed ones with failed_only), so
+    that they are processed again. The outputs are not deleted: the steps still skip the
+    complete ones.
+    """
+    status = get_queue_status(months, queue_dir)
+    for month in status["failed"] if failed_only else months:
+        for file in queue_dir.glob(f"cps_{month}.*"):
+            file.unlink(missing_ok=True)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Process the months on several workers through a shared-filesystem queue.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    worker_parser = subparsers.add_parser("worker", help="claim and process months until the queue is empty")
+    worker_parser.add_argument("--workers", type=int, default=1, help="worker processes on this host")
+    subparsers.add_parser("status", help="count the months by state")
+    reset_parser = subparsers.add_parser("reset", help="forget the claims and records of the months")
+    reset_parser.add_argument("--failed-only", action="store_true", help="only reset the failed months")
+    args = parser.parse_args()
+
+    months = list_queue_months()
+    if args.command == "worker":
+        run_local_workers(args.workers, months)
+    elif args.command == "status":
+        print_queue_status(months)
+    else:
+        reset_queue(months, failed_only=args.failed_only)
+
+if __name__ == "__main__":
+    main()
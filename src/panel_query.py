@@ -0,0 +1,189 @@
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+import argparse
+import sqlite3
+import pandas as pd
+from config import CPS_DATA_MERGED_DATASET
+from merged_dataset import read_merged_dataset
+from prep_06_construct_pseudo_panel import NON_PARENT_EVENT_TIMES
+from variable_typing import *
+
+try: # DuckDB is optional, the data is loaded into an in-memory SQLite database as a fallback
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# The pseudo panel is a view: the parents of the matched cohorts, and the non-parents joined
+# with the event-time table (one row per potential event time), so it is never materialized.
+EVENT_TIME = "EVENT_TIME"
+SQLITE_CHUNK_ROWS = 100000
+
+Connection = Union["duckdb.DuckDBPyConnection", sqlite3.Connection]
+
+def create_merged_view(con: Connection, dataset_dir: Path, columns: List[str]) -> None:
+    """
+    Register the merged dataset as "merged": a view over the Parquet files with DuckDB (the
+    filters and columns of a query are pushed down to the files), or a table with SQLite.
+    """
+    if isinstance(con, sqlite3.Connection):
+        data_df = read_merged_dataset(columns=columns, dataset_dir=dataset_dir)
+        data_df[COHORT_ID] = data_df[COHORT_ID].astype(str)
+        data_df.to_sql("merged", con, index=False, chunksize=SQLITE_CHUNK_ROWS)
+        con.execute(f"CREATE INDEX merged_cohort ON merged ({COHORT_ID})")
+        return
+    files = str(dataset_dir / "*" / "*.parquet").replace("'", "''")
+    con.execute(f"CREATE VIEW merged AS SELECT {', '.join(columns)} "
+                f"FROM read_parquet('{files}', hive_partitioning = true)")
+
+def create_pseudo_panel_view(con: Connection, columns: List[str]) -> None:
+    """
+    Register the matched cohorts, the event-time table of the non-parents and the pseudo
+    panel ("pseudo_panel", with the rows of prep_06 without replicating them).
+    """
+    con.execute(f"CREATE TABLE non_parent_event_times ({EVENT_TIME} INTEGER)")
+    con.executemany("INSERT INTO non_parent_event_times VALUES (?)", [(t,) for t in NON_PARENT_EVENT_TIMES])
+    con.execute(f"""
+        CREATE VIEW matched_cohorts AS
+        SELECT {COHORT_ID} FROM merged GROUP BY {COHORT_ID}
+        HAVING SUM(CASE WHEN {HAS_CHILD} = 1 THEN 1 ELSE 0 END) > 0
+           AND SUM(CASE WHEN {HAS_CHILD} = 0 THEN 1 ELSE 0 END) > 0""")
+    parent_columns = ", ".join(f"m.{col}" for col in columns)
+    non_parent_columns = ", ".join(f"e.{EVENT_TIME} AS {col}" if col == AGE_OF_OLDEST_CHILD else f"m.{col}"
+                                   for col in columns)
+    con.execute(f"""
+        CREATE VIEW pseudo_panel AS
+        SELECT {parent_columns} FROM merged m
+        WHERE m.{AGE_OF_OLDEST_CHILD} >= 0 AND m.{COHORT_ID} IN (SELECT {COHORT_ID} FROM matched_cohorts)
+        UNION ALL
+        SELECT {non_parent_columns} FROM merged m CROSS JOIN non_parent_event_times e
+        WHERE m.{AGE_OF_OLDEST_CHILD} = -1 AND m.{COHORT_ID} IN (SELECT {COHORT_ID} FROM matched_cohorts)""")
+
+def connect(dataset_dir: Path = CPS_DATA_MERGED_DATASET, columns: List[str] = NEEDED_VARS,
+            engine: Optional[str] = None) -> Connection:
+    """
+    Open an in-process database with the views "merged", "matched_cohorts" and "pseudo_panel".
+
+    Args:
+        dataset_dir (Path): The merged dataset directory.
+        columns (List[str]): The columns of the views (COHORT_ID, HAS_CHILD and
+            AGE_OF_OLDEST_CHILD are needed for the pseudo panel).
+        engine (Optional[str]): "duckdb" or "sqlite" (DuckDB when it is installed by default).
+
+    Returns:
+        Connection: The database connection.
+    """
+    engine = engine or ("duckdb" if duckdb is not None else "sqlite")
+    if engine == "duckdb":
+        if duckdb is None:
+            raise ImportError("DuckDB is not installed (pip install duckdb), use engine='sqlite'.")
+        con = duckdb.connect()
+    elif engine == "sqlite":
+        con = sqlite3.connect(":memory:")
+    else:
+        raise ValueError(f"Unknown query engine: {engine}")
+    create_merged_view(con, dataset_dir, columns)
+    create_pseudo_panel_view(con, columns)
+    return con
+
+def run_query(con: Connection, sql: str, params: Optional[List] = None) -> pd.DataFrame:
+    """
+    Run a query with positional parameters ("?") and return the result as a DataFrame.
+    """
+    if isinstance(con, sqlite3.Connection):
+        return pd.read_sql_query(sql, con, params=params or [])
+    return con.execute(sql, params or []).df()
+
+def check_columns(columns: List[str]) -> None:
+    """
+    Only known variables can be used as identifiers in the queries (values are parameters).
+    """
+    unknown = [col for col in columns if col not in NEEDED_VARS]
+    if unknown:
+        raise ValueError(f"Unknown variables: {unknown}")
+
+def build_where_clause(filters: Optional[Dict]) -> Tuple[str, List]:
+    """
+    Build a WHERE clause and its parameters from a dictionary of filters, as in
+    merged_dataset.build_filter_expression: a scalar (equality), a list or set (membership)
+    or a (low, high) tuple (inclusive range, None for an open bound).
+    """
+    conditions, params = [], []
+    check_columns(list(filters or {}))
+    for var, value in (filters or {}).items():
+        if isinstance(value, tuple):
+            low, high = value
+            if low is not None:
+                conditions.append(f"{var} >= ?")
+                params.append(low)
+            if high is not None:
+                conditions.append(f"{var} <= ?")
+                params.append(high)
+        elif isinstance(value, (list, set)):
+            value = list(value)
+            conditions.append(f"{var} IN ({', '.join('?' * len(value))})")
+            params += value
+        else:
+            conditions.append(f"{var} = ?")
+            params.append(value)
+    return (" AND ".join(conditions) or "TRUE"), params
+
+def get_event_time_means(con: Connection, target_var: str, filters: Optional[Dict] = None,
+                         by: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Get the number of observations and the mean of a target in the pseudo panel, by event
+    time (the age of the oldest child, negative for the potential observations of
+    non-parents). Negative codes of the target (not in universe, missing) are left out.
+
+    Args:
+        con (Connection): The database connection.
+        target_var (str): The target variable.
+        filters (Optional[Dict]): Filters on the pseudo panel variables, e.g. {DATA_YEAR: (2000, 2010)}.
+        by (Optional[List[str]]): Other grouping variables, e.g. [GENDER].
+
+    Returns:
+        pd.DataFrame: The groups, N and MEAN, sorted by the groups.
+    """
+    by = by or []
+    check_columns([target_var] + by)
+    where, params = build_where_clause(filters)
+    groups = ", ".join(by + [f"{AGE_OF_OLDEST_CHILD} AS {EVENT_TIME}"])
+    order = ", ".join(by + [EVENT_TIME])
+    return run_query(con, f"""
+        SELECT {groups}, COUNT(*) AS N, AVG({target_var}) AS MEAN FROM pseudo_panel
+        WHERE {target_var} >= 0 AND {where}
+        GROUP BY {order} ORDER BY {order}""", params)
+
+def get_cell_means(con: Connection, target_var: str, filters: Optional[Dict] = None) -> pd.DataFrame:
+    """
+    Get the number of observations and the mean of a target in each cohort x event-time cell
+    of the pseudo panel (the cells of event_study.get_cell_means).
+    """
+    check_columns([target_var])
+    where, params = build_where_clause(filters)
+    return run_query(con, f"""
+        SELECT {COHORT_ID}, {AGE_OF_OLDEST_CHILD} AS {EVENT_TIME}, COUNT(*) AS N, AVG({target_var}) AS MEAN
+        FROM pseudo_panel WHERE {target_var} >= 0 AND {where}
+        GROUP BY {COHORT_ID}, {EVENT_TIME} ORDER BY {COHORT_ID}, {EVENT_TIME}""", params)
+
+def count_rows(con: Connection, view: str = "pseudo_panel", filters: Optional[Dict] = None) -> int:
+    """
+    Count the rows of a view that match the filters.
+    """
+    where, params = build_where_clause(filters)
+    return int(run_query(con, f"SELECT COUNT(*) AS N FROM {view} WHERE {where}", params)["N"].iloc[0])
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Event-time means of the target variables in the pseudo panel.")
+    parser.add_argument("--engine", choices=["duckdb", "sqlite"], help="query engine (DuckDB when installed)")
+    parser.add_argument("--years", type=int, nargs=2, metavar=("FIRST", "LAST"), help="range of data years")
+    args = parser.parse_args()
+
+    con = connect(engine=args.engine)
+    filters = {DATA_YEAR: tuple(args.years)} if args.years else None
+    print(f"Pseudo panel: {count_rows(con, filters=filters)} rows")
+    for target_var in [TARGET_VAR1, TARGET_VAR2]:
+        print(target_var)
+        print(get_event_time_means(con, target_var, filters).round(3).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
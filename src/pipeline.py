@@ -0,0 +1,221 @@
+import time
+CLI_START = time.perf_counter()
+
+from pathlib import Path
+from typing import Dict, List, Optional
+import argparse
+import importlib
+import json
+import os
+import sys
+from config import (ROOT_DIR, SRC_DIR, IS_SAMPLE_RUN, SAMPLE_DIR, CPS_DICT_CSV_LIST, CPS_DATA_GZ_DIR, CPS_DATA_BLOCKS_DIR, CPS_DATA_CSV_DIR,
+                    CPS_DATA_CLEANED_DIR, CPS_DATA_CHILD_DIR, CPS_DATA_AGE_COUNTS_DIR, CPS_DATA_MERGED_DATASET,
+                    CPS_DATA_PSEUDO_CSV, CPS_DATA_DOWNLOAD_MANIFEST, PLOT_DIR)
+from month_catalog import get_month, is_sampled_month, parse_month_spec
+from atomic_io import get_marker_file
+
+# Only light modules are imported at the top: the stage modules (and pandas) are imported
+# when a stage actually runs, so that "status" and "--dry-run" start instantly.
+STAGE_PREFIXES = ["download_", "prep_", "plot_"]
+HEAVY_MODULES = ["pandas", "numpy", "matplotlib"]
+
+def get_stages() -> Dict[str, str]:
+    """
+    Find the stage scripts in the natural order of run_all_scripts.py, e.g. "prep_02" -> "prep_02_parse_cps_datasets".
+    """
+    stages = {}
+    for prefix in STAGE_PREFIXES:
+        for script in sorted(SRC_DIR.glob(f"{prefix}[0-9][0-9]_*.py")):
+            stages["_".join(script.stem.split("_")[:2])] = script.stem
+    return stages
+
+def list_months(data_dir: Path, suffix: str, complete_only: bool = False) -> set:
+    """
+    List the months available in a directory, from the file names only (with complete_only,
+    only the files with a completion marker, see atomic_io.py).
+    """
+    if not data_dir.exists():
+        return set()
+    names = set(os.listdir(data_dir))
+    return {get_month(Path(name)) for name in names
+            if Path(name).suffix == suffix and get_month(Path(name)) is not None and is_sampled_month(get_month(Path(name)))
+            and (not complete_only or get_marker_file(Path(name)).name in names)}
+
+def get_newest_mtime(data_dir: Path, suffix: str) -> Optional[float]:
+    """
+    Get the newest modification time of the files with a suffix in a directory.
+    """
+    if not data_dir.exists():
+        return None
+    mtimes = [entry.stat().st_mtime for entry in os.scandir(data_dir) if entry.name.endswith(suffix)]
+    return max(mtimes) if mtimes else None
+
+def is_older_than_inputs(output_file: Path, input_dir: Path, suffix: str) -> bool:
+    """
+    Check whether a single-file output is missing or older than its newest input.
+    """
+    newest_input = get_newest_mtime(input_dir, suffix)
+    if not output_file.exists():
+        return newest_input is not None
+    return newest_input is not None and newest_input > output_file.stat().st_mtime
+
+def get_dataset_mtime(dataset_dir: Path) -> Optional[float]:
+    """
+    Get the newest modification time of the partition files of a dataset.
+    """
+    mtimes = [file.stat().st_mtime for file in dataset_dir.glob("*/*.parquet")]
+    return max(mtimes) if mtimes else None
+
+def get_pending_work(stage: str) -> Optional[List[str]]:
+    """
+    Describe the work a stage would do, using file names and timestamps only.
+
+    Args:
+        stage (str): The stage name, e.g. "prep_02".
+
+    Returns:
+        Optional[List[str]]: The pending work items (empty if up to date), or None if unknown.
+    """
+    month_stages = { # stage: (input dir, input suffix, output dir, output suffix)
+        "prep_02": (CPS_DATA_BLOCKS_DIR, ".blk", CPS_DATA_CSV_DIR, ".csv"),
+        "prep_03": (CPS_DATA_CSV_DIR, ".csv", CPS_DATA_CLEANED_DIR, ".csv"),
+        "prep_04": (CPS_DATA_CLEANED_DIR, ".csv", CPS_DATA_CHILD_DIR, ".csv"),
+    }
+    if stage in month_stages:
+        input_dir, input_suffix, output_dir, output_suffix = month_stages[stage]
+        months = list_months(input_dir, input_suffix) - list_months(output_dir, output_suffix, complete_only=True)
+        return sorted(months)
+    if stage == "download_01":
+        manifest = json.loads(CPS_DATA_DOWNLOAD_MANIFEST.read_text()) if CPS_DATA_DOWNLOAD_MANIFEST.exists() else {}
+        known = list_months(CPS_DATA_GZ_DIR, ".gz") | {month for month, entry in manifest.items() if entry["status"] == "missing"}
+        months = {f"{year}{month:02d}" for year in range(1994, 2024 + 1) for month in range(1, 13)
+                  if is_sampled_month(f"{year}{month:02d}")} - known
+        to_archive = list_months(CPS_DATA_GZ_DIR, ".gz") - list_months(CPS_DATA_BLOCKS_DIR, ".blk", complete_only=True)
+        return [f"download {month}" for month in sorted(months)] + [f"archive {month}" for month in sorted(to_archive)]
+    if stage == "prep_01":
+        return [file.stem for file in CPS_DICT_CSV_LIST if not file.exists()]
+    if stage == "prep_05":
+        merged_mtime, newest_input = get_dataset_mtime(CPS_DATA_MERGED_DATASET), get_newest_mtime(CPS_DATA_CHILD_DIR, ".csv")
+        stale = newest_input is not None and (merged_mtime is None or newest_input > merged_mtime)
+        return [CPS_DATA_MERGED_DATASET.name] if stale else []
+    if stage == "prep_06":
+        merged_mtime = get_dataset_mtime(CPS_DATA_MERGED_DATASET)
+        stale = not CPS_DATA_PSEUDO_CSV.exists() or (merged_mtime is not None and
+                merged_mtime > CPS_DATA_PSEUDO_CSV.stat().st_mtime)
+        return [CPS_DATA_PSEUDO_CSV.name] if stale else []
+    if stage == "plot_01":
+        plot_file = PLOT_DIR / "age_distribution_by_year.png"
+        return [plot_file.name] if is_older_than_inputs(plot_file, CPS_DATA_AGE_COUNTS_DIR, ".csv") else []
+    return None
+
+def print_status(stages: List[str]) -> None:
+    """
+    Print what each stage would do, without importing pandas.
+    """
+    for stage in stages:
+        pending = get_pending_work(stage)
+        if pending is None:
+            print(f"{stage}: unknown, would run")
+        elif not pending:
+            print(f"{stage}: up to date")
+        else:
+            shown = ", ".join(pending[:5]) + (f", ... ({len(pending)} in total)" if len(pending) > 5 else "")
+            print(f"{stage}: would process {shown}")
+    imported = [module for module in HEAVY_MODULES if module in sys.modules]
+    print(f"Status computed in {time.perf_counter() - CLI_START:.3f} s "
+          f"({'imported ' + ', '.join(imported) if imported else 'no heavy module imported'})")
+
+def get_process_age() -> Optional[float]:
+    """
+    Get the seconds since the interpreter process started (Linux only, 10 ms resolution).
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+def run_stages(stages: List[str], force: bool = False) -> None:
+    """
+    Run stages in this interpreter, importing each stage module only when it runs, and
+    report the measured startup (import) and run times.
+
+    Args:
+        stages (List[str]): The stage names, in order.
+        force (bool): Run the stages even if they are up to date.
+    """
+    stage_modules = get_stages()
+    timings = []
+    for stage in stages:
+        pending = get_pending_work(stage)
+        if pending == [] and not force:
+            print(f"{stage}: up to date, skipping")
+            continue
+        print(f"Running {stage_modules[stage]}")
+        import_start = time.perf_counter()
+        module = importlib.import_module(stage_modules[stage])
+        run_start = time.perf_counter()
+        module.main()
+        timings.append((stage, run_start - import_start, time.perf_counter() - run_start))
+
+    process_age = get_process_age()
+    cli_startup = time.perf_counter() - CLI_START - sum(import_time + run_time for _, import_time, run_time in timings)
+    if process_age is not None:
+        cli_startup = process_age - sum(import_time + run_time for _, import_time, run_time in timings)
+    print(f"Startup (interpreter and CLI): {cli_startup:.3f} s")
+    for stage, import_time, run_time in timings:
+        print(f"{stage}: import {import_time:.3f} s, run {run_time:.3f} s")
+
+def set_sample_options(sample_fraction: Optional[float], months: Optional[str]) -> None:
+    """
+    Set the sampling mode of the run. The settings are read by config.py at import time, so
+    the process is restarted with them in its environment (inherited by any worker process).
+    """
+    environment = dict(os.environ)
+    if sample_fraction is not None:
+        environment["CPS_SAMPLE_FRACTION"] = str(sample_fraction)
+    if months is not None:
+        parse_month_spec(months) # fail before restarting
+        environment["CPS_SAMPLE_MONTHS"] = months
+    if environment != dict(os.environ):
+        os.execve(sys.executable, [sys.executable] + sys.argv, environment)
+
+def main() -> None:
+    stages = get_stages()
+    parser = argparse.ArgumentParser(description="Run the CPS data preparation pipeline.")
+    parser.add_argument("--sample-fraction", type=float, help="keep this fraction of the households (sample run)")
+    parser.add_argument("--months", help='only process these months, e.g. "199401-199412,200001" (sample run)')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("status", help="show what would run, without importing pandas")
+    update_parser = subparsers.add_parser("update", help="download and process only the months published since the last run")
+    update_parser.add_argument("--dry-run", action="store_true", help="only show the months that would be requested and merged")
+    worker_parser = subparsers.add_parser("worker", help="claim and process months from the shared-filesystem queue (month_queue.py)")
+    worker_parser.add_argument("--workers", type=int, default=1, help="worker processes on this host")
+    for name in ["all"] + list(stages.keys()):
+        help_text = "run all stages in order" if name == "all" else f"run {stages[name]}.py"
+        subparser = subparsers.add_parser(name, help=help_text)
+        subparser.add_argument("--dry-run", action="store_true", help="only show what would run")
+        subparser.add_argument("--force", action="store_true", help="run even if up to date")
+    args = parser.parse_args()
+    set_sample_options(args.sample_fraction, args.months)
+    if IS_SAMPLE_RUN:
+        print(f"Sample run: {SAMPLE_DIR.relative_to(ROOT_DIR)}")
+
+    os.chdir(ROOT_DIR) # same working directory as run_all_scripts.py
+    if args.command == "update":
+        importlib.import_module("update_months").update(dry_run=args.dry_run)
+        return
+    if args.command == "worker":
+        importlib.import_module("month_queue").run_local_workers(args.workers)
+        return
+    selected = list(stages.keys()) if args.command in ["all", "status"] else [args.command]
+    if args.command == "status" or args.dry_run:
+        print_status(selected)
+    else:
+        run_stages(selected, force=args.force)
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,95 @@
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import matplotlib
+matplotlib.use("Agg") # headless backend for batch runs
 import matplotlib.pyplot as plt
-import seaborn as sns
-from config import CPS_DATA_CHILD_DIR, PLOT_DIR
+from config import PLOT_DIR
+from month_catalog import refresh_catalog, get_month_files
+from age_counts import COUNT, build_missing_age_counts, load_age_counts
 from variable_typing import *
 
-def plot_age_frequency(age_var: str, group_var: str, data: pd.DataFrame, plot_dir: Path) -> None:
+def pivot_age_counts(counts_df: pd.DataFrame) -> pd.DataFrame:
     """
-    Plot the frequency of age groups for each group of having children or not.
+    Pivot the age counts into one row per age and one column per HAS_CHILD value.
+    """
+    return counts_df.pivot_table(index=AGE, columns=HAS_CHILD, values=COUNT, aggfunc="sum", fill_value=0)
+
+def plot_stacked_ages(ax: plt.Axes, counts_df: pd.DataFrame) -> None:
+    """
+    Draw the age histogram stacked by having children or not, from pre-aggregated counts.
+    """
+    pivot_df = pivot_age_counts(counts_df)
+    bottom = np.zeros(len(pivot_df))
+    for has_child, label in [(0, "No children"), (1, "Has children")]:
+        if has_child in pivot_df.columns:
+            ax.bar(pivot_df.index, pivot_df[has_child], width=1.0, bottom=bottom, label=label)
+            bottom += pivot_df[has_child].to_numpy()
+
+def plot_age_frequency(counts_df: pd.DataFrame, plot_dir: Path) -> None:
+    """
+    Plot the frequency of age groups for each group of having children or not, over all years.
 
     Parameters:
-    - x: list or array of x-axis values
-    - y: list or array of y-axis values
-    - labels: list of labels for each data series
+    - counts_df: age counts with DATA_YEAR, AGE, HAS_CHILD and COUNT columns
+    - plot_dir: directory to save the plot
 
     Returns:
     - None
     """
     fig, ax = plt.subplots()
-    sns.histplot(data=data, x=age_var, hue=group_var, multiple="stack", ax=ax, bins=len(data[age_var].unique()))
-    plt.title(f"Distribution of Age by Having Children or Not")
+    plot_stacked_ages(ax, counts_df)
+    years = counts_df[DATA_YEAR]
+    ax.legend(title=HAS_CHILD)
+    plt.title(f"Distribution of Age by Having Children or Not ({years.min()}-{years.max()})")
     plt.xlabel("Age")
     plt.ylabel("Frequency")
-    
+
     plot_path = plot_dir / "age_distribution.png"
     plot_dir.mkdir(parents=True, exist_ok=True)
     plt.savefig(plot_path)
+    plt.close(fig)
+
+def plot_age_frequency_by_year(counts_df: pd.DataFrame, plot_dir: Path, num_cols: int = 6) -> None:
+    """
+    Plot the age distribution by having children or not as small multiples, one panel per year.
+
+    Parameters:
+    - counts_df: age counts with DATA_YEAR, AGE, HAS_CHILD and COUNT columns
+    - plot_dir: directory to save the plot
+    - num_cols: number of panels per row
+
+    Returns:
+    - None
+    """
+    years = sorted(counts_df[DATA_YEAR].unique())
+    num_cols = min(num_cols, len(years))
+    num_rows = int(np.ceil(len(years) / num_cols))
+    fig, axes = plt.subplots(num_rows, num_cols, figsize=(3 * num_cols, 2.2 * num_rows),
+                             sharex=True, squeeze=False)
+    for ax, year in zip(axes.flat, years):
+        plot_stacked_ages(ax, counts_df[counts_df[DATA_YEAR] == year])
+        ax.set_title(str(year), fontsize=9)
+        ax.tick_params(labelsize=7)
+    for ax in axes.flat[len(years):]:
+        ax.set_visible(False)
+    axes.flat[0].legend(fontsize=7)
+    fig.suptitle("Distribution of Age by Having Children or Not, by Year")
+    fig.tight_layout()
+
+    plot_path = plot_dir / "age_distribution_by_year.png"
+    plot_dir.mkdir(parents=True, exist_ok=True)
+    fig.savefig(plot_path)
+    plt.close(fig)
+
+def main() -> None:
+    # Aggregate the months that have no age counts yet (prep_04 writes them for new months)
+    build_missing_age_counts(get_month_files(refresh_catalog(["child"]), "child"))
+
+    # Plot from the pre-aggregated counts, no microdata is loaded
+    counts_df = load_age_counts()
+    plot_age_frequency(counts_df, PLOT_DIR)
+    plot_age_frequency_by_year(counts_df, PLOT_DIR)
 
 if __name__ == "__main__":
-    df = pd.read_csv(list(CPS_DATA_CHILD_DIR.glob("*.csv"))[0])
-    plot_age_frequency(AGE, HAS_CHILD, df, PLOT_DIR)
+    main()
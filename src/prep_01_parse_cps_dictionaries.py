@@ -2,6 +2,7 @@ from pathlib import Path
 from typing import List
 import re
 import pandas as pd
+from dict_layouts import build_layout_registry, write_layout_registry, print_layout_summary
 from config import (CPS_DICT_TXT_LIST, CPS_DICT_CSV_LIST, CPS_DICT_DCT_DIR, 
                     MANUAL_CLEAN_CPS_DICT_CSV_LIST, CPS_DICT_CSV_DIR)
 
@@ -300,6 +301,11 @@ def main() -> None:
     
     # Convert the parsed dictionary files to .dct files
     convert_all_csv_to_dct()
+    
+    # Fingerprint the record layouts, and diff the layouts of adjacent epochs
+    registry = build_layout_registry(CPS_DICT_CSV_LIST)
+    write_layout_registry(registry)
+    print_layout_summary(registry)
 
 if __name__ == "__main__":
     main()
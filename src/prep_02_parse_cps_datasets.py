@@ -1,45 +1,76 @@
+from functools import lru_cache
+from itertools import groupby
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 from tqdm.auto import tqdm
 import pandas as pd
-from config import CPS_DATA_FW_DIR, CPS_DICT_CSV_LIST, CPS_DATA_CSV_DIR
+from config import CPS_DICT_CSV_LIST, CPS_DATA_CSV_DIR, CPS_DATA_HOUSEHOLD_DIR, CPS_SAMPLE_FRACTION
+from month_catalog import refresh_catalog, get_month_files, get_dict_epoch
+from fixed_width_kernel import decode_fixed_width_columns
+from block_archive import load_archive_records
+from dict_layouts import Colspecs, get_layout, diff_layouts, get_changed_columns
+from sampling import sample_household_records
+from household_tables import split_household_table, get_household_file
+from atomic_io import write_csv, is_complete, mark_complete, get_marker_file, remove_temp_files
+from column_stats import (compute_column_stats, write_column_stats, load_column_stats,
+                          validate_column_stats, estimate_archive_distinct_counts)
+from variable_typing import STR_VARS
 
-def convert_fixed_width_data_to_csv(data_fx_file: Path, dict_csv_file: Path, output_dir: Path) -> None:
+def convert_fixed_width_data_to_csv(data_fx_file: Path, dict_csv_file: Path, output_dir: Path,
+                                    colspecs: Optional[Colspecs] = None) -> None:
     """
-    Convert a fixed-width data file to a CSV file using a CPS dictionary file.
+    Convert a fixed-width data file to CSV files using a CPS dictionary file: a person table
+    in output_dir and a household table in CPS_DATA_HOUSEHOLD_DIR (see household_tables.py).
     
     Parameters:
-        data_fx_file (Path): The path to the fixed-width data file.
+        data_fx_file (Path): The path to the block archive of the fixed-width data (see block_archive.py).
         dict_csv_file (Path): The path to the dictionary CSV file.
         output_dir (Path): The directory to save the CSV file.
+        colspecs (Optional[Colspecs]): The column specifications of the layout of the
+            dictionary, if already known (e.g. for a run of months with the same layout).
     
     Returns:
         None
     """
-    # Check the existency of the output data file
+    # Check whether the output data file was completely written from this input
     output_file = output_dir / data_fx_file.with_suffix(".csv").name
-    if output_file.exists():
+    if output_file.exists() and not get_marker_file(output_file).exists() and load_column_stats(output_file) is not None:
+        mark_complete(output_file, [data_fx_file]) # written before the completion markers, complete as its sidecar is valid
+    household_file = get_household_file(output_file)
+    if is_complete(output_file, [data_fx_file]) and is_complete(household_file, [data_fx_file]):
         print(f"The file {output_file.stem} already exists, skipping...")
         return
     
-    # Load the dictionary
-    dict_df = pd.read_csv(dict_csv_file)
-    
-    # Extract the var_name, start_pos, and end_pos columns
-    dict_df = dict_df[["var_name", "start_pos", "end_pos"]]
-    dict_df = dict_df.sort_values("start_pos")
-    colspecs = [(row["start_pos"] - 1, row["end_pos"]) for _, row in dict_df.iterrows()]
-    
-    # Load the fixed-width data file
-    data_df = pd.read_fwf(data_fx_file, colspecs=colspecs, header=None)
-    
-    # Assign the column names
-    data_df.columns = dict_df["var_name"]
-    needed_columns = [col for col in data_df.columns.to_list() if col not in ["FILLER", "FILLER.2"]]
-    data_df = data_df[needed_columns]
-    
-    # Save the data as a CSV file
-    data_df.to_csv(output_file, index=False)
+    # Get the column specifications of the dictionary layout (read once per dictionary)
+    if colspecs is None:
+        _, colspecs = get_layout(dict_csv_file)
+    
+    # Decode the fixed-width records into nullable integers in one pass (only the sampled
+    # households in a sample run), the blocks of the archive being decompressed in parallel
+    buffer, starts, ends = load_archive_records(data_fx_file)
+    if CPS_SAMPLE_FRACTION < 1:
+        starts, ends = sample_household_records(buffer, starts, ends, colspecs, CPS_SAMPLE_FRACTION)
+    data_df, invalid_counts = decode_fixed_width_columns(buffer, starts, ends, colspecs, str_columns=STR_VARS)
+    if invalid_counts:
+        print(f"Invalid values (set to missing) in {data_fx_file.stem}: {invalid_counts}")
+    
+    # Save the household and the person tables as CSV files (the person table last, as its
+    # marker is checked first), with the column statistics as sidecars for validation
+    person_df, household_df = split_household_table(data_df)
+    household_file.parent.mkdir(parents=True, exist_ok=True)
+    write_csv(household_df, household_file, [data_fx_file], index=False)
+    write_column_stats(household_file, compute_column_stats(household_df, invalid_counts))
+    write_csv(person_df, output_file, [data_fx_file], index=False)
+    write_column_stats(output_file, compute_column_stats(person_df, invalid_counts))
+
+@lru_cache(maxsize=None)
+def get_dict_files_by_time(dict_csv_files: Tuple[Path, ...]) -> Tuple[List[str], Dict[str, Path]]:
+    """
+    Index dictionary files by start time, once per list of files: the sorted start times
+    (for get_dict_epoch) and the file of each start time.
+    """
+    dict_files_by_time = {dict_file.stem.split("_")[-1]: dict_file for dict_file in dict_csv_files}
+    return sorted(dict_files_by_time), dict_files_by_time
 
 def find_corresponding_dict_file(data_file: Path, dict_csv_files: List[Path]) -> Path:
     """
@@ -56,14 +87,14 @@ def find_corresponding_dict_file(data_file: Path, dict_csv_files: List[Path]) ->
     # Extract the start time from the data file name
     start_time = data_file.stem.split("_")[-1]
     
-    # Find the corresponding dictionary file
-    dict_csv_files = sorted(dict_csv_files, key=lambda x: x.stem.split("_")[-1], reverse=True)
-    for dict_file in dict_csv_files:
-        dict_time = dict_file.stem.split("_")[-1]
-        if dict_time <= start_time:
-            return dict_file
-        
-    raise ValueError(f"No corresponding dictionary CSV file found for {data_file}")
+    # Look up the corresponding dictionary file (binary search over the sorted start times)
+    dict_times, dict_files_by_time = get_dict_files_by_time(tuple(dict_csv_files))
+    try:
+        dict_time = get_dict_epoch(start_time, dict_times)
+    except ValueError:
+        raise ValueError(f"No corresponding dictionary CSV file found for {data_file}")
+    
+    return dict_files_by_time[dict_time]
 
 def validate_founded_dict_files(data_files: List[Path], dict_csv_files: List[Path]) -> None:
     """
@@ -81,72 +112,93 @@ def validate_founded_dict_files(data_files: List[Path], dict_csv_files: List[Pat
         dict_csv_file = find_corresponding_dict_file(data_file, dict_csv_files)
         print(f"Matched variable dictionary for {data_file.stem}: {dict_csv_file.stem}")
 
-def parse_cps_data_files(data_dir: Path, dict_csv_files: List[Path], output_dir: Path) -> None:
+def parse_cps_data_files(data_files: List[Path], dict_csv_files: List[Path], output_dir: Path) -> None:
     """
-    Parse all the CPS data files in a directory.
+    Parse a list of CPS data files.
     
     Parameters:
-        data_dir (Path): The directory containing the CPS data files.
+        data_files (List[Path]): The fixed-width CPS data files (e.g. from the month catalog).
         dict_csv_files (List[Path]): A list of dictionary CSV files.
         output_dir (Path): The directory to save the parsed data CSV files.
         
     Returns:
         None
     """
-    # Create the output directory if it does not exist
+    # Create the output directory if it does not exist (and drop the files of killed runs)
     output_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Find all the fixed-width data files (exclude "subset" files)
-    data_files = list(data_dir.glob("*"))
-    data_files = [file for file in data_files if "subset" not in file.stem]
-    data_files.sort()
-    
-    # Parse each data file
-    for data_file in tqdm(data_files):
-        dict_csv_file = find_corresponding_dict_file(data_file, dict_csv_files)
-        convert_fixed_width_data_to_csv(data_file, dict_csv_file, output_dir)
+    remove_temp_files(output_dir)
+    remove_temp_files(CPS_DATA_HOUSEHOLD_DIR)
+    
+    # Parse the data files in runs of consecutive months that share a record layout: the
+    # months of a run are decoded with the colspecs of its first month, even across
+    # dictionary epochs with an identical layout, and the columns that change between two
+    # runs are reported
+    dict_files = {data_file: find_corresponding_dict_file(data_file, dict_csv_files) for data_file in sorted(data_files)}
+    previous_colspecs = None
+    for fingerprint, run in groupby(dict_files, key=lambda data_file: get_layout(dict_files[data_file])[0]):
+        run = list(run)
+        _, colspecs = get_layout(dict_files[run[0]])
+        if previous_colspecs is not None:
+            changed_columns = get_changed_columns(diff_layouts(previous_colspecs, colspecs))
+            print(f"Layout {fingerprint} from {run[0].stem}: {len(changed_columns)} changed columns "
+                  f"({', '.join(changed_columns[:10])}{', ...' if len(changed_columns) > 10 else ''})")
+        for data_file in tqdm(run, desc=f"Layout {fingerprint}"):
+            convert_fixed_width_data_to_csv(data_file, dict_files[data_file], output_dir, colspecs)
+        previous_colspecs = colspecs
    
-def validate_parsed_csv_files(csv_dir: Path) -> None:
+def validate_parsed_csv_files(csv_files: List[Path]) -> None:
     """
     Validate the parsed CSV files, make sure no unexpected string values are present.
+    The rules are evaluated against the sidecar statistics written during decoding, so the
+    CSV files are only read if their sidecar is missing or stale. The columns of the household
+    table of a month count as columns of the month, and the row threshold is scaled in a
+    sample run.
     
     Parameters:
-        csv_dir (Path): The directory containing the parsed CSV files.
+        csv_files (List[Path]): The parsed CSV files.
     """
-    csv_files = list(csv_dir.glob("*.csv"))
-    csv_files.sort()
-    
-    for csv_file in csv_files:
-        allowed_str_columns = ["HRSAMPLE", "HRSERSUF"]
-        df = pd.read_csv(csv_file, dtype={var : str for var in allowed_str_columns})
-        num_columns = len(df.columns)
-        num_entries = len(df)
-        str_columns = df.select_dtypes(include="object").columns
-        unexpected_str_columns = [col for col in str_columns if col not in allowed_str_columns]
+    month_stats = []
+    for csv_file in sorted(csv_files):
+        stats = load_column_stats(csv_file)
+        if stats is None:
+            df = pd.read_csv(csv_file, dtype={var : str for var in STR_VARS})
+            stats = compute_column_stats(df)
+            write_column_stats(csv_file, stats)
+        household_stats = load_column_stats(get_household_file(csv_file))
+        if household_stats is not None:
+            stats = {**stats, "columns": {**household_stats["columns"], **stats["columns"]}}
+        month_stats.append(stats)
+        result = validate_column_stats(stats, allowed_str_vars=STR_VARS, min_rows=int(100000 * CPS_SAMPLE_FRACTION))
         
-        # Check for number of columns
-        if num_columns <= 300:
-            raise ValueError(f"Number of columns is too low in {csv_file.stem}")
-        # Check for number of entries
-        if num_entries <= 100000:
-            raise ValueError(f"Number of entries is too low in {csv_file.stem}")
-        # Check for string columns
-        if len(unexpected_str_columns) > 0:
-            print(f"Unexpected string columns in {csv_file.stem}: {unexpected_str_columns}")
-            for col in unexpected_str_columns:
-                print(f"Unique Values for {col}:\n{df[col].value_counts()}")
+        # Check for number of columns and entries
+        if result["errors"]:
+            raise ValueError(f"{'; '.join(result['errors'])} in {csv_file.stem}")
+        # Check for string columns and invalid values
+        if result["warnings"]:
+            print(f"Issues in {csv_file.stem}:\n" + "\n".join(result["warnings"]))
             continue
         
         print(f"Validated {csv_file.stem}")
+    
+    # Report the columns that hold a single value over all the months (merged sketches)
+    distinct_counts = estimate_archive_distinct_counts(month_stats)
+    constant_columns = [col for col, count in distinct_counts.items() if count <= 1]
+    if constant_columns:
+        print(f"Columns with at most one value over {len(month_stats)} months: {constant_columns}")
 
-
-if __name__ == "__main__":
+def main() -> None:
+    # Find the archived fixed-width data files in the month catalog ("subset" files are not catalogued)
+    catalog = refresh_catalog(["blocks"])
+    data_files = get_month_files(catalog, "blocks")
+    
     # Validate the founded dictionary files for the data files
-    data_files = [file for file in list(CPS_DATA_FW_DIR.glob("*")) if "subset" not in file.stem]
     dict_csv_files = CPS_DICT_CSV_LIST
     validate_founded_dict_files(data_files, dict_csv_files)
     
     # Parse and validate the CPS data files
-    parse_cps_data_files(CPS_DATA_FW_DIR, CPS_DICT_CSV_LIST, CPS_DATA_CSV_DIR)
-    # validate_parsed_csv_files(CPS_DATA_CSV_DIR)
-    
\ No newline at end of file
+    parse_cps_data_files(data_files, CPS_DICT_CSV_LIST, CPS_DATA_CSV_DIR)
+    catalog = refresh_catalog(["csv", "households"])
+    validate_parsed_csv_files(get_month_files(catalog, "csv"))
+
+if __name__ == "__main__":
+    main()
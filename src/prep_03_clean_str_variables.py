@@ -2,7 +2,10 @@ from typing import List
 from pathlib import Path
 import pandas as pd
 from tqdm.auto import tqdm
-from config import CPS_DATA_CSV_DIR, CPS_DATA_CLEANED_DIR
+from config import CPS_DATA_CLEANED_DIR
+from month_catalog import refresh_catalog, get_month_files
+from column_stats import compute_column_stats, write_column_stats, load_column_stats, get_str_columns
+from atomic_io import write_csv, is_complete, mark_complete, get_marker_file, link_output, remove_temp_files
 
 def clean_str_variables(data_df: pd.DataFrame) -> pd.DataFrame:
     """
@@ -36,38 +39,68 @@ def get_invalid_str_columns(cleaned_df: pd.DataFrame, allowed_str_vars: List[str
     str_columns = [col for col in str_columns if col not in allowed_str_vars]
     return str_columns
 
+def clean_data_file(data_file: Path, output_file: Path) -> None:
+    """
+    Clean the string variables of a monthly data file, unless the sidecar statistics of the
+    cleaned file show that it has no string columns left. A decoded file whose sidecar shows
+    no string columns is linked to the cleaned directory as it is, with its statistics.
+    
+    Parameters:
+        data_file (Path): The decoded CPS data file.
+        output_file (Path): The path to save the cleaned data.
+    """
+    # Define dtype
+    dtype = {"HRSAMPLE": str, "HRSERSUF": str}
+    
+    # Cleaned data written before the completion markers is complete if its sidecar is valid
+    stats = load_column_stats(output_file)
+    if stats is not None and not get_marker_file(output_file).exists():
+        mark_complete(output_file, [data_file])
+    complete = is_complete(output_file, [data_file])
+    
+    # Skip the cleaned data whose sidecar statistics show no string columns (no reload needed)
+    if complete and stats is not None and not get_str_columns(stats, dtype.keys()):
+        return
+    
+    # Link the decoded data that has nothing to clean (no reload and rewrite needed)
+    input_stats = load_column_stats(data_file) if not complete else None
+    if input_stats is not None and not get_str_columns(input_stats, dtype.keys()):
+        link_output(data_file, output_file, [data_file])
+        write_column_stats(output_file, {key: value for key, value in input_stats.items() if not key.startswith("source_")})
+        return
+    
+    # Check if the cleaned data exists (completely written, from this decoded file)
+    if not complete:
+        data_df = pd.read_csv(data_file, dtype=dtype)
+        data_df = clean_str_variables(data_df)
+        write_csv(data_df, output_file, [data_file], index=False)
+    else:
+        data_df = pd.read_csv(output_file, dtype=dtype)
+        str_columns = get_invalid_str_columns(data_df, dtype.keys())
+        if str_columns:
+            data_df = clean_str_variables(data_df)
+            write_csv(data_df, output_file, [data_file], index=False)
+    
+    # Validate the cleaned dataset, and keep its statistics for the next runs
+    write_column_stats(output_file, compute_column_stats(data_df))
+    str_columns = get_invalid_str_columns(data_df, dtype.keys())
+    if str_columns:
+        print(f"String columns found in {data_file}: {str_columns}")
+
 def main() -> None:
     """
     Main function.
     """
     # Create the output directory
     CPS_DATA_CLEANED_DIR.mkdir(parents=True, exist_ok=True)
+    remove_temp_files(CPS_DATA_CLEANED_DIR)
     
-    # Loop through the data files
-    data_files = list(CPS_DATA_CSV_DIR.glob("*.csv"))
+    # Loop through the data files (listed in the month catalog)
+    data_files = get_month_files(refresh_catalog(["csv"]), "csv")
     for data_file in tqdm(data_files):
-        # Set the output file
-        output_file = CPS_DATA_CLEANED_DIR / data_file.name
-        
-        # Define dtype
-        dtype = {"HRSAMPLE": str, "HRSERSUF": str}
-        
-        # Check if the cleaned data exists
-        if not output_file.exists():
-            data_df = pd.read_csv(data_file, dtype=dtype)
-            data_df = clean_str_variables(data_df)
-            data_df.to_csv(output_file, index=False)
-        else:
-            data_df = pd.read_csv(output_file, dtype=dtype)
-            str_columns = get_invalid_str_columns(data_df, dtype.keys())
-            if str_columns:
-                data_df = clean_str_variables(data_df)
-                data_df.to_csv(output_file, index=False)
-        
-        # Validate the cleaned dataset
-        str_columns = get_invalid_str_columns(data_df, dtype.keys())
-        if str_columns:
-            print(f"String columns found in {data_file}: {str_columns}")
+        clean_data_file(data_file, CPS_DATA_CLEANED_DIR / data_file.name)
+    
+    refresh_catalog(["cleaned"])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
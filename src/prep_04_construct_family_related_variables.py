@@ -1,14 +1,28 @@
-from typing import List
+from typing import Dict, Iterator, List, Optional
 from pathlib import Path
+import os
+import pickle
+import tempfile
+import numpy as np
 import pandas as pd
 from tqdm.auto import tqdm
-from config import CPS_DATA_CLEANED_DIR, CPS_DATA_CHILD_DIR
+from config import CPS_DATA_CHILD_DIR, FAMILY_CHUNK_ROWS
+from month_catalog import refresh_catalog, get_month_files, get_file_sha256
+from age_counts import count_age_by_child, write_age_counts, get_age_counts_file, MAX_AGE
+from column_stats import load_column_stats
+from derived_cache import cached_step, evict_results, report_cache_stats, CACHE_KEY
+from atomic_io import atomic_output, write_csv, is_complete, remove_temp_files
+from variable_schema import apply_schema
+from household_tables import (get_household_file, load_household_columns, join_household_columns,
+                              get_household_key_columns, get_household_keys)
 from variable_typing import *
 
 # Data-loading function
 def load_data(data_file: Path) -> pd.DataFrame:
     """
-    Load the cleaned CPS data, with DATA_YEAR added.
+    Load the cleaned CPS data, with DATA_YEAR and the household fields of the analysis
+    (NEEDED_VARS, from the household table) added. The checksums of the files are the
+    cache key of the derived variables.
     
     Args:
         data_file (Path): The path to the cleaned CPS data.
@@ -18,12 +32,30 @@ def load_data(data_file: Path) -> pd.DataFrame:
     """
     dtype = {"HRSAMPLE": str, "HRSERSUF": str}
     data_df = pd.read_csv(data_file, dtype=dtype)
+    data_df = join_household_columns(data_df, data_file, NEEDED_VARS)
     year = int(data_file.stem.split("_")[-1][:4])
     data_df[DATA_YEAR] = year
+    data_df.attrs[CACHE_KEY] = get_month_key(data_file)
     
     return data_df
 
+def get_month_key(data_file: Path) -> str:
+    """
+    Get the cache key of a month: the checksums of its cleaned file and of its household table.
+    """
+    key = f"{data_file.name}:{get_file_sha256(data_file)}"
+    household_file = get_household_file(data_file)
+    return f"{key}:{get_file_sha256(household_file)}" if household_file.exists() else key
+
+def get_child_inputs(cleaned_data_file: Path) -> List[Path]:
+    """
+    Get the inputs of a child-related data file: the cleaned file and its household table.
+    """
+    household_file = get_household_file(cleaned_data_file)
+    return [cleaned_data_file] + ([household_file] if household_file.exists() else [])
+
 # Variable-adding functions
+@cached_step(outputs=[BIRTH_YEAR])
 def add_birth_year(data_df: pd.DataFrame) -> pd.DataFrame:
     """
     Add the birth year variable to the CPS data.
@@ -38,6 +70,7 @@ def add_birth_year(data_df: pd.DataFrame) -> pd.DataFrame:
     data_df[BIRTH_YEAR] = birth_year
     return data_df
 
+@cached_step(outputs=[IS_MARRIED])
 def add_is_married(data_df: pd.DataFrame) -> pd.DataFrame:
     """
     Add the IS_MARRIED variable to the CPS data.
@@ -48,58 +81,37 @@ def add_is_married(data_df: pd.DataFrame) -> pd.DataFrame:
     Returns:
         pd.DataFrame: The CPS data with the IS_MARRIED variable.
     """
-    data_df[IS_MARRIED] = None
-    data_df.loc[data_df[MARRITAL_STATUS].isin([1, 2]), IS_MARRIED] = 1
-    data_df.loc[data_df[MARRITAL_STATUS] == 6, IS_MARRIED] = 0
-    data_df[IS_MARRIED].fillna(-1, inplace=True) # only consider married and never married
+    is_married = data_df[MARRITAL_STATUS].isin([1, 2])
+    is_never_married = data_df[MARRITAL_STATUS] == 6
+    # only consider married and never married (-1 otherwise)
+    data_df[IS_MARRIED] = np.select([is_married, is_never_married], [1, 0], default=-1).astype(np.int8)
     
     return data_df
 
-def get_family_groups(data_df: pd.DataFrame) -> List[pd.DataFrame]:
+def get_household_child_table(data_df: pd.DataFrame) -> pd.DataFrame:
     """
-    Group the entries in a DataFrame by family.
+    Aggregate the children of each household into a household table (one row per household).
     
     Args:
-        data_df (pd.DataFrame): The DataFrame to group.
-        
-    Returns:
-        List[pd.DataFrame]: The groups of entries.
-    """
-    family_groups = data_df.groupby(HOUSEHOLD_ID)
-    return [group for _, group in family_groups]
-
-def add_child_related_variables_for_household(family_group: pd.DataFrame) -> pd.DataFrame:
-    """
-    Add family-based variables to a family group (IS_PARENT, IS_CHILD, IS_OLDEST_CHILD,
-    AGE_OF_OLDEST_CHILD).
-    
-    Args:
-        family_group (pd.DataFrame): The family group.
+        data_df (pd.DataFrame): The CPS data.
         
     Returns:
-        pd.DataFrame: The family group with the child-related variables.
+        pd.DataFrame: The number of children (PRFAMREL 3) and the age of the oldest child of
+        each household, indexed by HRHHID.
     """
-    if family_group[HOUSEHOLD_ID].nunique() != 1:
-        raise ValueError("The family group should contain only one household.")
-
-    # Calculate the number of children in the family
-    is_ref_or_spouse = family_group[RELATIONSHIP].isin([1, 2]) # Series of booleans
-    is_child = family_group[RELATIONSHIP] == 3 # Series of booleans
-    num_children_in_family = is_child.sum() # Scalar
-    has_child = (int(num_children_in_family > 0) * is_ref_or_spouse).astype(int) # Series of 0 or 1
-    age_of_oldest_child = family_group.loc[is_child, AGE].max() if num_children_in_family > 0 else -1 # Scalar
-    year_of_first_birth_giving = family_group[DATA_YEAR] - age_of_oldest_child if num_children_in_family > 0 else -1 # Series of years
-    
-    # Assign the family-based variables to the family group
-    family_group[HAS_CHILD] = has_child
-    family_group[AGE_OF_OLDEST_CHILD] = age_of_oldest_child
-    family_group[YEAR_OF_FIRST_BIRTH_GIVING] = year_of_first_birth_giving
-
-    return family_group[is_ref_or_spouse]
+    is_child = data_df[RELATIONSHIP] == 3 # Series of booleans
+    households = data_df[HOUSEHOLD_ID]
+    return pd.DataFrame({
+        "NUM_CHILDREN": is_child.groupby(households).sum(),
+        AGE_OF_OLDEST_CHILD: data_df[AGE].where(is_child).groupby(households).max(),
+    })
 
+@cached_step(outputs=[HAS_CHILD, AGE_OF_OLDEST_CHILD, YEAR_OF_FIRST_BIRTH_GIVING])
 def add_child_related_variables(data_df: pd.DataFrame) -> pd.DataFrame:
     """
-    Add child-related variables to the CPS data.
+    Add child-related variables to the CPS data (HAS_CHILD, AGE_OF_OLDEST_CHILD and
+    YEAR_OF_FIRST_BIRTH_GIVING, -1 without children), and keep the reference persons and
+    spouses, by household.
     
     Args:
         data_df (pd.DataFrame): The CPS data.
@@ -107,15 +119,28 @@ def add_child_related_variables(data_df: pd.DataFrame) -> pd.DataFrame:
     Returns:
         pd.DataFrame: The CPS data with the child-related variables.
     """
-    if data_df[HOUSEHOLD_ID].nunique() <= 1:
+    if data_df[HOUSEHOLD_ID].nunique() == 1:
         raise ValueError("The DataFrame should contain multiple households.")
     
-    family_groups = get_family_groups(data_df)
-    family_groups = [add_child_related_variables_for_household(family_group) for family_group in family_groups]
-    data_df = pd.concat(family_groups)
+    # Compute the child aggregates on the household table, then join them to the parents
+    child_df = get_household_child_table(data_df)
+    is_ref_or_spouse = data_df[RELATIONSHIP].isin([1, 2]) & data_df[HOUSEHOLD_ID].notna()
+    data_df = data_df[is_ref_or_spouse]
+    data_df = data_df.iloc[np.argsort(data_df[HOUSEHOLD_ID].to_numpy(), kind="stable")] # grouped by household
+    child_values = child_df.reindex(data_df[HOUSEHOLD_ID].to_numpy())
+    has_child = child_values["NUM_CHILDREN"].to_numpy() > 0
+    age_of_oldest_child = pd.Series(np.where(has_child, child_values[AGE_OF_OLDEST_CHILD].to_numpy(), -1), index=data_df.index)
+    if pd.api.types.is_integer_dtype(data_df[AGE]) and age_of_oldest_child.notna().all():
+        age_of_oldest_child = age_of_oldest_child.astype(data_df[AGE].dtype)
+    
+    # Assign the family-based variables
+    data_df[HAS_CHILD] = has_child.astype(int)
+    data_df[AGE_OF_OLDEST_CHILD] = age_of_oldest_child
+    data_df[YEAR_OF_FIRST_BIRTH_GIVING] = (data_df[DATA_YEAR] - age_of_oldest_child).where(has_child, -1)
     
     return data_df
 
+@cached_step(outputs=[SPOUSE_AGE, SPOUSE_EDUCATION, SPOUSE_HOURS, HAS_SPOUSE_PRESENT, MARRIAGE_TIMES])
 def add_marriage_related_variables(data_df: pd.DataFrame) -> pd.DataFrame:
     """
     Add marriage-related variables to the CPS data.
@@ -126,8 +151,40 @@ def add_marriage_related_variables(data_df: pd.DataFrame) -> pd.DataFrame:
     Returns:
         pd.DataFrame: The CPS data with the marriage-related variables.
     """
+    # Count reference persons and spouses per family (family-segment operations). A family is
+    # keyed by the household key (HRHHID alone is not unique in a month) and PRFAMNUM, as a
+    # subfamily has its own reference person and spouse (PRFAMREL is relative to the family)
+    family_columns = get_household_key_columns(data_df.columns.to_list())
+    family_columns += [FAMILY_NUM] if FAMILY_NUM in data_df.columns else []
+    family_keys = pd.Series(get_household_keys(data_df, family_columns), index=data_df.index)
+    is_ref = data_df[RELATIONSHIP] == 1
+    is_spouse = data_df[RELATIONSHIP] == 2
+    num_ref = is_ref.groupby(family_keys).transform("sum")
+    num_spouse = is_spouse.groupby(family_keys).transform("sum")
+    is_couple = (is_ref | is_spouse) & (num_ref == 1) & (num_spouse == 1) & data_df[HOUSEHOLD_ID].notna() # Series of booleans
+
+    # Link each partner to the other one by swapping the PRFAMREL codes (1 <-> 2)
+    spouse_vars = {AGE: SPOUSE_AGE, EDUCATION: SPOUSE_EDUCATION, TARGET_VAR2: SPOUSE_HOURS}
+    partner_df = data_df.loc[is_couple, list(spouse_vars.keys())].rename(columns=spouse_vars)
+    partner_df.index = pd.MultiIndex.from_arrays([family_keys[is_couple], 3 - data_df.loc[is_couple, RELATIONSHIP]])
+    partner_values = partner_df.reindex(pd.MultiIndex.from_arrays([family_keys, data_df[RELATIONSHIP]]))
+    for spouse_var in spouse_vars.values():
+        data_df[spouse_var] = partner_values[spouse_var].to_numpy()
+
+    # Assign the spouse-related variables (-1 if no spouse is linked)
+    data_df[HAS_SPOUSE_PRESENT] = is_couple.astype(int)
+    for var, spouse_var in spouse_vars.items():
+        data_df[spouse_var] = data_df[spouse_var].fillna(-1).astype(data_df[var].dtype)
+
+    # The basic CPS only reveals whether a person has ever been married (PEMARITL 1-5)
+    # or never married (6), so MARRIAGE_TIMES is a lower bound: 0, 1 or -1 if unknown
+    data_df[MARRIAGE_TIMES] = -1
+    data_df.loc[data_df[MARRITAL_STATUS].isin([1, 2, 3, 4, 5]), MARRIAGE_TIMES] = 1
+    data_df.loc[data_df[MARRITAL_STATUS] == 6, MARRIAGE_TIMES] = 0
+
     return data_df
 
+@cached_step(outputs=[COHORT_ID])
 def add_cohort_id(df: pd.DataFrame, var_list: List[str]=MATCHING_VARS) -> pd.DataFrame:
     """
     Construct a demographic identifier (COHORT_ID) for each individual based on the specified variables.
@@ -139,8 +196,13 @@ def add_cohort_id(df: pd.DataFrame, var_list: List[str]=MATCHING_VARS) -> pd.Dat
     Returns:
     - df: DataFrame with the demographic identifier added
     """
-    # Construct the demographic identifier "COHORT_ID"
-    df[COHORT_ID] = df[var_list].apply(lambda x: "_".join(x.astype(str)), axis=1)
+    # Construct the demographic identifier "COHORT_ID" column by column, from the values cast to
+    # the common dtype of the variables (as in a row of df[var_list], e.g. "1970.0" for floats)
+    values = df[var_list].to_numpy()
+    cohort_id = pd.Series(values[:, 0], index=df.index).astype(str)
+    for i in range(1, len(var_list)):
+        cohort_id = cohort_id + "_" + pd.Series(values[:, i], index=df.index).astype(str)
+    df[COHORT_ID] = cohort_id
     return df
 
 # Container functions
@@ -189,7 +251,7 @@ def prepare_dataframe(data_df: pd.DataFrame) -> pd.DataFrame:
     Returns:
         pd.DataFrame: The prepared DataFrame.
     """    
-    return filter_data(add_variables(data_df))
+    return apply_schema(filter_data(add_variables(data_df)))
 
 def update_age(child_data_df: pd.DataFrame) -> None:
     """
@@ -206,19 +268,99 @@ def update_age(child_data_df: pd.DataFrame) -> None:
     else:
         raise ValueError("No age variable found (PEAGE or PRTAGE).")
 
-# Main function
-def main() -> None:
-    # Create the directory for the child-related CPS data
-    CPS_DATA_CHILD_DIR.mkdir(parents=True, exist_ok=True)
+def get_household_buckets(household_ids: pd.Series, chunk_rows: int) -> np.ndarray:
+    """
+    Split the range of household IDs into buckets of about chunk_rows rows, so that no
+    household spans two buckets. Each bucket holds at least 2 households (a single household
+    would be rejected by add_child_related_variables).
     
-    # Find all cleaned CPS data files
-    cleaned_data_files = list(CPS_DATA_CLEANED_DIR.glob("*.csv"))
-    cleaned_data_files.sort()
+    Args:
+        household_ids (pd.Series): The HRHHID column of a month.
+        chunk_rows (int): The target number of rows per bucket.
+        
+    Returns:
+        np.ndarray: The smallest household ID of each bucket, in increasing order.
+    """
+    sizes = household_ids.value_counts().sort_index()
+    ids, sizes = sizes.index.to_numpy(), sizes.to_numpy()
+    if len(ids) == 0:
+        return ids # an empty month has no buckets
+    starts, num_rows = [0], 0
+    for i, size in enumerate(sizes):
+        if num_rows + size > chunk_rows and i - starts[-1] >= 2:
+            starts.append(i)
+            num_rows = 0
+        num_rows += size
+    if len(starts) > 1 and len(ids) - starts[-1] < 2:
+        starts.pop()
+    return ids[starts]
+
+def get_csv_dtypes(stats: Dict) -> Dict[str, object]:
+    """
+    Get the dtypes of a whole file from its sidecar statistics, so that every chunk is read
+    with the dtypes inferred when the file is read at once.
+    """
+    csv_dtypes = {"int64": "int64", "float64": "float64", "bool": "bool", "object": str}
+    return {col: csv_dtypes[col_stats["dtype"]] for col, col_stats in stats["columns"].items()}
+
+def read_household_buckets(cleaned_data_file: Path, dtypes: Dict[str, object], chunk_rows: int,
+                           spill_dir: Path) -> Iterator[pd.DataFrame]:
+    """
+    Read a cleaned monthly file bucket by bucket (household ID ranges). The file is read
+    twice in chunks: once for the household IDs only, then to spill the rows of each bucket
+    to its own file, in file order. Memory is bounded by chunk_rows (or the largest household).
     
-    # Loop over all cleaned CPS data files
-    for cleaned_data_file in tqdm(cleaned_data_files, desc="Adding child-related variables"):
+    Args:
+        cleaned_data_file (Path): The cleaned CPS data file.
+        dtypes (Dict[str, object]): The dtypes of the columns.
+        chunk_rows (int): The target number of rows per chunk.
+        spill_dir (Path): A temporary directory for the bucket files.
+        
+    Yields:
+        pd.DataFrame: The rows of each bucket, by increasing household IDs (a single empty
+        frame for an empty month, so that the output has its header).
+    """
+    household_ids = pd.read_csv(cleaned_data_file, usecols=[HOUSEHOLD_ID], dtype={HOUSEHOLD_ID: dtypes[HOUSEHOLD_ID]})
+    bucket_starts = get_household_buckets(household_ids[HOUSEHOLD_ID], chunk_rows)
+    del household_ids
+    if len(bucket_starts) == 0:
+        yield pd.read_csv(cleaned_data_file, dtype=dtypes, nrows=0)
+        return
+    
+    bucket_files = [spill_dir / f"bucket_{i}.pkl" for i in range(len(bucket_starts))]
+    for chunk_df in pd.read_csv(cleaned_data_file, dtype=dtypes, chunksize=chunk_rows):
+        buckets = np.searchsorted(bucket_starts, chunk_df[HOUSEHOLD_ID].to_numpy(), side="right") - 1
+        for bucket in np.unique(buckets):
+            with open(bucket_files[max(bucket, 0)], "ab") as f:
+                pickle.dump(chunk_df[buckets == bucket], f)
+    
+    for bucket_file in bucket_files:
+        parts = []
+        with open(bucket_file, "rb") as f:
+            while True:
+                try:
+                    parts.append(pickle.load(f))
+                except EOFError:
+                    break
+        os.remove(bucket_file)
+        yield pd.concat(parts)
+
+def construct_child_data_file(cleaned_data_file: Path, child_data_file: Path,
+                              chunk_rows: Optional[int] = FAMILY_CHUNK_ROWS) -> None:
+    """
+    Add the family-related variables to a cleaned monthly data file, and aggregate its
+    age distribution for the plots. With chunk_rows, the month is processed in household
+    ranges of about chunk_rows rows whose outputs are appended to the file; the output is
+    identical to the output of the whole month.
+    
+    Args:
+        cleaned_data_file (Path): The cleaned CPS data file.
+        child_data_file (Path): The path to save the child-related CPS data.
+        chunk_rows (Optional[int]): The number of rows per chunk (None to load the whole month).
+    """
+    stats = load_column_stats(cleaned_data_file) if chunk_rows is not None else None
+    if stats is None:
         # Load the cleaned CPS data
-        child_data_file = CPS_DATA_CHILD_DIR / cleaned_data_file.name
         child_data_df = load_data(cleaned_data_file)
         
         # Update "AGE" variable
@@ -226,12 +368,53 @@ def main() -> None:
         
         # Prepare the DataFrame
         child_data_df = prepare_dataframe(child_data_df)
-        child_data_df.to_csv(child_data_file, index=False)
+        write_csv(child_data_df, child_data_file, get_child_inputs(cleaned_data_file), index=False)
+        
+        # Aggregate the age distribution for the plots
+        counts = count_age_by_child(child_data_df, AGE)
+        write_age_counts(counts, int(cleaned_data_file.stem.split("_")[-1][:4]), get_age_counts_file(child_data_file))
+        return
+    
+    # Chunked mode: the dtypes come from the sidecar statistics of the cleaned file
+    year = int(cleaned_data_file.stem.split("_")[-1][:4])
+    update_age(pd.DataFrame(columns=list(stats["columns"].keys())))
+    file_key = get_month_key(cleaned_data_file)
+    household_df = load_household_columns(cleaned_data_file, NEEDED_VARS) # joined to each chunk
+    counts = np.zeros((MAX_AGE + 1, 2), dtype=np.int64)
+    with atomic_output(child_data_file, get_child_inputs(cleaned_data_file)) as temp_file:
+        with tempfile.TemporaryDirectory(dir=child_data_file.parent) as spill_dir:
+            buckets = read_household_buckets(cleaned_data_file, get_csv_dtypes(stats), chunk_rows, Path(spill_dir))
+            for i, chunk_df in enumerate(buckets):
+                chunk_df = join_household_columns(chunk_df, cleaned_data_file, NEEDED_VARS, household_df)
+                chunk_df[DATA_YEAR] = year
+                chunk_df.attrs[CACHE_KEY] = f"{file_key}:{chunk_rows}:{i}"
+                chunk_df = prepare_dataframe(chunk_df)
+                chunk_df.to_csv(temp_file, index=False, mode="w" if i == 0 else "a", header=(i == 0))
+                counts = counts + count_age_by_child(chunk_df, AGE)
+    write_age_counts(counts, year, get_age_counts_file(child_data_file))
 
-        if "199403" in cleaned_data_file.name:
-            break # for testing purposes
+# Main function
+def main() -> None:
+    # Create the directory for the child-related CPS data (and drop the files of killed runs)
+    CPS_DATA_CHILD_DIR.mkdir(parents=True, exist_ok=True)
+    remove_temp_files(CPS_DATA_CHILD_DIR)
+    
+    # Find all cleaned CPS data files (sorted by month in the catalog)
+    cleaned_data_files = get_month_files(refresh_catalog(["cleaned"]), "cleaned")
+    
+    # Loop over the cleaned CPS data files, resuming after the months already completed
+    for cleaned_data_file in tqdm(cleaned_data_files, desc="Adding child-related variables"):
+        child_data_file = CPS_DATA_CHILD_DIR / cleaned_data_file.name
+        if is_complete(child_data_file, get_child_inputs(cleaned_data_file)) and get_age_counts_file(child_data_file).exists():
+            continue
+        construct_child_data_file(cleaned_data_file, child_data_file)
+    
+    # Trim the result cache once for the run
+    evict_results()
+    report_cache_stats()
     
+    refresh_catalog(["child"])
     print("Child-related variables added to the CPS data.")
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
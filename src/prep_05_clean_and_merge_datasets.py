@@ -1,62 +1,100 @@
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
 from pathlib import Path
+import numpy as np
 import pandas as pd
-from config import CPS_DATA_CHILD_DIR, CPS_DATA_MERGED_CSV
+from config import CPS_DATA_MERGED_DATASET, MERGE_MAX_WORKERS, MERGE_BATCH_MONTHS
+from atomic_io import remove_temp_files
+from merged_dataset import write_month, is_month_merged, remove_stale_months
+from month_catalog import refresh_catalog, get_month_files, get_month
+from shared_frames import publish_frame, assemble_frames, discard_frames
+from variable_schema import apply_schema, report_memory_usage
 from variable_typing import *
 
-def get_child_data_files(child_csv_dir: Path) -> List[Path]:
+def load_child_data(data_file: Path, columns: List[str]) -> pd.DataFrame:
     """
-    Get the paths of the child data files.
+    Load the child data, with the schema dtypes.
     
     Parameters:
-        child_csv_dir (Path): The directory containing the child data files.
+        data_file (Path): The path to the child data file.
+        columns (List[str]): The columns to load.
         
     Returns:
-        List[Path]: The paths of the child data files.
+        pd.DataFrame: The child data.
     """
-    files = list(child_csv_dir.glob("*.csv"))
-    return files
+    return apply_schema(pd.read_csv(data_file, usecols=columns))
 
-def load_child_data(data_file: Path, columns: List[str]) -> pd.DataFrame:
+def load_and_publish_child_data(data_file: Path, columns: List[str]) -> Dict:
+    """
+    Load the child data in a worker process, and publish it in shared memory.
+    """
+    return publish_frame(load_child_data(data_file, columns))
+
+def load_child_datasets(data_files: List[Path], columns: List[str],
+                        max_workers: int = MERGE_MAX_WORKERS) -> Tuple[pd.DataFrame, List[int]]:
     """
-    Load the child data.
+    Load the child datasets in worker processes, and assemble them from shared memory
+    (the monthly frames are not pickled back to this process).
     
     Parameters:
-        data_file (Path): The path to the child data file.
+        data_files (List[Path]): The paths to the child datasets.
         columns (List[str]): The columns to load.
+        max_workers (int): The number of worker processes.
         
     Returns:
-        pd.DataFrame: The child data.
+        Tuple[pd.DataFrame, List[int]]: The merged data, and the number of rows of each file.
     """
-    return pd.read_csv(data_file, usecols=columns)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(load_and_publish_child_data, data_file, columns) for data_file in data_files]
+    handles = [future.result() for future in futures if future.exception() is None]
+    if len(handles) < len(futures):
+        discard_frames(handles)
+        raise next(future.exception() for future in futures if future.exception() is not None)
+    return assemble_frames(handles), [handle["rows"] for handle in handles]
 
-def merge_datasets_and_save(data_files: List[Path], output_file: Path, needed_variables: List[str]) -> None:
+def merge_datasets_and_save(data_files: List[Path], output_dir: Path, needed_variables: List[str],
+                            batch_months: int = MERGE_BATCH_MONTHS) -> None:
     """
-    Merge the child datasets and save the merged dataset.
+    Merge the child datasets and save the merged dataset. The months are loaded and written
+    in batches, and each written month is marked complete, so that a restarted run resumes
+    with the months that are missing or whose child data changed.
     
     Parameters:
         data_files (List[Path]): The paths to the child datasets.
-        output_file (Path): The path to save the merged dataset.
+        output_dir (Path): The directory of the merged dataset (partitioned by DATA_YEAR).
         needed_variables (List[str]): The variables needed in the merged dataset.
+        batch_months (int): The number of months per batch.
     """
-    # Load the child datasets
-    output_file.parent.mkdir(parents=True, exist_ok=True)
-    data_df = pd.concat([load_child_data(data_file, needed_variables) for data_file in data_files])
+    remove_temp_files(output_dir)
+    pending_files = [data_file for data_file in data_files
+                     if not is_month_merged(get_month(data_file), [data_file], output_dir)]
+    print(f"{len(data_files) - len(pending_files)} months already merged, {len(pending_files)} to merge.")
     
-    # Check for missing values
-    len_before = data_df.shape[0]
-    data_df.dropna(how="any", inplace=True)
-    len_after = data_df.shape[0]
-    if len_before != len_after:
-        raise ValueError(f"Missing values found in the merged dataset: {len_before - len_after} rows dropped.")
+    num_rows_merged = 0
+    for batch_start in range(0, len(pending_files), batch_months):
+        # Load the child datasets of the batch
+        batch_files = pending_files[batch_start:batch_start + batch_months]
+        data_df, num_rows = load_child_datasets(batch_files, needed_variables)
+        
+        # Check for missing values
+        num_missing = data_df.isna().any(axis=1).sum()
+        if num_missing > 0:
+            raise ValueError(f"Missing values found in the merged dataset: {num_missing} rows.")
+        
+        if batch_start == 0:
+            report_memory_usage(data_df, f"Merged dataset memory ({len(batch_files)} months)")
+        
+        # Save the months of the batch (one file per month)
+        for data_file, rows, end in zip(batch_files, num_rows, np.cumsum(num_rows)):
+            write_month(data_df.iloc[end - rows:end], get_month(data_file), output_dir, inputs=[data_file])
+        num_rows_merged += len(data_df)
     
-    # Save the merged dataset
-    data_df.to_csv(output_file, index=False)
-    print(f"Merged dataset shape: {data_df.shape}, from {len(data_files)} files.")
+    remove_stale_months([get_month(data_file) for data_file in data_files], output_dir)
+    print(f"Merged {num_rows_merged} rows from {len(pending_files)} files ({len(data_files)} months in the dataset).")
 
 def main() -> None:
-    data_files = get_child_data_files(CPS_DATA_CHILD_DIR)
-    merge_datasets_and_save(data_files, CPS_DATA_MERGED_CSV, NEEDED_VARS)
+    data_files = get_month_files(refresh_catalog(["child"]), "child")
+    merge_datasets_and_save(data_files, CPS_DATA_MERGED_DATASET, NEEDED_VARS)
     print("Child datasets merged and saved.")
     
 if __name__ == "__main__":
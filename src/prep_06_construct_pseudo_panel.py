@@ -1,8 +1,25 @@
-from typing import List
+from pathlib import Path
+from typing import List, Tuple
+import json
+import os
 import pandas as pd
-from config import CPS_DATA_MERGED_CSV, CPS_DATA_PSEUDO_CSV
+import pyarrow as pa
+import pyarrow.parquet as pq
+from atomic_io import atomic_output, write_csv
+from config import CPS_DATA_PSEUDO_CSV, CPS_DATA_COHORT_STATUS, PSEUDO_PANEL_BY_COHORT
+from external_sort import iter_cohort_batches
+from merged_dataset import read_merged_dataset, read_merged_month, list_merged_months
+from variable_schema import report_memory_usage
 from variable_typing import *
 
+# Columns of the cohort status table
+HAS_TREATED = "HAS_TREATED"
+HAS_CONTROL = "HAS_CONTROL"
+
+# Event times of the potential observations of non-parents (the event-time table of the
+# pseudo panel view in panel_query.py)
+NON_PARENT_EVENT_TIMES = [-1, -2, -3, -4, -5]
+
 def drop_non_matched_observations(df: pd.DataFrame, cohort_id: str, treatment_var: str) -> pd.DataFrame:
     """
     Group the dataset into 2 by the treatment variable, and drop the unmatched observations.
@@ -39,24 +56,138 @@ def make_potential_observations_for_non_parents(df: pd.DataFrame, treatment_timi
     
     # Replicate the observations
     non_parent_df_list = []
-    for i in range(1, 6):
+    for event_time in NON_PARENT_EVENT_TIMES:
         non_parent_df_copy = non_parent_df.copy()
-        non_parent_df_copy[treatment_timing] = -i
+        non_parent_df_copy[treatment_timing] = event_time
         non_parent_df_list.append(non_parent_df_copy)
         
-    df = pd.concat([parent_df,] + non_parent_df_list)
+    df = pd.concat([parent_df,] + non_parent_df_list, ignore_index=True)
     df = df[NEEDED_VARS]
     
     return df
 
-def main() -> None:
-    df = pd.read_csv(CPS_DATA_MERGED_CSV)
-    df = drop_non_matched_observations(df, COHORT_ID, HAS_CHILD)
+def get_cohort_status(df: pd.DataFrame, cohort_id: str, treatment_var: str) -> pd.DataFrame:
+    """
+    Flag, for each cohort, whether it has treated and control observations (a cohort is
+    matched, and kept in the pseudo panel, when it has both).
+    
+    Parameters:
+        df (pd.DataFrame): The dataset.
+        cohort_id (str): The cohort ID variable.
+        treatment_var (str): The treatment variable.
+        
+    Returns:
+        pd.DataFrame: The HAS_TREATED and HAS_CONTROL flags, indexed by cohort ID.
+    """
+    flags = pd.DataFrame({HAS_TREATED: df[treatment_var] == 1, HAS_CONTROL: df[treatment_var] == 0})
+    return flags.groupby(df[cohort_id].astype(str)).any()
+
+def get_matched_cohorts(status_df: pd.DataFrame) -> pd.Index:
+    """
+    Get the cohorts that have both treated and control observations.
+    """
+    return status_df.index[status_df[HAS_TREATED] & status_df[HAS_CONTROL]]
+
+def save_cohort_status(status_df: pd.DataFrame, months: List[str], csv_bytes: int,
+                       status_file: Path = CPS_DATA_COHORT_STATUS) -> None:
+    """
+    Save the cohort status table, together with the months included in the pseudo panel and
+    the size of the pseudo panel CSV file (in the Parquet metadata, so that both are replaced
+    in one atomic rename).
+    """
+    table = pa.Table.from_pandas(status_df.rename_axis(COHORT_ID).reset_index(), preserve_index=False)
+    table = table.replace_schema_metadata({"months": json.dumps(months), "csv_bytes": str(csv_bytes)})
+    with atomic_output(status_file) as temp_file:
+        pq.write_table(table, temp_file)
+
+def load_cohort_status(status_file: Path = CPS_DATA_COHORT_STATUS) -> Tuple[pd.DataFrame, List[str], int]:
+    """
+    Load the cohort status table, the months included in the pseudo panel and the size of
+    the pseudo panel CSV file when the table was saved.
+    """
+    table = pq.read_table(status_file)
+    metadata = table.schema.metadata
+    status_df = table.to_pandas().set_index(COHORT_ID)
+    return status_df, json.loads(metadata[b"months"]), int(metadata[b"csv_bytes"])
+
+def update_pseudo_panel(months: List[str], output_file: Path = CPS_DATA_PSEUDO_CSV,
+                        status_file: Path = CPS_DATA_COHORT_STATUS) -> None:
+    """
+    Append the observations of new months (already in the merged dataset) to the pseudo panel.
+    The cohorts that were matched before only get the new rows; the cohorts that become
+    matched with the new months get all their rows, read from the merged dataset with a
+    cohort filter. The other cohorts are not touched.
+    
+    Parameters:
+        months (List[str]): The new months, "YYYYMM".
+        output_file (Path): The pseudo panel CSV file.
+        status_file (Path): The cohort status table.
+    """
+    status_df, done_months, csv_bytes = load_cohort_status(status_file)
+    months = sorted(set(months) - set(done_months))
+    if not months:
+        return
+    
+    # Discard a partial append left by an interrupted update
+    if output_file.stat().st_size > csv_bytes:
+        os.truncate(output_file, csv_bytes)
+    
+    # Update the cohort status with the new months
+    new_df = pd.concat([read_merged_month(month) for month in months], ignore_index=True)
+    was_matched = get_matched_cohorts(status_df)
+    status_df = pd.concat([status_df, get_cohort_status(new_df, COHORT_ID, HAS_CHILD)]).groupby(level=0).any()
+    newly_matched = get_matched_cohorts(status_df).difference(was_matched)
+    
+    # Append the new rows of the matched cohorts, and all rows of the newly matched cohorts
+    df_list = [new_df[new_df[COHORT_ID].astype(str).isin(was_matched)]]
+    if len(newly_matched) > 0:
+        df_list.append(read_merged_dataset({COHORT_ID: list(newly_matched)}))
+    df = pd.concat(df_list, ignore_index=True)
     df = make_potential_observations_for_non_parents(df, AGE_OF_OLDEST_CHILD)
+    df.to_csv(output_file, mode="a", header=False, index=False)
+    save_cohort_status(status_df, sorted(done_months + months), output_file.stat().st_size, status_file)
+    print(f"Pseudo panel updated with {len(months)} months: {len(df)} rows appended, "
+          f"{len(newly_matched)} newly matched cohorts.")
+
+def construct_pseudo_panel_by_cohort(output_file: Path = CPS_DATA_PSEUDO_CSV) -> pd.DataFrame:
+    """
+    Build the pseudo panel from the merged dataset sorted by cohort on disk (see
+    external_sort.py), one batch of whole cohorts at a time, so that the memory does not
+    grow with the merged dataset. The rows are written in cohort and year order.
+    
+    Parameters:
+        output_file (Path): The pseudo panel CSV file.
+        
+    Returns:
+        pd.DataFrame: The cohort status table.
+    """
+    status_list, num_rows = [], 0
+    with atomic_output(output_file) as temp_file:
+        pd.DataFrame(columns=NEEDED_VARS).to_csv(temp_file, index=False)
+        for df in iter_cohort_batches(NEEDED_VARS):
+            # The cohort-level steps see whole cohorts in each batch
+            status_list.append(get_cohort_status(df, COHORT_ID, HAS_CHILD))
+            df = drop_non_matched_observations(df, COHORT_ID, HAS_CHILD)
+            df = make_potential_observations_for_non_parents(df, AGE_OF_OLDEST_CHILD)
+            df.to_csv(temp_file, mode="a", header=False, index=False)
+            num_rows += len(df)
+    print(f"Pseudo panel: {num_rows} rows written cohort by cohort.")
+    return pd.concat(status_list).sort_index() if status_list else pd.DataFrame(columns=[HAS_TREATED, HAS_CONTROL], dtype=bool)
+
+def main() -> None:
+    months = list_merged_months()
+    if PSEUDO_PANEL_BY_COHORT:
+        status_df = construct_pseudo_panel_by_cohort()
+    else:
+        df = read_merged_dataset()
+        status_df = get_cohort_status(df, COHORT_ID, HAS_CHILD)
+        df = drop_non_matched_observations(df, COHORT_ID, HAS_CHILD)
+        df = make_potential_observations_for_non_parents(df, AGE_OF_OLDEST_CHILD)
+        report_memory_usage(df, "Pseudo panel memory")
+        write_csv(df, CPS_DATA_PSEUDO_CSV, index=False)
     
-    # Save the dataset
-    CPS_DATA_PSEUDO_CSV.parent.mkdir(parents=True, exist_ok=True)
-    df.to_csv(CPS_DATA_PSEUDO_CSV, index=False)
+    # Save the cohort status for the update mode
+    save_cohort_status(status_df, months, CPS_DATA_PSEUDO_CSV.stat().st_size)
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
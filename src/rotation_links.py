@@ -0,0 +1,155 @@
+from pathlib import Path
+from typing import List, Tuple
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm.auto import tqdm
+from atomic_io import atomic_output
+from config import CPS_DATA_PERSON_LINKS
+from month_catalog import refresh_catalog, get_month_files, get_month
+from household_tables import get_household_key_columns, get_household_keys, get_month_columns, read_month
+from variable_typing import *
+
+# A household is interviewed for 4 months, leaves the sample for 8 months and returns for
+# 4 months (months in sample 1-4 and 5-8). All the interviews of a person share the household
+# key, the line number and the month of the first interview ("origin month"), so one global
+# sort on (household key, line, origin month, month) puts them next to each other.
+ROTATION_GAP_MONTHS = 8
+# Ages at or above this value can be top-coded, and are not checked
+AGE_TOP_CODE = 80
+
+MONTH = "MONTH" # "YYYYMM" as an integer
+MONTH_INDEX = "MONTH_INDEX" # months since January 1994
+ROW_NUMBER = "ROW_NUMBER" # row of the person in the monthly file
+HOUSEHOLD_KEY = "HOUSEHOLD_KEY"
+MONTHS_LINKED = "MONTHS_LINKED"
+
+def get_month_index(month: str) -> int:
+    return (int(month[:4]) - 1994) * 12 + int(month[4:]) - 1
+
+def load_link_keys(data_file: Path) -> pd.DataFrame:
+    """
+    Load the linking keys of the persons of a monthly file, in compact dtypes: the hash of the
+    household identifiers, the line number, the month in sample and the variables that are
+    checked across months (sex, race and age). The household fields come from the household
+    table of the month.
+
+    Args:
+        data_file (Path): A decoded or cleaned monthly data file.
+
+    Returns:
+        pd.DataFrame: One row per person, in file order.
+    """
+    columns = get_month_columns(data_file)
+    age_var = AGE if AGE in columns else "PRTAGE"
+    key_columns = get_household_key_columns(columns)
+    data_df = read_month(data_file, key_columns + [LINE_NUMBER, MONTH_IN_SAMPLE, GENDER, RACE, age_var])
+    return pd.DataFrame({
+        HOUSEHOLD_KEY: get_household_keys(data_df, key_columns),
+        LINE_NUMBER: data_df[LINE_NUMBER].fillna(-1).to_numpy(dtype=np.int8),
+        MONTH_INDEX: np.int16(get_month_index(get_month(data_file))),
+        MONTH_IN_SAMPLE: data_df[MONTH_IN_SAMPLE].fillna(-1).to_numpy(dtype=np.int8),
+        GENDER: data_df[GENDER].fillna(-1).to_numpy(dtype=np.int8),
+        RACE: data_df[RACE].fillna(-1).to_numpy(dtype=np.int8),
+        AGE: data_df[age_var].fillna(-1).to_numpy(dtype=np.int16),
+        ROW_NUMBER: np.arange(len(data_df), dtype=np.int32),
+    })
+
+def link_persons(keys_df: pd.DataFrame) -> pd.Series:
+    """
+    Link the persons across months with one sort-merge over all months: after sorting by
+    (household key, line, origin month, month), consecutive rows with the same keys are
+    the same person if the sex and race are equal and the age is consistent with the
+    months elapsed (a failed check starts a new person).
+
+    Args:
+        keys_df (pd.DataFrame): The linking keys of all months (see load_link_keys).
+
+    Returns:
+        pd.Series: The person ID of each row (0, 1, ...), aligned with keys_df.
+    """
+    month = keys_df[MONTH_INDEX].to_numpy(dtype=np.int32)
+    month_in_sample = keys_df[MONTH_IN_SAMPLE].to_numpy(dtype=np.int32)
+    origin = month - (month_in_sample - 1) - np.where(month_in_sample > 4, ROTATION_GAP_MONTHS, 0)
+    household_key, line = keys_df[HOUSEHOLD_KEY].to_numpy(), keys_df[LINE_NUMBER].to_numpy()
+    order = np.lexsort((month, origin, line, household_key))
+
+    def consecutive(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        sorted_values = values[order]
+        return sorted_values[1:], sorted_values[:-1]
+
+    same_key = np.ones(len(order) - 1 if len(order) else 0, dtype=bool)
+    for values in [household_key, line, origin]:
+        current, previous = consecutive(values)
+        same_key &= current == previous
+    current_month, previous_month = consecutive(month)
+    same_key &= (current_month > previous_month) & (month_in_sample[order][1:] > 0)
+
+    consistent = np.ones_like(same_key)
+    for var in [GENDER, RACE]:
+        current, previous = consecutive(keys_df[var].to_numpy())
+        consistent &= current == previous
+    current_age, previous_age = consecutive(keys_df[AGE].to_numpy(dtype=np.int32))
+    age_change = current_age - previous_age
+    consistent &= ((age_change >= 0) & (age_change <= (current_month - previous_month) // 12 + 1)) | \
+                  (np.minimum(current_age, previous_age) >= AGE_TOP_CODE)
+
+    is_linked = same_key & consistent
+    print(f"Linked {is_linked.sum()} of {len(order)} person-months to an earlier interview "
+          f"({(same_key & ~consistent).sum()} key matches rejected by the sex, race or age checks)")
+    person_ids = np.empty(len(order), dtype=np.int64)
+    person_ids[order] = np.cumsum(np.r_[True, ~is_linked]) - 1
+    return pd.Series(person_ids, index=keys_df.index, name=PERSON_LINK_ID)
+
+def summarize_links(links_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Get the share of the persons in each month in sample that are linked to an interview in
+    the previous month in sample (month in sample 5 is linked to 4, after the 8-month gap).
+    """
+    previous_df = links_df[[PERSON_LINK_ID, MONTH_IN_SAMPLE]].copy()
+    previous_df[MONTH_IN_SAMPLE] += 1
+    previous_df["LINKED"] = True
+    merged_df = links_df[[PERSON_LINK_ID, MONTH_IN_SAMPLE]].merge(
+        previous_df.drop_duplicates(), on=[PERSON_LINK_ID, MONTH_IN_SAMPLE], how="left")
+    return merged_df.groupby(MONTH_IN_SAMPLE)["LINKED"].agg(lambda linked: linked.notna().mean()).rename("LINK_RATE").reset_index()
+
+def build_person_links(data_files: List[Path], output_file: Path = CPS_DATA_PERSON_LINKS) -> pd.DataFrame:
+    """
+    Link the persons of all monthly files and save the links (month, row in the monthly
+    file, person ID and number of linked months), so that any stage can join them back.
+
+    Args:
+        data_files (List[Path]): The monthly data files (e.g. the cleaned files from the catalog).
+        output_file (Path): The Parquet file of the links.
+
+    Returns:
+        pd.DataFrame: The links.
+    """
+    months = [get_month(data_file) for data_file in data_files]
+    keys_df = pd.concat([load_link_keys(data_file) for data_file in tqdm(data_files, desc="Loading linking keys")],
+                        ignore_index=True)
+    person_ids = link_persons(keys_df)
+    months_linked = np.bincount(person_ids.to_numpy())[person_ids.to_numpy()]
+    month_values = np.array([int(month) for month in months], dtype=np.int32)
+    month_indexes = np.array([get_month_index(month) for month in months])
+    links_df = pd.DataFrame({
+        MONTH: month_values[np.searchsorted(month_indexes, keys_df[MONTH_INDEX].to_numpy())],
+        ROW_NUMBER: keys_df[ROW_NUMBER],
+        MONTH_IN_SAMPLE: keys_df[MONTH_IN_SAMPLE],
+        LINE_NUMBER: keys_df[LINE_NUMBER],
+        PERSON_LINK_ID: person_ids,
+        MONTHS_LINKED: months_linked.astype(np.int8),
+    })
+    with atomic_output(output_file, data_files) as temp_file:
+        pq.write_table(pa.Table.from_pandas(links_df, preserve_index=False), temp_file)
+    return links_df
+
+def main() -> None:
+    data_files = sorted(get_month_files(refresh_catalog(["cleaned"]), "cleaned"), key=get_month)
+    links_df = build_person_links(data_files)
+    print(f"{links_df[PERSON_LINK_ID].nunique()} persons in {len(links_df)} person-months")
+    print(summarize_links(links_df).round(3).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+from typing import List, Tuple
+import numpy as np
+from fixed_width_kernel import decode_fixed_width_columns
+from variable_typing import HOUSEHOLD_ID
+
+# Households are kept when the top 53 bits of the SplitMix64 hash of HRHHID fall below the
+# sample fraction: the same households are kept in every month, stage and run, and a smaller
+# fraction keeps a subset of the households of a larger one.
+HASH_BITS = 53
+
+def splitmix64(values: np.ndarray) -> np.ndarray:
+    """
+    Hash integers with the SplitMix64 finalizer (uint64 arithmetic wraps around).
+    """
+    z = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+def keep_households(household_ids: np.ndarray, fraction: float) -> np.ndarray:
+    """
+    Select a deterministic fraction of the households.
+
+    Args:
+        household_ids (np.ndarray): The HRHHID of each record.
+        fraction (float): The fraction of the households to keep, in (0, 1].
+
+    Returns:
+        np.ndarray: A boolean mask of the records of the kept households.
+    """
+    if fraction >= 1:
+        return np.ones(len(household_ids), dtype=bool)
+    threshold = np.uint64(int(fraction * 2**HASH_BITS))
+    return (splitmix64(household_ids) >> np.uint64(64 - HASH_BITS)) < threshold
+
+def sample_household_records(buffer: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+                             colspecs: List[Tuple[str, int, int]], fraction: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Keep the records of a deterministic fraction of the households of a fixed-width file,
+    before the other columns are decoded (only HRHHID is decoded for all records).
+
+    Args:
+        buffer (np.ndarray): The raw bytes.
+        starts (np.ndarray): The start offset of each record.
+        ends (np.ndarray): The end offset of each record.
+        colspecs (List[Tuple[str, int, int]]): The column specifications of the file.
+        fraction (float): The fraction of the households to keep.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The start and end offsets of the kept records.
+    """
+    household_colspecs = [colspec for colspec in colspecs if colspec[0] == HOUSEHOLD_ID]
+    if not household_colspecs:
+        raise ValueError(f"{HOUSEHOLD_ID} is not in the record layout, households cannot be sampled.")
+    household_df, _ = decode_fixed_width_columns(buffer, starts, ends, household_colspecs)
+    household_ids = household_df[HOUSEHOLD_ID].to_numpy(dtype=np.int64, na_value=0)
+    keep = keep_households(household_ids, fraction)
+    return starts[keep], ends[keep]
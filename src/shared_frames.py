@@ -0,0 +1,165 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from variable_schema import SCHEMA, concat_with_schema
+from variable_typing import *
+
+# Column buffers are aligned to this many bytes inside a shared memory block
+BUFFER_ALIGNMENT = 64
+
+def publish_frame(data_df: pd.DataFrame) -> Dict:
+    """
+    Copy the columns of a DataFrame into one shared memory block, so that another process
+    can read them without pickling. Categorical columns are published as their codes; only
+    the categories travel with the handle.
+
+    Args:
+        data_df (pd.DataFrame): A DataFrame with numeric or categorical columns (e.g. the schema dtypes).
+
+    Returns:
+        Dict: The handle of the block (name, rows, column layout and categories), small enough to pickle.
+    """
+    arrays, categories = {}, {}
+    for col in data_df.columns:
+        series = data_df[col]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            arrays[col] = series.cat.codes.to_numpy()
+            categories[col] = series.cat.categories.tolist()
+        elif pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_extension_array_dtype(series):
+            arrays[col] = series.to_numpy()
+        else:
+            raise ValueError(f"Column {col} has dtype {series.dtype}, which cannot be published.")
+
+    layout, size = [], 0
+    for col, array in arrays.items():
+        layout.append((col, array.dtype.str, size))
+        size += -(-array.nbytes // BUFFER_ALIGNMENT) * BUFFER_ALIGNMENT
+    shm = SharedMemory(create=True, size=max(size, 1))
+    for (col, dtype, offset), array in zip(layout, arrays.values()):
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf, offset=offset)
+        view[:] = array
+        del view
+    shm.close()
+    # The block is owned (and unlinked) by the process that assembles it, not by this one
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return {"name": shm.name, "rows": len(data_df), "layout": layout, "categories": categories}
+
+def discard_frames(handles: List[Dict]) -> None:
+    """
+    Release the shared memory blocks of published frames that will not be assembled.
+    """
+    for handle in handles:
+        try:
+            shm = SharedMemory(name=handle["name"])
+        except FileNotFoundError:
+            continue
+        shm.close()
+        shm.unlink()
+
+def assemble_frames(handles: List[Dict]) -> pd.DataFrame:
+    """
+    Assemble published frames into one DataFrame, copying each column buffer once straight
+    from shared memory (no serialization), and release the blocks. The categories of the
+    categorical columns are unioned and the codes remapped.
+
+    Args:
+        handles (List[Dict]): The handles from publish_frame, in row order.
+
+    Returns:
+        pd.DataFrame: The concatenated frames.
+    """
+    segments = [SharedMemory(name=handle["name"]) for handle in handles]
+    try:
+        num_rows = sum(handle["rows"] for handle in handles)
+        starts = np.cumsum([0] + [handle["rows"] for handle in handles])
+        columns = {}
+        for col_index, (col, dtype, _) in enumerate(handles[0]["layout"]):
+            if col in handles[0]["categories"]:
+                all_categories = pd.Index(pd.unique(np.concatenate(
+                    [np.asarray(handle["categories"][col], dtype=object) for handle in handles])))
+                code_dtype = np.int16 if len(all_categories) < 2**15 else np.int32
+                codes = np.empty(num_rows, dtype=code_dtype)
+            else:
+                codes = np.empty(num_rows, dtype=np.dtype(dtype))
+            for handle, shm, start, end in zip(handles, segments, starts[:-1], starts[1:]):
+                layout_col, layout_dtype, offset = handle["layout"][col_index]
+                view = np.ndarray(handle["rows"], dtype=np.dtype(layout_dtype), buffer=shm.buf, offset=offset)
+                if col in handle["categories"]:
+                    # Map the local codes to the codes of the union (-1 stays missing)
+                    indexer = np.append(all_categories.get_indexer(handle["categories"][col]), -1).astype(code_dtype)
+                    codes[start:end] = indexer[view]
+                else:
+                    codes[start:end] = view
+                del view
+            if col in handles[0]["categories"]:
+                columns[col] = pd.Categorical.from_codes(codes, categories=all_categories)
+            else:
+                columns[col] = codes
+        return pd.DataFrame(columns)
+    finally:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+
+def make_synthetic_month(seed: int, num_rows: int) -> pd.DataFrame:
+    """
+    Make a month of synthetic merged data with the schema dtypes (for the benchmark).
+    """
+    rng = np.random.default_rng(seed)
+    data_df = pd.DataFrame({col: rng.integers(0, 100, num_rows).astype(dtype)
+                            for col, dtype in SCHEMA.items() if dtype != "category"})
+    cohort_ids = [f"{1940 + i % 60}_{i // 60 % 3 + 1}_{i // 180 % 2 + 1}_{31 + i // 360 % 16}_{i // 5760 + 11}"
+                  for i in range(20000)]
+    cohorts = pd.Categorical.from_codes(rng.integers(0, len(cohort_ids), num_rows), categories=cohort_ids)
+    data_df[COHORT_ID] = cohorts.remove_unused_categories()
+    return data_df[NEEDED_VARS]
+
+def count_synthetic_month(seed: int, num_rows: int) -> int:
+    return len(make_synthetic_month(seed, num_rows))
+
+def publish_synthetic_month(seed: int, num_rows: int) -> Dict:
+    return publish_frame(make_synthetic_month(seed, num_rows))
+
+def benchmark_transport(num_months: int, num_rows: int, max_workers: int) -> None:
+    """
+    Compare the merge of monthly frames made in worker processes, returned by pickling
+    against handed over through shared memory.
+    """
+    seeds, sizes = list(range(num_months)), [num_rows] * num_months
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        start = time.perf_counter()
+        sum(executor.map(count_synthetic_month, seeds, sizes)) # the data generation alone
+        generation_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        month_dfs = list(executor.map(make_synthetic_month, seeds, sizes))
+        pickled_df = concat_with_schema(month_dfs)
+        pickle_time = time.perf_counter() - start
+        del month_dfs
+
+        start = time.perf_counter()
+        shared_df = assemble_frames(list(executor.map(publish_synthetic_month, seeds, sizes)))
+        shared_time = time.perf_counter() - start
+
+    if not shared_df.astype({COHORT_ID: str}).equals(pickled_df.astype({COHORT_ID: str})):
+        raise ValueError("The assembled frame differs from the pickled frame.")
+    print(f"{num_months} months x {num_rows} rows ({shared_df.memory_usage(deep=True).sum() / 1e6:.0f} MB), "
+          f"{max_workers} workers, transport and merge time (without the {generation_time:.2f} s of data generation):")
+    print(f"  pickling:      {pickle_time - generation_time:.2f} s")
+    print(f"  shared memory: {shared_time - generation_time:.2f} s")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the shared memory transport against pickling.")
+    parser.add_argument("--months", type=int, default=372, help="number of months (the 1994-2024 archive by default)")
+    parser.add_argument("--rows", type=int, default=35000, help="rows per month in the merged data")
+    parser.add_argument("--workers", type=int, default=4, help="number of worker processes")
+    args = parser.parse_args()
+    benchmark_transport(args.months, args.rows, args.workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+import argparse
+import struct
+import time
+import numpy as np
+import pandas as pd
+from atomic_io import atomic_output
+from column_stats import load_column_stats
+from config import CPS_DATA_CSV_DIR, CPS_DICT_CSV_LIST, CPS_DATA_STATA_DIR, STATA_CHUNK_ROWS
+from merged_dataset import get_dataset, get_dataset_ranges, build_filter_expression
+from prep_02_parse_cps_datasets import find_corresponding_dict_file
+from household_tables import get_household_file, load_household_columns, join_household_columns, read_month
+from variable_typing import *
+
+# Stata 14+ format (dta 118): the header, the variable descriptors and the labels are written
+# first, the rows are appended chunk by chunk, and the row count and the section offsets are
+# patched at the end, so that the data never has to be in memory at once.
+DTA_RELEASE = b"118"
+BYTE, INT, LONG, FLOAT, DOUBLE = 65530, 65529, 65528, 65527, 65526
+MAX_STR_LENGTH = 2045
+
+# Valid range and missing value (".") of the integer types, and the numpy type of each Stata type
+INT_RANGES = {BYTE: (-127, 100), INT: (-32767, 32740), LONG: (-2147483647, 2147483620)}
+INT_MISSING = {BYTE: 101, INT: 32741, LONG: 2147483621}
+NUMPY_TYPES = {BYTE: "<i1", INT: "<i2", LONG: "<i4", FLOAT: "<f4", DOUBLE: "<f8"}
+FLOAT_MISSING = {FLOAT: struct.unpack("<f", b"\x00\x00\x00\x7f")[0],
+                 DOUBLE: struct.unpack("<d", b"\x00\x00\x00\x00\x00\x00\xe0\x7f")[0]}
+
+# Labels of the variables constructed by the pipeline (the others come from the dictionaries)
+DERIVED_VARIABLE_LABELS = {
+    COHORT_ID: "Cohort: birth year, race, sex, education, state",
+    DATA_YEAR: "Survey year",
+    BIRTH_YEAR: "Year of birth (survey year - age)",
+    IS_MARRIED: "Married (1), never married (0)",
+    MARRIAGE_TIMES: "Ever married: 1, never married: 0 (-1 unknown)",
+    HAS_SPOUSE_PRESENT: "Spouse present in the household",
+    SPOUSE_AGE: "Age of the spouse (-1 if none)",
+    SPOUSE_EDUCATION: "Education of the spouse (-1 if none)",
+    SPOUSE_HOURS: "Usual hours of the spouse (-1 if none)",
+    HAS_CHILD: "Own child in the household",
+    AGE_OF_OLDEST_CHILD: "Age of the oldest child (-1 if none)",
+    YEAR_OF_FIRST_BIRTH_GIVING: "Year of the first birth (-1 if none)",
+}
+
+def get_stata_type(dtype: str, low: Optional[float] = None, high: Optional[float] = None,
+                   max_length: int = 1) -> int:
+    """
+    Get the smallest Stata type that holds a column: an integer type if the range fits
+    (values outside the valid range of a type are reserved for missing values), a double
+    otherwise, or a fixed-length string.
+
+    Args:
+        dtype (str): "int", "float" or "str".
+        low (Optional[float]): The minimum of the column (None if unknown).
+        high (Optional[float]): The maximum of the column (None if unknown).
+        max_length (int): The maximum length of a string column, in bytes.
+
+    Returns:
+        int: The Stata type code.
+    """
+    if dtype == "str":
+        if max_length > MAX_STR_LENGTH:
+            raise ValueError(f"Strings longer than {MAX_STR_LENGTH} bytes are not supported.")
+        return max(max_length, 1)
+    if dtype == "int":
+        for stata_type in [BYTE, INT, LONG]:
+            valid_low, valid_high = INT_RANGES[stata_type]
+            if low is None or high is None:
+                continue
+            if valid_low <= low and high <= valid_high:
+                return stata_type
+    return DOUBLE
+
+def get_display_format(stata_type: int) -> str:
+    if stata_type <= MAX_STR_LENGTH:
+        return f"%{stata_type}s"
+    return {BYTE: "%8.0g", INT: "%8.0g", LONG: "%12.0g", FLOAT: "%9.0g", DOUBLE: "%10.0g"}[stata_type]
+
+def fixed_bytes(text: str, size: int) -> bytes:
+    """
+    Encode a text as a null-terminated field of a fixed size (truncated to fit).
+    """
+    encoded = text.encode("utf-8")[:size - 1]
+    return encoded + b"\x00" * (size - len(encoded))
+
+def pack_rows(chunk_df: pd.DataFrame, columns: List[str], types: List[int]) -> bytes:
+    """
+    Pack the rows of a chunk in the Stata record layout (missing values as ".").
+    """
+    record_dtype = np.dtype([(col, f"S{stata_type}" if stata_type <= MAX_STR_LENGTH else NUMPY_TYPES[stata_type])
+                             for col, stata_type in zip(columns, types)])
+    records = np.zeros(len(chunk_df), dtype=record_dtype)
+    for col, stata_type in zip(columns, types):
+        series = chunk_df[col]
+        if stata_type <= MAX_STR_LENGTH:
+            values = series.astype(object).where(series.notna(), "").astype(str).to_numpy()
+            try:
+                records[col] = values.astype(f"S{stata_type}") # fast path for ASCII codes
+            except UnicodeEncodeError:
+                records[col] = [value.encode("utf-8") for value in values]
+        elif stata_type in INT_MISSING:
+            is_missing = series.isna().to_numpy()
+            values = series.to_numpy(dtype=np.float64, na_value=0)
+            if np.any(values != np.round(values)):
+                raise ValueError(f"{col} has non-integer values and cannot be exported as an integer type.")
+            records[col] = np.where(is_missing, INT_MISSING[stata_type], values)
+        else:
+            values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+            records[col] = np.where(np.isnan(values), FLOAT_MISSING[stata_type], values)
+    return records.tobytes()
+
+def write_dta(output_file: Path, columns: List[str], types: List[int], chunks: Iterable[pd.DataFrame],
+              variable_labels: Optional[Dict[str, str]] = None, data_label: str = "") -> int:
+    """
+    Write a Stata .dta file (format 118) from an iterable of chunks, streaming the rows.
+
+    Args:
+        output_file (Path): The .dta file.
+        columns (List[str]): The variable names.
+        types (List[int]): The Stata type of each variable (see get_stata_type).
+        chunks (Iterable[pd.DataFrame]): The rows, chunk by chunk.
+        variable_labels (Optional[Dict[str, str]]): The variable labels (up to 80 characters).
+        data_label (str): The dataset label.
+
+    Returns:
+        int: The number of rows written.
+    """
+    variable_labels = variable_labels or {}
+    num_vars = len(columns)
+    with atomic_output(output_file) as temp_file, open(temp_file, "wb") as f:
+        f.write(b"<stata_dta><header><release>" + DTA_RELEASE + b"</release><byteorder>LSF</byteorder>")
+        f.write(b"<K>" + struct.pack("<H", num_vars) + b"</K><N>")
+        rows_position = f.tell()
+        f.write(struct.pack("<Q", 0) + b"</N>")
+        label = data_label.encode("utf-8")[:80]
+        timestamp = time.strftime("%d %b %Y %H:%M").encode()
+        f.write(b"<label>" + struct.pack("<H", len(label)) + label + b"</label>")
+        f.write(b"<timestamp>" + struct.pack("<B", len(timestamp)) + timestamp + b"</timestamp></header>")
+        map_position = f.tell()
+        f.write(b"<map>" + bytes(14 * 8) + b"</map>")
+
+        offsets = [0, map_position]
+        def write_section(name: str, payload: bytes) -> None:
+            offsets.append(f.tell())
+            f.write(f"<{name}>".encode() + payload + f"</{name}>".encode())
+
+        write_section("variable_types", struct.pack(f"<{num_vars}H", *types))
+        write_section("varnames", b"".join(fixed_bytes(col, 129) for col in columns))
+        write_section("sortlist", bytes(2 * (num_vars + 1)))
+        write_section("formats", b"".join(fixed_bytes(get_display_format(t), 57) for t in types))
+        write_section("value_label_names", bytes(129 * num_vars))
+        write_section("variable_labels", b"".join(fixed_bytes(variable_labels.get(col, "")[:80], 321)
+                                                  for col in columns))
+        write_section("characteristics", b"")
+
+        offsets.append(f.tell())
+        f.write(b"<data>")
+        num_rows = 0
+        for chunk_df in chunks:
+            f.write(pack_rows(chunk_df, columns, types))
+            num_rows += len(chunk_df)
+        f.write(b"</data>")
+        write_section("strls", b"")
+        write_section("value_labels", b"")
+        offsets.append(f.tell())
+        f.write(b"</stata_dta>")
+        offsets.append(f.tell())
+
+        # Patch the row count and the section offsets
+        f.seek(rows_position)
+        f.write(struct.pack("<Q", num_rows))
+        f.seek(map_position + len(b"<map>"))
+        f.write(struct.pack("<14Q", *offsets))
+    return num_rows
+
+def get_dictionary_labels(dict_csv_file: Path) -> Dict[str, str]:
+    """
+    Get the variable labels of a dictionary (its "desc" column).
+    """
+    dict_df = pd.read_csv(dict_csv_file)
+    if "desc" not in dict_df.columns:
+        return {}
+    return {row.var_name: str(row.desc).strip() for row in dict_df.itertuples() if pd.notna(row.desc)}
+
+def export_month(csv_file: Path, output_file: Path, chunk_rows: int = STATA_CHUNK_ROWS) -> int:
+    """
+    Export a decoded (or cleaned) month to Stata, with the types from its sidecar statistics,
+    the string widths, the variable order and the variable labels from its dictionary, reading
+    the CSV in chunks (the household fields are joined from the household table).
+
+    Args:
+        csv_file (Path): The monthly CSV file (with a sidecar statistics file).
+        output_file (Path): The .dta file.
+        chunk_rows (int): The number of rows per chunk.
+
+    Returns:
+        int: The number of rows written.
+    """
+    stats = load_column_stats(csv_file)
+    if stats is None:
+        raise ValueError(f"No up-to-date column statistics for {csv_file}, decode it again with prep_02.")
+    dict_csv_file = find_corresponding_dict_file(csv_file, CPS_DICT_CSV_LIST)
+    dict_df = pd.read_csv(dict_csv_file)
+    widths = dict_df.set_index("var_name")["var_len"].to_dict()
+    household_stats = load_column_stats(get_household_file(csv_file)) or {"columns": {}}
+    household_columns = [col for col in household_stats["columns"] if col not in stats["columns"]]
+    column_stats = {**stats["columns"], **{col: household_stats["columns"][col] for col in household_columns}}
+    positions = {name: i for i, name in enumerate(dict_df["var_name"])}
+
+    columns, types, dtypes = [], [], {}
+    for col, col_stats in sorted(column_stats.items(), key=lambda item: positions.get(item[0], len(positions))):
+        if col_stats["dtype"] == "object":
+            types.append(get_stata_type("str", max_length=int(widths.get(col, MAX_STR_LENGTH))))
+            dtypes[col] = str
+        else:
+            types.append(get_stata_type("int", col_stats["min"], col_stats["max"]))
+            dtypes[col] = "float64" # integer codes, with missing values
+        columns.append(col)
+    household_df = load_household_columns(csv_file, household_columns) if household_columns else None
+    chunks = (join_household_columns(chunk_df, csv_file, household_columns, household_df)
+              for chunk_df in pd.read_csv(csv_file, dtype=dtypes, chunksize=chunk_rows))
+    return write_dta(output_file, columns, types, chunks, get_dictionary_labels(dict_csv_file),
+                     data_label=f"CPS basic monthly {csv_file.stem.split('_')[-1]}")
+
+def get_variable_labels(columns: List[str]) -> Dict[str, str]:
+    """
+    Get the labels of the merged variables: the derived ones, and the newest dictionary
+    description of the survey variables.
+    """
+    labels = {}
+    for dict_csv_file in sorted(file for file in CPS_DICT_CSV_LIST if file.exists()):
+        labels.update(get_dictionary_labels(dict_csv_file))
+    labels.update(DERIVED_VARIABLE_LABELS)
+    return {col: labels[col] for col in columns if col in labels}
+
+def export_merged_dataset(output_file: Path, filters: Optional[Dict] = None, columns: Optional[List[str]] = None,
+                          chunk_rows: int = STATA_CHUNK_ROWS) -> int:
+    """
+    Export the merged dataset (or a filtered subset) to Stata, batch by batch. The integer
+    types come from the row-group statistics and the string widths from a pass over the
+    string columns only.
+
+    Args:
+        output_file (Path): The .dta file.
+        filters (Optional[Dict]): The filters (see merged_dataset.build_filter_expression).
+        columns (Optional[List[str]]): The variables to export (NEEDED_VARS by default).
+        chunk_rows (int): The number of rows per batch.
+
+    Returns:
+        int: The number of rows written.
+    """
+    columns = columns or NEEDED_VARS
+    dataset = get_dataset()
+    expression = build_filter_expression(filters)
+    ranges = get_dataset_ranges(dataset, [col for col in columns if col != DATA_YEAR])
+    ranges[DATA_YEAR] = (1994, 9999)
+
+    types = []
+    for col in columns:
+        field_type = dataset.schema.field(col).type
+        if str(field_type).startswith(("string", "dictionary")):
+            values = dataset.to_table(columns=[col], filter=expression).column(col).to_pandas().astype(str)
+            types.append(get_stata_type("str", max_length=int(values.str.len().max() if len(values) else 1)))
+        elif str(field_type).startswith(("int", "uint")):
+            low, high = ranges[col] or (None, None)
+            types.append(get_stata_type("int", low, high))
+        else:
+            types.append(DOUBLE)
+
+    batches = dataset.to_batches(columns=columns, filter=expression, batch_size=chunk_rows)
+    chunks = (batch.to_pandas() for batch in batches)
+    return write_dta(output_file, columns, types, chunks, get_variable_labels(columns), data_label="CPS merged data")
+
+def benchmark_month(csv_file: Path, output_dir: Path = CPS_DATA_STATA_DIR) -> None:
+    """
+    Compare the .dta export of a month with the CSV path (file size and load time), and check
+    that the .dta file holds the same data as the CSV file.
+    """
+    dta_file = output_dir / f"{csv_file.stem}.dta"
+    start = time.perf_counter()
+    num_rows = export_month(csv_file, dta_file)
+    export_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    csv_df = read_month(csv_file) # person and household tables
+    csv_time = time.perf_counter() - start
+    start = time.perf_counter()
+    dta_df = pd.read_stata(dta_file)
+    dta_time = time.perf_counter() - start
+    csv_df = csv_df[dta_df.columns]
+
+    str_columns = [col for col in csv_df.columns if csv_df[col].dtype == object]
+    same = dta_df[str_columns].replace("", np.nan).equals(csv_df[str_columns]) and np.allclose(
+        dta_df.drop(columns=str_columns).to_numpy(dtype=np.float64),
+        csv_df.drop(columns=str_columns).to_numpy(dtype=np.float64), equal_nan=True)
+    print(f"{csv_file.stem}: {num_rows} rows x {len(csv_df.columns)} columns, exported in {export_time:.2f} s "
+          f"({'same data' if same else 'DIFFERENT DATA'})")
+    print(f"  CSV: {csv_file.stat().st_size / 1e6:.1f} MB, loaded in {csv_time:.2f} s (untyped, parsed at every load)")
+    print(f"  DTA: {dta_file.stat().st_size / 1e6:.1f} MB, loaded in {dta_time:.2f} s (typed, with variable labels)")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Export the CPS data to Stata .dta files.")
+    parser.add_argument("--month", help="export a decoded month (YYYYMM) instead of the merged dataset")
+    parser.add_argument("--benchmark", action="store_true", help="compare the export of the month with its CSV file")
+    args = parser.parse_args()
+
+    CPS_DATA_STATA_DIR.mkdir(parents=True, exist_ok=True)
+    if args.month:
+        csv_file = CPS_DATA_CSV_DIR / f"cps_{args.month}.csv"
+        if args.benchmark:
+            benchmark_month(csv_file)
+        else:
+            print(f"{export_month(csv_file, CPS_DATA_STATA_DIR / f'{csv_file.stem}.dta')} rows exported.")
+        return
+    output_file = CPS_DATA_STATA_DIR / "cps_data_merged.dta"
+    print(f"{export_merged_dataset(output_file)} rows exported to {output_file}.")
+
+if __name__ == "__main__":
+    main()
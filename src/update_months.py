@@ -0,0 +1,150 @@
+from datetime import date
+from pathlib import Path
+from typing import Dict, List, Optional
+from config import (CPS_DATA_GZ_DIR, CPS_DATA_BLOCKS_DIR, CPS_DATA_CSV_DIR, CPS_DATA_CLEANED_DIR, CPS_DATA_CHILD_DIR,
+                    CPS_DICT_CSV_LIST, CPS_DATA_DOWNLOAD_MANIFEST, CPS_DATA_COHORT_STATUS)
+from atomic_io import is_complete
+from fetch_engine import load_manifest
+from month_catalog import load_catalog, refresh_catalog
+from merged_dataset import list_merged_months, write_month
+from derived_cache import evict_results
+from download_01_cps_dictionaries_and_datasets import download_cps_months
+from block_archive import build_archive
+from prep_02_parse_cps_datasets import convert_fixed_width_data_to_csv, find_corresponding_dict_file
+from prep_03_clean_str_variables import clean_data_file
+from prep_04_construct_family_related_variables import construct_child_data_file, get_child_inputs
+from prep_05_clean_and_merge_datasets import load_child_data
+from prep_06_construct_pseudo_panel import update_pseudo_panel, main as construct_pseudo_panel
+from variable_typing import NEEDED_VARS
+
+# The update mode only touches the months that are not in the merged dataset yet, so its run
+# time depends on the number of new months and not on the length of the archive.
+LAST_MONTH_BEFORE_ARCHIVE = "199312" # the archive starts in January 1994
+
+def get_months_after(last_month: str, until: date) -> List[str]:
+    """
+    List the months after last_month ("YYYYMM"), up to the month of a date.
+    """
+    year, month = int(last_month[:4]), int(last_month[4:])
+    months = []
+    while True:
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        if (year, month) > (until.year, until.month):
+            return months
+        months.append(f"{year}{month:02d}")
+
+def discover_new_months(manifest: Dict[str, Dict], catalog: Dict[str, Dict], today: Optional[date] = None) -> List[str]:
+    """
+    Find the months to request: the months after the newest month already downloaded, up to
+    the current month (months answered with 404 are rechecked by the download engine).
+
+    Args:
+        manifest (Dict[str, Dict]): The download status manifest.
+        catalog (Dict[str, Dict]): The month catalog.
+        today (Optional[date]): The current date (today by default).
+
+    Returns:
+        List[str]: The months to request, "YYYYMM".
+    """
+    known = [month for month, entry in manifest.items() if entry["status"] == "downloaded"]
+    known += [month for month, entry in catalog.items() if {"gz", "blocks"} & set(entry["artifacts"])]
+    last_month = max(known) if known else LAST_MONTH_BEFORE_ARCHIVE
+    return get_months_after(last_month, today or date.today())
+
+def get_unmerged_months(catalog: Dict[str, Dict], merged_months: List[str]) -> List[str]:
+    """
+    Get the downloaded months that are not in the merged dataset yet.
+    """
+    return sorted(month for month, entry in catalog.items()
+                  if {"gz", "blocks"} & set(entry["artifacts"]) and month not in set(merged_months))
+
+def format_months(months: List[str]) -> str:
+    """
+    Format a list of months for printing, e.g. "199502-199612" for a long list.
+    """
+    if not months:
+        return "none"
+    return ", ".join(months) if len(months) <= 5 else f"{months[0]}-{months[-1]}"
+
+def build_month_files(month: str) -> Path:
+    """
+    Run archive -> decode -> clean -> family variables for a month, skipping the steps whose
+    output is already complete (the archive is only built when the .gz file is there).
+
+    Args:
+        month (str): The month, "YYYYMM".
+
+    Returns:
+        Path: The child-related data file of the month.
+    """
+    name = f"cps_{month}"
+    archive_file = CPS_DATA_BLOCKS_DIR / f"{name}.blk"
+    gz_file = CPS_DATA_GZ_DIR / f"{name}.gz"
+    csv_file = CPS_DATA_CSV_DIR / f"{name}.csv"
+    cleaned_file = CPS_DATA_CLEANED_DIR / f"{name}.csv"
+    child_file = CPS_DATA_CHILD_DIR / f"{name}.csv"
+
+    if gz_file.exists() and not is_complete(archive_file, [gz_file]):
+        build_archive(gz_file, archive_file)
+    dict_csv_file = find_corresponding_dict_file(archive_file, CPS_DICT_CSV_LIST)
+    CPS_DATA_CSV_DIR.mkdir(parents=True, exist_ok=True)
+    convert_fixed_width_data_to_csv(archive_file, dict_csv_file, CPS_DATA_CSV_DIR) # skipped if complete
+    CPS_DATA_CLEANED_DIR.mkdir(parents=True, exist_ok=True)
+    clean_data_file(csv_file, cleaned_file)
+    if not is_complete(child_file, get_child_inputs(cleaned_file)):
+        construct_child_data_file(cleaned_file, child_file)
+    return child_file
+
+def process_month(month: str) -> None:
+    """
+    Build the files of a month (see build_month_files) and add its rows to the merged dataset.
+
+    Args:
+        month (str): The month, "YYYYMM".
+    """
+    child_file = build_month_files(month)
+    write_month(load_child_data(child_file, NEEDED_VARS), month, inputs=[child_file])
+
+def update(dry_run: bool = False, today: Optional[date] = None) -> List[str]:
+    """
+    Bring the pipeline up to date with the months published since the last run: download
+    the new months, process only them, append them to the merged dataset, and update the
+    pseudo panel for the affected cohorts.
+
+    Args:
+        dry_run (bool): Only print the months that would be requested and processed.
+        today (Optional[date]): The current date (today by default).
+
+    Returns:
+        List[str]: The months added to the merged dataset.
+    """
+    candidates = discover_new_months(load_manifest(CPS_DATA_DOWNLOAD_MANIFEST), load_catalog(), today)
+    if dry_run:
+        months = get_unmerged_months(load_catalog(), list_merged_months())
+        print(f"Would request {len(candidates)} months ({format_months(candidates)}) "
+              f"and merge {len(months)} downloaded months ({format_months(months)})")
+        return []
+
+    if candidates:
+        download_cps_months(candidates, CPS_DATA_GZ_DIR)
+    catalog = refresh_catalog(["gz", "blocks"])
+    months = get_unmerged_months(catalog, list_merged_months())
+    for month in months:
+        print(f"Processing {month}")
+        process_month(month)
+    evict_results()
+    refresh_catalog(["blocks", "csv", "households", "cleaned", "child"])
+
+    # Update the pseudo panel (rebuilt once if it has no cohort status yet)
+    if CPS_DATA_COHORT_STATUS.exists():
+        update_pseudo_panel(list_merged_months())
+    elif months:
+        construct_pseudo_panel()
+    print(f"{len(months)} new months added.")
+    return months
+
+def main() -> None:
+    update()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+from variable_typing import *
+
+# Compact dtypes of the coded variables (the CPS codes and ages fit in int8, years in int16)
+SCHEMA = {
+    COHORT_ID: "category",
+    DATA_YEAR: "int16",
+    BIRTH_YEAR: "int16",
+    RACE: "int8",
+    GENDER: "int8",
+    EDUCATION: "int8",
+    STATE: "int8",
+    AGE: "int8",
+    IS_MARRIED: "int8",
+    MARRITAL_STATUS: "int8",
+    MARRIAGE_TIMES: "int8",
+    HAS_SPOUSE_PRESENT: "int8",
+    SPOUSE_AGE: "int8",
+    SPOUSE_EDUCATION: "int8",
+    SPOUSE_HOURS: "int8",
+    HAS_CHILD: "int8",
+    AGE_OF_OLDEST_CHILD: "int8",
+    YEAR_OF_FIRST_BIRTH_GIVING: "int16",
+    TARGET_VAR1: "int8",
+    TARGET_VAR2: "int8",
+}
+
+def apply_schema(df: pd.DataFrame, schema: Dict[str, str] = SCHEMA) -> pd.DataFrame:
+    """
+    Cast the columns of a DataFrame to the schema dtypes (columns not in the schema are kept as
+    they are). The cast has to be lossless: missing values, non-integer values or values out of
+    the dtype range raise a ValueError.
+
+    Args:
+        df (pd.DataFrame): The DataFrame at a stage boundary.
+        schema (Dict[str, str]): The dtype of each variable.
+
+    Returns:
+        pd.DataFrame: The DataFrame with the schema dtypes.
+    """
+    dtypes = {}
+    for col in [col for col in df.columns if col in schema]:
+        dtype = schema[col]
+        if str(df[col].dtype) == dtype:
+            continue
+        dtypes[col] = dtype
+        if dtype == "category":
+            continue
+        values = df[col]
+        if values.isna().any():
+            raise ValueError(f"Missing values found in {col}: {values.isna().sum()} rows.")
+        info = np.iinfo(dtype)
+        if values.min() < info.min or values.max() > info.max:
+            raise ValueError(f"Values of {col} out of the {dtype} range: [{values.min()}, {values.max()}].")
+        if not (values.astype(dtype) == values).all():
+            raise ValueError(f"Non-integer values found in {col}.")
+    return df.astype(dtypes) if dtypes else df
+
+def concat_with_schema(dfs: List[pd.DataFrame], schema: Dict[str, str] = SCHEMA) -> pd.DataFrame:
+    """
+    Concatenate DataFrames that follow the schema, keeping the categorical columns categorical
+    (pd.concat falls back to object when the categories differ).
+
+    Args:
+        dfs (List[pd.DataFrame]): The DataFrames, e.g. one per month.
+        schema (Dict[str, str]): The dtype of each variable.
+
+    Returns:
+        pd.DataFrame: The concatenated DataFrame.
+    """
+    for col in [col for col, dtype in schema.items() if dtype == "category" and col in dfs[0].columns]:
+        categories = pd.api.types.union_categoricals([df[col] for df in dfs]).categories
+        for df in dfs:
+            df[col] = df[col].cat.set_categories(categories)
+    return pd.concat(dfs, ignore_index=True)
+
+def estimate_default_memory(df: pd.DataFrame) -> int:
+    """
+    Estimate the memory (bytes) the DataFrame would use with the default int64/float64/object dtypes.
+    """
+    num_bytes = df.index.memory_usage()
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            category_bytes = np.array([len(str(category)) + 49 for category in df[col].cat.categories]) # str object size
+            codes = df[col].cat.codes.to_numpy()
+            num_bytes += 8 * len(df) + int(category_bytes[codes[codes >= 0]].sum())
+        elif pd.api.types.is_numeric_dtype(df[col]):
+            num_bytes += 8 * len(df)
+        else:
+            num_bytes += int(df[col].memory_usage(deep=True, index=False))
+    return num_bytes
+
+def report_memory_usage(df: pd.DataFrame, label: str) -> None:
+    """
+    Print the memory used by a DataFrame with the schema dtypes, against the default dtypes.
+    """
+    used = df.memory_usage(deep=True).sum()
+    default = estimate_default_memory(df)
+    print(f"{label}: {used / 1e6:.1f} MB with the schema dtypes, {default / 1e6:.1f} MB with the default dtypes "
+          f"({default / max(used, 1):.1f}x)")
@@ -4,17 +4,29 @@
 TARGET_VAR1 = "HUFAMINC" # Family income
 TARGET_VAR2 = "PRHRUSL" # Usual working hours
 
+# String variables (alphanumeric codes, all other variables are numeric)
+STR_VARS = ["HRSAMPLE", "HRSERSUF"]
+
 # ID variables
 HOUSEHOLD_ID = "HRHHID"
 PERSON_NUM = "HUHHNUM"
 
+# Rotation linking variables (see rotation_links.py)
+HOUSEHOLD_ID2 = "HRHHID2" # second part of the household identifier (from May 2004)
+SAMPLE_ID = "HRSAMPLE"
+SERIAL_SUFFIX = "HRSERSUF"
+LINE_NUMBER = "PULINENO"
+MONTH_IN_SAMPLE = "HRMIS"
+PERSON_LINK_ID = "PERSON_LINK_ID"
+
 # Year variables
 DATA_YEAR = "DATA_YEAR"
 BIRTH_YEAR = "BIRTH_YEAR"
 AGE = "PEAGE"
 
 # Family variables
-RELATIONSHIP = "PRFAMREL"
+RELATIONSHIP = "PRFAMREL" # relative to the family (PRFAMNUM) of the household
+FAMILY_NUM = "PRFAMNUM"
 HAS_CHILD = "HAS_CHILD"
 IS_REF_OR_SPOUSE = "IS_REF_OR_SPOUSE"
 IS_CHILD = "IS_CHILD"
@@ -26,6 +38,10 @@ YEAR_OF_FIRST_BIRTH_GIVING = "YEAR_OF_FIRST_BIRTH_GIVING"
 MARRITAL_STATUS = "PEMARITL"
 IS_MARRIED = "IS_MARRIED"
 MARRIAGE_TIMES = "MARRIAGE_TIMES"
+HAS_SPOUSE_PRESENT = "HAS_SPOUSE_PRESENT"
+SPOUSE_AGE = "SPOUSE_AGE"
+SPOUSE_EDUCATION = "SPOUSE_EDUCATION"
+SPOUSE_HOURS = "SPOUSE_HOURS"
 
 # Demographic Variables
 BIRTH_YEAR = BIRTH_YEAR
@@ -43,7 +59,8 @@ MATCHING_VARS = [BIRTH_YEAR, RACE, GENDER, EDUCATION, STATE]
 # Variables needed for the analysis
 NEEDED_VARS = [COHORT_ID, DATA_YEAR, # Data year
                BIRTH_YEAR, RACE, GENDER, EDUCATION, STATE, # Demographic variables
-               AGE, IS_MARRIED, MARRITAL_STATUS, # Marriage variables
+               AGE, IS_MARRIED, MARRITAL_STATUS, MARRIAGE_TIMES, # Marriage variables
+               HAS_SPOUSE_PRESENT, SPOUSE_AGE, SPOUSE_EDUCATION, SPOUSE_HOURS, # Spouse variables
                HAS_CHILD, AGE_OF_OLDEST_CHILD, YEAR_OF_FIRST_BIRTH_GIVING, # Treatment variables
                TARGET_VAR1, TARGET_VAR2] # Target variables
                